@@ -7,6 +7,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, func
 from pydantic import BaseModel
 from typing import Dict
+import asyncio
 
 from app.database.session import get_db
 from app.models.user import User
@@ -32,6 +33,12 @@ class ReindexRequest(BaseModel):
     file_id: int
 
 
+class EmbeddingMigrationRequest(BaseModel):
+    provider: str
+    model: str
+    dimension: int  # 模型输出维度
+
+
 # ========== 依赖项 ==========
 
 async def require_admin(current_user: User = Depends(get_current_active_user)) -> User:
@@ -117,3 +124,111 @@ async def trigger_reindex(
     
     return {"message": "重新索引任务已触发", "file_id": file.id}
 
+
+@router.get("/embedding-migrations")
+async def list_embedding_migrations(
+    current_user: User = Depends(require_admin)
+):
+    """查看本组织的 embedding 模型切换记录"""
+    
+    from app.services.embedding_migration import embedding_migration_service
+    
+    migrations = await asyncio.to_thread(embedding_migration_service.list_migrations, current_user.org_id)
+    return [
+        {
+            "id": m.id,
+            "provider": m.provider,
+            "model": m.model,
+            "dimension": m.dimension,
+            "status": m.status,
+            "processed_chunks": m.processed_chunks,
+            "total_chunks": m.total_chunks,
+            "error_message": m.error_message,
+            "created_at": m.created_at,
+            "activated_at": m.activated_at
+        }
+        for m in migrations
+    ]
+
+
+@router.post("/embedding-migrations")
+async def start_embedding_migration(
+    data: EmbeddingMigrationRequest,
+    current_user: User = Depends(require_admin)
+):
+    """开始切换本组织的 embedding 模型（后台回填影子索引，切换前查询不受影响）"""
+    
+    from app.services.embedding_migration import embedding_migration_service
+    from app.tasks.index_tasks import reembed_organization_task
+    
+    try:
+        migration = await asyncio.to_thread(
+            embedding_migration_service.start,
+            current_user.org_id, data.provider, data.model, data.dimension
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    reembed_organization_task.delay(migration.id)
+    
+    return {"message": "影子索引回填任务已触发", "migration_id": migration.id, "total_chunks": migration.total_chunks}
+
+
+async def _get_org_migration(migration_id: int, org_id: int):
+    """获取本组织的切换记录"""
+    from app.services.embedding_migration import embedding_migration_service
+    
+    migrations = await asyncio.to_thread(embedding_migration_service.list_migrations, org_id)
+    migration = next((m for m in migrations if m.id == migration_id), None)
+    if migration is None:
+        raise HTTPException(status_code=404, detail="模型切换记录不存在")
+    return migration
+
+
+@router.post("/embedding-migrations/{migration_id}/resume")
+async def resume_embedding_migration(
+    migration_id: int,
+    current_user: User = Depends(require_admin)
+):
+    """从游标继续回填（worker 中断后使用）"""
+    
+    from app.tasks.index_tasks import reembed_organization_task
+    
+    migration = await _get_org_migration(migration_id, current_user.org_id)
+    if migration.status != "building":
+        raise HTTPException(status_code=400, detail=f"当前状态为 {migration.status}，无需继续回填")
+    
+    reembed_organization_task.delay(migration.id)
+    return {"message": "回填任务已触发", "migration_id": migration.id}
+
+
+@router.post("/embedding-migrations/{migration_id}/cutover")
+async def cutover_embedding_migration(
+    migration_id: int,
+    current_user: User = Depends(require_admin)
+):
+    """切换本组织的查询和新文档到新模型（回填完成后）"""
+    
+    from app.tasks.index_tasks import cutover_embedding_migration_task
+    
+    migration = await _get_org_migration(migration_id, current_user.org_id)
+    if migration.status != "ready":
+        raise HTTPException(status_code=400, detail=f"回填尚未完成（当前状态 {migration.status}）")
+    
+    cutover_embedding_migration_task.delay(migration.id)
+    return {"message": "切换任务已触发", "migration_id": migration.id}
+
+
+@router.post("/embedding-migrations/{migration_id}/cancel")
+async def cancel_embedding_migration(
+    migration_id: int,
+    current_user: User = Depends(require_admin)
+):
+    """取消未完成的模型切换"""
+    
+    from app.services.embedding_migration import embedding_migration_service
+    
+    await _get_org_migration(migration_id, current_user.org_id)
+    if not await asyncio.to_thread(embedding_migration_service.cancel, migration_id):
+        raise HTTPException(status_code=400, detail="只能取消未完成的模型切换")
+    return {"message": "模型切换已取消", "migration_id": migration_id}
@@ -12,6 +12,7 @@ from app.database.session import get_db
 from app.models.user import User
 from app.api.auth import get_current_active_user
 from app.config import settings
+from app.services.inference_executor import local_inference_executor
 
 router = APIRouter()
 
@@ -200,7 +201,8 @@ async def get_health_detail(
             "redis": "connected",
             "minio": "connected",
             "vector_db": "connected"
-        }
+        },
+        "local_inference": local_inference_executor.get_stats()
     }
 
 
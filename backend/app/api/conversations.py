@@ -16,6 +16,7 @@ from app.models.message import Message, MessageRole
 from app.api.auth import get_current_active_user
 from app.services.conversation_service import ConversationService
 from app.services.rag_service import RAGService
+from app.services.inference_executor import InferenceQueueFullError
 
 router = APIRouter()
 
@@ -40,6 +41,9 @@ class ConversationResponse(BaseModel):
 
 class MessageCreate(BaseModel):
     content: str
+    file_ids: Optional[List[int]] = None  # 只在这些文件中检索
+    tag_ids: Optional[List[int]] = None  # 只在带有这些标签的文件中检索
+    latest_only: bool = False  # 只检索最新版本的文件
 
 
 class SourceRef(BaseModel):
@@ -217,7 +221,10 @@ async def send_message(
         answer_data = await rag_service.generate_answer(
             question=data.content,
             conversation_id=conversation_id,
-            org_id=current_user.org_id
+            org_id=current_user.org_id,
+            file_ids=data.file_ids,
+            tag_ids=data.tag_ids,
+            latest_only=data.latest_only
         )
         
         # 保存助手回复
@@ -243,6 +250,9 @@ async def send_message(
             "confidence": answer_data.get("confidence")
         }
         
+    except InferenceQueueFullError as e:
+        await db.rollback()
+        raise HTTPException(status_code=503, detail=f"服务繁忙，请稍后重试: {str(e)}")
     except Exception as e:
         await db.rollback()
         raise HTTPException(status_code=500, detail=f"生成回答失败: {str(e)}")
@@ -8,6 +8,7 @@ from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from pydantic import BaseModel
+from typing import List, Optional
 import json
 from datetime import datetime
 
@@ -15,6 +16,7 @@ from app.database.session import get_db
 from app.models.user import User
 from app.models.conversation import Conversation
 from app.models.message import Message, MessageRole
+from app.services.inference_executor import InferenceQueueFullError
 from app.services.rag_service import RAGService
 from app.api.auth import get_current_active_user
 
@@ -26,6 +28,9 @@ router = APIRouter()
 class StreamQueryRequest(BaseModel):
     conversation_id: int
     question: str
+    file_ids: Optional[List[int]] = None  # 只在这些文件中检索
+    tag_ids: Optional[List[int]] = None  # 只在带有这些标签的文件中检索
+    latest_only: bool = False  # 只检索最新版本的文件
 
 
 # ========== API 端点 ==========
@@ -57,14 +62,46 @@ async def stream_chat(
         content=data.question
     )
     db.add(user_message)
+    await db.flush()
+    
+    rag_service = RAGService(db)
+    answer_stream = rag_service.stream_generate_answer(
+        question=data.question,
+        conversation_id=data.conversation_id,
+        org_id=current_user.org_id,
+        file_ids=data.file_ids,
+        tag_ids=data.tag_ids,
+        latest_only=data.latest_only
+    )
+    
+    # 响应开始前先取第一段答案（检索和推理排队都在此之前完成）：
+    # 推理队列已满时与普通接口一样返回 503，响应头发出后就只能以错误事件结束流
+    first_chunks = []
+    first_error = None
+    try:
+        first_chunks.append(await answer_stream.__anext__())
+    except StopAsyncIteration:
+        pass
+    except InferenceQueueFullError as e:
+        await db.rollback()
+        raise HTTPException(status_code=503, detail=f"服务繁忙，请稍后重试: {str(e)}")
+    except Exception as e:
+        first_error = e
+    
     await db.commit()
     await db.refresh(user_message)
     
+    async def answer_chunks():
+        for chunk in first_chunks:
+            yield chunk
+        if first_error is not None:
+            raise first_error
+        async for chunk in answer_stream:
+            yield chunk
+    
     # 流式生成器
     async def generate_sse_stream():
         """生成SSE事件流"""
-        rag_service = RAGService(db)
-        
         try:
             # 发送开始事件
             event_data = {
@@ -76,11 +113,7 @@ async def stream_chat(
             
             # 流式生成答案
             full_answer = ""
-            async for chunk in rag_service.stream_generate_answer(
-                question=data.question,
-                conversation_id=data.conversation_id,
-                org_id=current_user.org_id
-            ):
+            async for chunk in answer_chunks():
                 full_answer += chunk
                 
                 event_data = {
@@ -75,6 +75,38 @@ class Settings(BaseSettings):
     # ========== 向量数据库配置 ==========
     VECTOR_DB_TYPE: str = Field(default="faiss")  # faiss, milvus, chroma
     VECTOR_DB_PATH: str = Field(default="/app/data/faiss_index")
+    VECTOR_INDEX_RELOAD_INTERVAL: float = Field(default=2.0)  # 检查磁盘索引新版本的最小间隔（秒）
+    VECTOR_INDEX_BACKGROUND_RELOAD: bool = Field(default=True)  # 发现新快照时在后台加载，加载完成前继续使用旧索引
+    VECTOR_SNAPSHOT_RETAIN: int = Field(default=2)  # 保留的历史快照数量（供仍在读取旧快照的进程使用）
+    
+    # FAISS 索引类型: flat, ivf_flat, hnsw, ivf_pq, sq8, pq, ivf_sq8
+    VECTOR_INDEX_TYPE: str = Field(default="flat")
+    VECTOR_METRIC: str = Field(default="l2")  # 相似度度量: l2, cosine（写入和查询时归一化，使用内积索引）
+    VECTOR_INDEX_MIN_TRAIN_SIZE: int = Field(default=10000)  # IVF 索引开始训练所需的最少向量数
+    VECTOR_IVF_NLIST: int = Field(default=0)  # 0 表示按向量数量自动选择
+    VECTOR_IVF_NPROBE: int = Field(default=16)
+    VECTOR_HNSW_M: int = Field(default=32)
+    VECTOR_HNSW_EF_CONSTRUCTION: int = Field(default=200)
+    VECTOR_HNSW_EF_SEARCH: int = Field(default=64)
+    VECTOR_PQ_M: int = Field(default=64)  # 子空间数量，需整除向量维度
+    VECTOR_PQ_NBITS: int = Field(default=8)
+    VECTOR_RERANK_CANDIDATES: int = Field(default=200)  # 压缩索引召回后用原始向量精确重排的候选数，0 表示不重排
+    VECTOR_FILTER_EXACT_MAX: int = Field(default=20000)  # 过滤后候选向量不超过该值时直接用原始向量精确搜索
+    VECTOR_COMPACTION_THRESHOLD: float = Field(default=0.2)  # 已删除向量比例超过该值时压缩索引
+    VECTOR_WAL_CHECKPOINT_ROWS: int = Field(default=50000)  # 日志累计写入多少向量后合并为新快照
+    VECTOR_WAL_SEGMENT_BYTES: int = Field(default=64 * 1024 * 1024)  # 单个日志段的最大字节数
+    VECTOR_WAL_FSYNC: bool = Field(default=True)  # 每条日志记录写入后是否 fsync
+    VECTOR_INDEX_MMAP: bool = Field(default=False)  # 以只读内存映射加载索引快照（多个 API worker 共享页缓存），首次写入时转为普通加载
+    VECTOR_SINGLE_WRITER: bool = Field(default=False)  # 向量写入推入 Redis 队列，由单独的 index_writer 进程按顺序提交（开启前需先部署该进程）
+    VECTOR_WRITER_QUEUE: str = Field(default="index_writer")  # 写入任务所在的 Celery 队列（worker 需 --concurrency=1）
+    VECTOR_WRITE_BATCH_SIZE: int = Field(default=64)  # 写入进程每批合并提交的操作数
+    VECTOR_HIERARCHICAL_SEARCH: bool = Field(default=False)  # 两阶段检索：为每个文件维护文档级向量，先选候选文件再搜索其分块
+    VECTOR_HIERARCHICAL_TOP_FILES: int = Field(default=50)  # 第一阶段为每个查询选出的候选文件数
+    VECTOR_HIERARCHICAL_MIN_FILES: int = Field(default=500)  # 分区文件数不少于该值时才启用两阶段检索
+    VECTOR_NUM_SHARDS: int = Field(default=1)  # 每个分区按 file_id 拆分的分片数（修改后需重新写入向量）
+    VECTOR_SHARD_ADDRESSES: str = Field(default="")  # 分片服务地址 host:port，逗号分隔、按分片编号排列；为空时在本进程内并行搜索
+    VECTOR_SHARD_AUTHKEY: str = Field(default="")  # 分片服务连接认证密钥（无默认值，使用分片服务时必须配置）
+    VECTOR_SHARD_TIMEOUT: float = Field(default=10.0)  # 单个分片的响应超时（秒）
     
     # Milvus
     MILVUS_HOST: str = Field(default="localhost")
@@ -105,15 +137,49 @@ class Settings(BaseSettings):
     TONGYI_MODEL: str = Field(default="qwen-turbo")  # qwen-turbo, qwen-plus, qwen-max
     
     # ========== Embedding 配置 ==========
-    EMBEDDING_PROVIDER: str = Field(default="openai")
+    EMBEDDING_PROVIDER: str = Field(default="openai")  # openai, local (sentence-transformers), onnx (ONNX Runtime CPU 推理)
     EMBEDDING_MODEL: str = Field(default="text-embedding-3-small")
     EMBEDDING_DIMENSION: int = Field(default=1536)
-    EMBEDDING_BATCH_SIZE: int = Field(default=100)
+    EMBEDDING_BATCH_SIZE: int = Field(default=100)  # 每个请求的最大文本条数
+    EMBEDDING_BATCH_MAX_TOKENS: int = Field(default=50000)  # 每个请求的最大 token 总数
+    EMBEDDING_MAX_CONCURRENCY: int = Field(default=4)  # 同时进行的 embedding 请求数
+    EMBEDDING_MAX_RETRIES: int = Field(default=3)  # 单个批次失败后的重试次数
+    EMBEDDING_RETRY_BACKOFF: float = Field(default=1.0)  # 重试的初始等待时间（秒），之后每次翻倍
+    EMBEDDING_ONNX_QUANTIZE: bool = Field(default=True)  # onnx 后端使用 int8 动态量化模型
+    EMBEDDING_ONNX_CACHE_DIR: str = Field(default="/app/data/onnx_models")  # 导出的 ONNX 模型目录
+    EMBEDDING_ONNX_THREADS: int = Field(default=0)  # ONNX Runtime 推理线程数，0 表示使用全部核心
+    EMBEDDING_DEVICE: str = Field(default="")  # 本地模型运行设备（cpu / cuda），为空时自动选择
+    EMBEDDING_LOCAL_WORKERS: int = Field(default=1)  # 本地模型推理线程数（每个线程内部仍会使用多核）
+    EMBEDDING_LOCAL_QUEUE_SIZE: int = Field(default=64)  # 本地推理最多排队的请求数，超过时直接拒绝
+    EMBEDDING_MICRO_BATCH_ENABLED: bool = Field(default=True)  # 合并并发的查询向量请求为一次批量调用
+    EMBEDDING_MICRO_BATCH_WAIT_MS: float = Field(default=5.0)  # 收集查询请求的最长等待时间（毫秒）
+    EMBEDDING_MICRO_BATCH_MAX_SIZE: int = Field(default=32)  # 凑满该数量时立即发起批量调用
+    QUERY_EMBEDDING_CACHE_ENABLED: bool = Field(default=True)  # 缓存问题向量（进程内 LRU + Redis），重复问题不再计算
+    QUERY_EMBEDDING_CACHE_SIZE: int = Field(default=10000)  # 进程内 LRU 缓存的问题数
+    QUERY_EMBEDDING_CACHE_TTL: int = Field(default=7 * 24 * 3600)  # Redis 中问题向量的过期时间（秒）
+    EMBEDDING_WARMUP: bool = Field(default=True)  # API 和 Celery worker 进程启动时预加载本地 embedding 模型
+    EMBEDDING_CACHE_ENABLED: bool = Field(default=True)  # 按 (模型, 分块文本哈希) 缓存 embedding，内容未变的分块不再重复计算
+    EMBEDDING_REDUCTION: str = Field(default="none")  # 向量降维方式: none, truncate (Matryoshka 截断), pca (语料训练的 PCA 投影)
+    EMBEDDING_REDUCED_DIMENSION: int = Field(default=0)  # 降维后的维度，0 表示不降维（修改后需要重新 embedding 并重建索引）
+    EMBEDDING_PCA_PATH: str = Field(default="/app/data/embedding_pca.npz")  # PCA 投影文件（由 fit_embedding_pca 任务生成）
+    EMBEDDING_PCA_SAMPLE_SIZE: int = Field(default=50000)  # 训练 PCA 时从 embedding 缓存中采样的向量数
+    EMBEDDING_MIGRATION_BATCH_SIZE: int = Field(default=256)  # 切换 embedding 模型时每批回填的分块数
+    EMBEDDING_MIGRATION_BATCH_INTERVAL: float = Field(default=0.5)  # 回填批次之间的间隔（秒），限制对模型和索引的压力
+    EMBEDDING_MIGRATION_BATCHES_PER_TASK: int = Field(default=100)  # 每个回填任务处理的批数，之后重新入队让出 worker
+    EMBEDDING_ROUTE_CACHE_TTL: float = Field(default=10.0)  # 组织使用哪个 embedding 模型的进程内缓存时间（秒）
+    
+    @property
+    def VECTOR_DIMENSION(self) -> int:
+        """写入向量索引的维度（开启降维时为降维后的维度）"""
+        if self.EMBEDDING_REDUCTION != "none" and self.EMBEDDING_REDUCED_DIMENSION > 0:
+            return self.EMBEDDING_REDUCED_DIMENSION
+        return self.EMBEDDING_DIMENSION
     
     # ========== 检索配置 ==========
     RETRIEVAL_TOP_N: int = Field(default=20)
     RETRIEVAL_TOP_K: int = Field(default=5)
-    SIMILARITY_THRESHOLD: float = Field(default=0.75)
+    SIMILARITY_THRESHOLD: float = Field(default=0.75)  # 0~1 相似度阈值（cosine 度量下即余弦相似度），检索时直接过滤
+    ORG_SEARCH_PARAMS_CACHE_TTL: float = Field(default=10.0)  # 组织级检索参数（nprobe / ef_search）的进程内缓存时间（秒）
     USE_RERANKER: bool = Field(default=True)
     RERANKER_MODEL: str = Field(default="cross-encoder/ms-marco-MiniLM-L-6-v2")
     
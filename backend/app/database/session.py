@@ -62,6 +62,8 @@ async def init_db():
             conversation,
             message,
             audit_log,
+            embedding_cache,
+            embedding_migration,
         )
 
         # 创建所有表
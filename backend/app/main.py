@@ -7,11 +7,13 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import JSONResponse
 from contextlib import asynccontextmanager
+import asyncio
 import time
 
 from app.config import settings
 from app.api import router
 from app.database.session import init_db
+from app.services.embedding_service import warm_up_embedding_model
 
 
 @asynccontextmanager
@@ -27,6 +29,9 @@ async def lifespan(app: FastAPI):
     # 初始化数据库
     await init_db()
     
+    # 预加载本地 embedding 模型（在线程中执行，不阻塞事件循环）
+    await asyncio.to_thread(warm_up_embedding_model)
+    
     yield
     
     # 关闭时执行
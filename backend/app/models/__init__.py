@@ -11,6 +11,8 @@ from app.models.message import Message
 from app.models.audit_log import AuditLog
 from app.models.feedback import MessageFeedback, FeedbackStats
 from app.models.prompt_template import PromptTemplate, PromptTemplateUsageLog
+from app.models.embedding_cache import EmbeddingCacheEntry
+from app.models.embedding_migration import EmbeddingMigration, EmbeddingMigrationStatus
 
 __all__ = [
     "User",
@@ -24,5 +26,8 @@ __all__ = [
     "FeedbackStats",
     "PromptTemplate",
     "PromptTemplateUsageLog",
+    "EmbeddingCacheEntry",
+    "EmbeddingMigration",
+    "EmbeddingMigrationStatus",
 ]
 
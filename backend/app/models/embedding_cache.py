@@ -0,0 +1,24 @@
+"""
+Embedding 缓存模型
+按 (模型, 文本哈希) 保存已计算的向量，内容相同的分块不再重复调用 embedding 模型
+"""
+
+from sqlalchemy import Column, Integer, String, LargeBinary, DateTime
+from sqlalchemy.sql import func
+from app.database.session import Base
+
+
+class EmbeddingCacheEntry(Base):
+    """Embedding 缓存表"""
+    __tablename__ = "embedding_cache"
+    
+    model = Column(String(200), primary_key=True)  # 提供商:模型名:维度
+    text_hash = Column(String(64), primary_key=True)  # 分块文本的 sha256，与 chunks.text_hash 一致
+    
+    dimension = Column(Integer, nullable=False)
+    embedding = Column(LargeBinary, nullable=False)  # float32 原始字节
+    
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    def __repr__(self):
+        return f"<EmbeddingCacheEntry {self.model} {self.text_hash[:12]}>"
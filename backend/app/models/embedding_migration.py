@@ -0,0 +1,51 @@
+"""
+Embedding 模型切换（影子索引）模型
+记录每个组织切换 embedding 模型的进度：后台回填影子索引，按组织切换查询
+"""
+
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy.sql import func
+import enum
+from app.database.session import Base
+
+
+class EmbeddingMigrationStatus(str, enum.Enum):
+    """切换状态"""
+    BUILDING = "building"    # 正在回填影子索引，查询仍使用旧索引
+    READY = "ready"          # 回填已追上，等待切换
+    ACTIVE = "active"        # 已切换，查询和新文档使用该模型和索引
+    RETIRED = "retired"      # 已被更新的切换取代
+    CANCELLED = "cancelled"  # 已取消
+
+
+class EmbeddingMigration(Base):
+    """Embedding 模型切换表"""
+    __tablename__ = "embedding_migrations"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    org_id = Column(Integer, ForeignKey("organizations.id"), nullable=False, index=True)
+    
+    # 目标模型
+    provider = Column(String(50), nullable=False)
+    model = Column(String(200), nullable=False)
+    dimension = Column(Integer, nullable=False)  # 模型输出维度
+    
+    # 进度（回填按 chunks.id 递增处理，中断后从游标继续）
+    status = Column(String(20), nullable=False, default=EmbeddingMigrationStatus.BUILDING.value, index=True)
+    last_chunk_id = Column(Integer, nullable=False, default=0)
+    processed_chunks = Column(Integer, nullable=False, default=0)
+    total_chunks = Column(Integer, nullable=False, default=0)
+    error_message = Column(Text)
+    
+    # 时间戳
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    activated_at = Column(DateTime(timezone=True))
+    
+    @property
+    def namespace(self) -> str:
+        """影子索引的命名空间（索引分区名后缀）"""
+        return f"emb{self.id}"
+    
+    def __repr__(self):
+        return f"<EmbeddingMigration {self.id} org={self.org_id} {self.model} {self.status}>"
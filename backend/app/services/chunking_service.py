@@ -3,11 +3,39 @@
 将长文档切分成适合向量化的小块
 """
 
-from typing import List
+from bisect import bisect_left
+from functools import lru_cache
+from typing import List, Tuple
+import re
+import numpy as np
 import tiktoken
 from app.config import settings
 
 
+# 句末标点（中英文）
+SENTENCE_END = re.compile(r'[。！？\.!?]')
+
+
+@lru_cache(maxsize=None)
+def _token_char_tables(encoding) -> Tuple[np.ndarray, np.ndarray]:
+    """词表中每个 token 的字符信息（每个进程每种编码只计算一次）
+    
+    Returns:
+        (token 中字符起始字节的个数, token 首字节是否为多字节字符的后续字节)
+    """
+    char_starts = np.zeros(encoding.n_vocab, dtype=np.int64)
+    continues = np.zeros(encoding.n_vocab, dtype=np.int64)
+    for token in range(encoding.n_vocab):
+        try:
+            data = encoding.decode_single_token_bytes(token)
+        except KeyError:
+            continue
+        # UTF-8 中非 10xxxxxx 的字节是一个字符的开始
+        char_starts[token] = sum(1 for byte in data if byte & 0xC0 != 0x80)
+        continues[token] = int(bool(data) and data[0] & 0xC0 == 0x80)
+    return char_starts, continues
+
+
 class ChunkingService:
     """文档切片服务"""
     
@@ -20,79 +48,86 @@ class ChunkingService:
         """计算文本的 token 数量"""
         return len(self.encoding.encode(text))
     
+    def _encode_with_offsets(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        """对整篇文本只编码一次，返回 token 数组和每个 token 起始处的字符偏移
+        
+        偏移数组比 token 多一项（文本总长度），第 i 个 token 覆盖 text[offsets[i]:offsets[i + 1]]；
+        多字节字符被拆到多个 token 时，后续 token 的偏移记为该字符的起始位置
+        """
+        # 文档中出现的特殊 token 文本按普通文本处理
+        encoded = self.encoding.encode_ordinary(text)
+        tokens = np.fromiter(encoded, dtype=np.int64, count=len(encoded))
+        if not len(tokens):
+            return tokens, np.zeros(1, dtype=np.int64)
+        
+        char_starts, continues = _token_char_tables(self.encoding)
+        token_chars = char_starts[tokens]
+        chars_before = np.cumsum(token_chars) - token_chars
+        return tokens, np.append(chars_before - continues[tokens], len(text))
+    
+    def _make_chunk(
+        self,
+        text: str,
+        offsets: np.ndarray,
+        token_start: int,
+        token_end: int,
+        metadata: dict = None
+    ) -> dict:
+        """按 token 区间生成切片（文本直接取原文的字符区间）"""
+        start_offset, end_offset = int(offsets[token_start]), int(offsets[token_end])
+        return {
+            "text": text[start_offset:end_offset],
+            "token_count": token_end - token_start,
+            "start_offset": start_offset,
+            "end_offset": end_offset,
+            "token_start": token_start,
+            "token_end": token_end,
+            "metadata": metadata or {}
+        }
+    
     def chunk_by_tokens(self, text: str, metadata: dict = None) -> List[dict]:
-        """按 token 数量切分文本"""
-        chunks = []
-        tokens = self.encoding.encode(text)
+        """按 token 数量切分文本（start_offset / end_offset 为字符偏移）"""
+        tokens, offsets = self._encode_with_offsets(text)
+        step = max(self.chunk_size - self.chunk_overlap, 1)
         
-        start = 0
-        while start < len(tokens):
-            end = start + self.chunk_size
-            chunk_tokens = tokens[start:end]
-            chunk_text = self.encoding.decode(chunk_tokens)
-            
-            chunks.append({
-                "text": chunk_text,
-                "token_count": len(chunk_tokens),
-                "start_offset": start,
-                "end_offset": end,
-                "metadata": metadata or {}
-            })
-            
-            # 移动到下一个块，考虑重叠
-            start = end - self.chunk_overlap
+        chunks = []
+        for start in range(0, len(tokens), step):
+            end = min(start + self.chunk_size, len(tokens))
+            chunks.append(self._make_chunk(text, offsets, start, end, metadata))
+            if end == len(tokens):
+                break
         
         return chunks
     
     def chunk_by_sentences(self, text: str, metadata: dict = None) -> List[dict]:
-        """按句子切分文本（保持语义完整性）"""
-        import re
+        """按句子切分文本（保持语义完整性）
         
-        # 简单的句子分割（支持中英文）
-        sentences = re.split(r'([。！？\.!?])', text)
-        sentences = [''.join(i) for i in zip(sentences[0::2], sentences[1::2])]
+        整篇文本只编码一次：句子边界换算为 token 下标后，切片和重叠都按下标计算，
+        不再逐句、逐次重叠重复编码。句末标点后的剩余文本作为最后一句保留。
+        """
+        tokens, offsets = self._encode_with_offsets(text)
+        if not len(tokens):
+            return []
         
-        chunks = []
-        current_chunk = []
-        current_tokens = 0
+        # 句子边界：句末标点之后的字符位置，换算为第一个起始位置不小于它的 token
+        char_bounds = [m.end() for m in SENTENCE_END.finditer(text)]
+        token_bounds = np.searchsorted(offsets[:-1], char_bounds, side="left")
+        bounds = np.unique(np.concatenate([[0], token_bounds, [len(tokens)]])).tolist()
         
-        for sentence in sentences:
-            sentence_tokens = self.count_tokens(sentence)
+        chunks = []
+        first = 0  # 当前块的第一句
+        for i in range(len(bounds) - 1):
+            sentence_tokens = bounds[i + 1] - bounds[i]
             
-            if current_tokens + sentence_tokens > self.chunk_size and current_chunk:
+            if i > first and bounds[i] - bounds[first] + sentence_tokens > self.chunk_size:
                 # 当前块已满，保存并开始新块
-                chunk_text = ''.join(current_chunk)
-                chunks.append({
-                    "text": chunk_text,
-                    "token_count": current_tokens,
-                    "metadata": metadata or {}
-                })
+                chunks.append(self._make_chunk(text, offsets, bounds[first], bounds[i], metadata))
                 
-                # 保留重叠部分
-                overlap_sentences = []
-                overlap_tokens = 0
-                for s in reversed(current_chunk):
-                    s_tokens = self.count_tokens(s)
-                    if overlap_tokens + s_tokens <= self.chunk_overlap:
-                        overlap_sentences.insert(0, s)
-                        overlap_tokens += s_tokens
-                    else:
-                        break
-                
-                current_chunk = overlap_sentences
-                current_tokens = overlap_tokens
-            
-            current_chunk.append(sentence)
-            current_tokens += sentence_tokens
+                # 保留重叠部分：末尾总长不超过 chunk_overlap 的连续句子（至少前进一句）
+                first = bisect_left(bounds, bounds[i] - self.chunk_overlap, first + 1, i)
         
         # 添加最后一个块
-        if current_chunk:
-            chunk_text = ''.join(current_chunk)
-            chunks.append({
-                "text": chunk_text,
-                "token_count": current_tokens,
-                "metadata": metadata or {}
-            })
+        chunks.append(self._make_chunk(text, offsets, bounds[first], bounds[-1], metadata))
         
         return chunks
     
@@ -0,0 +1,127 @@
+"""
+向量降维
+把模型输出的向量降到 EMBEDDING_REDUCED_DIMENSION 维后再写入索引和查询缓存：
+- truncate：保留前 k 维后重新归一化（适用于 Matryoshka 训练的模型，如 text-embedding-3 系列）
+- pca：用语料向量训练的 PCA 投影
+"""
+
+import hashlib
+import os
+import threading
+from typing import Optional, Tuple
+
+import numpy as np
+
+from app.config import settings
+
+
+REDUCTION_METHODS = ("none", "truncate", "pca")
+
+
+class DimensionReducer:
+    """向量降维器"""
+
+    def __init__(
+        self,
+        method: str = "none",
+        dimension: int = 0,
+        mean: Optional[np.ndarray] = None,
+        components: Optional[np.ndarray] = None
+    ):
+        if method not in REDUCTION_METHODS:
+            raise ValueError(f"不支持的降维方式: {method}")
+        self.method = method
+        self.dimension = dimension
+        self.mean = mean
+        self.components = components  # (dimension, 原始维度)
+
+    @property
+    def enabled(self) -> bool:
+        return self.method != "none" and self.dimension > 0
+
+    @property
+    def signature(self) -> str:
+        """降维配置的标识（写入查询缓存键，投影变化时旧缓存自然失效）"""
+        if not self.enabled:
+            return "full"
+        if self.method == "truncate":
+            return f"truncate{self.dimension}"
+        fingerprint = hashlib.sha1(self.components.tobytes()).hexdigest()[:8]
+        return f"pca{self.dimension}-{fingerprint}"
+
+    def transform(self, vectors) -> np.ndarray:
+        """降维（输入为 (n, d) 向量，返回 float32）"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not self.enabled:
+            return vectors
+        if self.method == "truncate":
+            reduced = vectors[:, :self.dimension]
+            norms = np.linalg.norm(reduced, axis=1, keepdims=True)
+            return reduced / np.clip(norms, 1e-12, None)
+        return ((vectors - self.mean) @ self.components.T).astype(np.float32)
+
+    @classmethod
+    def fit_pca(cls, vectors: np.ndarray, dimension: int) -> Tuple["DimensionReducer", float]:
+        """用语料向量训练 PCA 投影，返回降维器和保留的方差比例"""
+        vectors = np.asarray(vectors, dtype=np.float64)
+        if dimension >= vectors.shape[1]:
+            raise ValueError(f"降维后的维度 {dimension} 必须小于原始维度 {vectors.shape[1]}")
+
+        mean = vectors.mean(axis=0)
+        centered = vectors - mean
+        covariance = centered.T @ centered / max(len(vectors) - 1, 1)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+
+        # eigh 按特征值升序返回
+        top = np.argsort(eigenvalues)[::-1][:dimension]
+        explained = float(eigenvalues[top].sum() / max(eigenvalues.sum(), 1e-12))
+        reducer = cls(
+            "pca",
+            dimension,
+            mean.astype(np.float32),
+            eigenvectors[:, top].T.astype(np.float32)
+        )
+        return reducer, explained
+
+    def save(self, path: str):
+        """原子保存 PCA 投影"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, mean=self.mean, components=self.components)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load_pca(cls, path: str) -> "DimensionReducer":
+        with np.load(path) as data:
+            components = data["components"]
+            return cls("pca", components.shape[0], data["mean"], components)
+
+
+_reducer_lock = threading.Lock()
+_reducer_cache = {}
+
+
+def get_dimension_reducer() -> DimensionReducer:
+    """按当前配置获取降维器（PCA 投影文件更新后自动重新加载）"""
+    method = settings.EMBEDDING_REDUCTION
+    dimension = settings.EMBEDDING_REDUCED_DIMENSION
+    if method == "none" or dimension <= 0:
+        return DimensionReducer()
+    if method == "truncate":
+        return DimensionReducer("truncate", dimension)
+
+    path = settings.EMBEDDING_PCA_PATH
+    if not os.path.exists(path):
+        raise RuntimeError(f"PCA 投影文件不存在: {path}，请先运行 fit_embedding_pca 任务")
+
+    key = (path, os.path.getmtime(path))
+    with _reducer_lock:
+        if key not in _reducer_cache:
+            reducer = DimensionReducer.load_pca(path)
+            if reducer.dimension != dimension:
+                raise RuntimeError(
+                    f"PCA 投影维度 {reducer.dimension} 与 EMBEDDING_REDUCED_DIMENSION={dimension} 不一致"
+                )
+            _reducer_cache.clear()
+            _reducer_cache[key] = reducer
+        return _reducer_cache[key]
@@ -0,0 +1,104 @@
+"""
+Embedding 缓存服务
+按 (模型, 文本哈希) 查询和保存已计算的向量，调用 embedding 模型前先查缓存
+"""
+
+from typing import Dict, Iterable, List
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app.models.embedding_cache import EmbeddingCacheEntry
+
+
+# 支持 INSERT ... ON CONFLICT DO NOTHING 的数据库
+_INSERT_DIALECTS = {"postgresql": postgresql, "sqlite": sqlite}
+
+
+class EmbeddingCache:
+    """数据库中的 embedding 缓存
+    
+    使用独立的会话读写，缓存失败不影响调用方的事务，也不会中断 embedding 流程；
+    数据库不支持冲突忽略写入（非 PostgreSQL / SQLite）时跳过写入，只读取已有缓存
+    """
+    
+    QUERY_BATCH_SIZE = 500  # 单次 IN 查询的哈希数量
+    
+    def __init__(self, session_factory=None):
+        self._session_factory = session_factory
+    
+    @property
+    def session_factory(self):
+        if self._session_factory is None:
+            from app.database.session import SessionLocal
+            self._session_factory = SessionLocal
+        return self._session_factory
+    
+    def get_many(self, model: str, text_hashes: Iterable[str]) -> Dict[str, List[float]]:
+        """批量查询缓存，返回命中的 {text_hash: embedding}"""
+        text_hashes = list(dict.fromkeys(text_hashes))
+        found = {}
+        db = self.session_factory()
+        try:
+            for i in range(0, len(text_hashes), self.QUERY_BATCH_SIZE):
+                rows = db.query(EmbeddingCacheEntry.text_hash, EmbeddingCacheEntry.embedding).filter(
+                    EmbeddingCacheEntry.model == model,
+                    EmbeddingCacheEntry.text_hash.in_(text_hashes[i:i + self.QUERY_BATCH_SIZE])
+                ).all()
+                for text_hash, embedding in rows:
+                    found[text_hash] = np.frombuffer(embedding, dtype=np.float32).tolist()
+        except Exception as e:
+            print(f"读取 embedding 缓存失败: {e}")
+        finally:
+            db.close()
+        return found
+    
+    def put_many(self, model: str, embeddings: Dict[str, List[float]]):
+        """批量写入缓存（已存在的记录保持不变）"""
+        if not embeddings:
+            return
+        
+        rows = []
+        for text_hash, embedding in embeddings.items():
+            vector = np.asarray(embedding, dtype=np.float32)
+            rows.append({
+                "model": model,
+                "text_hash": text_hash,
+                "dimension": len(vector),
+                "embedding": vector.tobytes()
+            })
+        
+        db = self.session_factory()
+        try:
+            dialect_name = db.get_bind().dialect.name
+            dialect = _INSERT_DIALECTS.get(dialect_name)
+            if dialect is None:
+                print(f"警告: embedding 缓存不支持写入 {dialect_name} 数据库，跳过缓存写入")
+                return
+            try:
+                # 多个 worker 可能同时写入相同内容，冲突时忽略
+                db.execute(dialect.insert(EmbeddingCacheEntry).values(rows).on_conflict_do_nothing())
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                print(f"写入 embedding 缓存失败: {e}")
+        finally:
+            db.close()
+
+    def sample(self, model: str, limit: int) -> np.ndarray:
+        """随机采样该模型的缓存向量（用于训练降维投影），返回 (n, 维度) 矩阵"""
+        db = self.session_factory()
+        try:
+            rows = db.query(EmbeddingCacheEntry.embedding).filter(
+                EmbeddingCacheEntry.model == model
+            ).order_by(func.random()).limit(limit).all()
+        finally:
+            db.close()
+        if not rows:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.vstack([np.frombuffer(embedding, dtype=np.float32) for (embedding,) in rows])
+
+
+# 全局 embedding 缓存实例
+embedding_cache = EmbeddingCache()
@@ -0,0 +1,379 @@
+"""
+Embedding 模型切换服务
+用新模型在后台回填每个组织的影子索引（分批限速，按 chunks.id 游标断点续跑），
+回填追上后按组织切换：切换前查询和新文档继续使用旧模型和旧索引，切换后改用新模型和影子索引
+"""
+
+import asyncio
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from app.config import settings
+from app.models.chunk import Chunk
+from app.models.embedding_migration import EmbeddingMigration, EmbeddingMigrationStatus
+from app.models.file import File
+from app.services.dimension_reducer import get_dimension_reducer
+from app.services.embedding_service import EmbeddingService
+from app.services.vector_service import VectorService
+
+
+class EmbeddingRouter:
+    """按组织选择 embedding 模型和索引命名空间
+
+    组织没有已切换的模型时使用当前配置的模型和原索引；路由在进程内缓存 EMBEDDING_ROUTE_CACHE_TTL 秒
+    """
+
+    def __init__(self, session_factory=None):
+        self._session_factory = session_factory
+        self._routes: Dict[int, Tuple[float, Optional[Dict]]] = {}
+        self._services: Dict[Tuple, EmbeddingService] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def session_factory(self):
+        if self._session_factory is None:
+            from app.database.session import SessionLocal
+            self._session_factory = SessionLocal
+        return self._session_factory
+
+    def _cached_route(self, org_id: int) -> Tuple[bool, Optional[Dict]]:
+        """缓存中未过期的路由，返回 (是否命中, 路由)"""
+        cached = self._routes.get(org_id)
+        if cached is not None and time.monotonic() - cached[0] < settings.EMBEDDING_ROUTE_CACHE_TTL:
+            return True, cached[1]
+        return False, None
+
+    def _query_route(self, org_id: int) -> Optional[Dict]:
+        """从数据库读取组织的路由并写入缓存（同步查询）"""
+        now = time.monotonic()
+        cached = self._routes.get(org_id)
+        db = self.session_factory()
+        try:
+            migration = db.query(EmbeddingMigration).filter(
+                EmbeddingMigration.org_id == org_id,
+                EmbeddingMigration.status == EmbeddingMigrationStatus.ACTIVE.value
+            ).order_by(EmbeddingMigration.id.desc()).first()
+            route = None if migration is None else {
+                "provider": migration.provider,
+                "model": migration.model,
+                "dimension": migration.dimension,
+                "namespace": migration.namespace
+            }
+        except Exception as e:
+            # 数据库暂时不可用时沿用上次的路由
+            print(f"读取 embedding 路由失败: {e}")
+            route = cached[1] if cached is not None else None
+        finally:
+            db.close()
+
+        self._routes[org_id] = (now, route)
+        return route
+
+    def route(self, org_id: Optional[int]) -> Optional[Dict]:
+        """组织当前使用的模型（provider / model / dimension / namespace），未切换过时返回 None"""
+        if org_id is None:
+            return None
+        hit, route = self._cached_route(org_id)
+        if hit:
+            return route
+        return self._query_route(org_id)
+
+    async def aroute(self, org_id: Optional[int]) -> Optional[Dict]:
+        """route 的异步版本：缓存过期时在线程中查询数据库，不阻塞事件循环"""
+        if org_id is None:
+            return None
+        hit, route = self._cached_route(org_id)
+        if hit:
+            return route
+        return await asyncio.to_thread(self._query_route, org_id)
+
+    def _for_route(self, route: Optional[Dict]) -> Tuple[EmbeddingService, str]:
+        if route is None:
+            return self.service(), ""
+        return self.service(route["provider"], route["model"], route["dimension"]), route["namespace"]
+
+    def resolve(self, org_id: Optional[int]) -> Tuple[EmbeddingService, str]:
+        """组织应使用的 embedding 服务和索引命名空间"""
+        return self._for_route(self.route(org_id))
+
+    async def aresolve(self, org_id: Optional[int]) -> Tuple[EmbeddingService, str]:
+        """resolve 的异步版本（请求处理中使用）"""
+        return self._for_route(await self.aroute(org_id))
+
+    def service(self, provider: str = None, model: str = None, dimension: int = None) -> EmbeddingService:
+        """按模型复用 EmbeddingService 实例"""
+        key = (provider, model, dimension)
+        with self._lock:
+            if key not in self._services:
+                self._services[key] = EmbeddingService(provider, model, dimension)
+            return self._services[key]
+
+    def invalidate(self, org_id: Optional[int] = None):
+        """清除路由缓存（切换后立即在本进程生效，其他进程在缓存过期后生效）"""
+        if org_id is None:
+            self._routes.clear()
+        else:
+            self._routes.pop(org_id, None)
+
+
+class EmbeddingMigrationService:
+    """Embedding 模型切换
+
+    流程：start 创建切换记录 -> run_batches 回填影子索引（可多次调用，从游标继续）
+    -> cutover 补齐遗漏的分块后切换 -> 路由缓存过期后再 reconcile 一次，补上切换瞬间仍写入旧索引的分块
+    """
+
+    # 未完成的切换（同一组织同时只允许一个）
+    PENDING_STATUSES = (EmbeddingMigrationStatus.BUILDING.value, EmbeddingMigrationStatus.READY.value)
+
+    def __init__(self, session_factory=None, router: Optional[EmbeddingRouter] = None):
+        self._session_factory = session_factory
+        self.router = router or embedding_router
+
+    @property
+    def session_factory(self):
+        if self._session_factory is None:
+            from app.database.session import SessionLocal
+            self._session_factory = SessionLocal
+        return self._session_factory
+
+    @staticmethod
+    def _chunks_query(db, org_id: int):
+        """组织中已写入索引的分块（未完成或失败的文件不参与回填）"""
+        return db.query(
+            Chunk.id, Chunk.chunk_id, Chunk.text, Chunk.text_hash, Chunk.page_number, Chunk.heading,
+            File.id, File.original_filename
+        ).join(File, Chunk.file_id == File.id).filter(
+            File.org_id == org_id,
+            Chunk.is_embedded == 1
+        )
+
+    def _validate_model(self, provider: str, model: str, dimension: int):
+        """用一段探测文本调用目标模型，确认模型可用且输出维度与声明一致"""
+        if settings.EMBEDDING_REDUCTION == "pca":
+            # PCA 投影由当前模型的向量训练，用在其他模型的输出上没有意义
+            raise ValueError("开启 PCA 降维时不支持切换 embedding 模型，请先关闭降维或改用 truncate")
+
+        service = self.router.service(provider, model, dimension)
+        if (service.provider, service.model) != (provider, model):
+            raise ValueError(f"embedding 模型 {provider}:{model} 不可用（已回退为 {service.provider}:{service.model}）")
+
+        try:
+            probe = asyncio.run(service._embed_uncached(["embedding 模型切换探测"]))
+        except Exception as e:
+            raise ValueError(f"调用 embedding 模型 {provider}:{model} 失败: {e}")
+        if len(probe[0]) != dimension:
+            raise ValueError(f"embedding 模型 {provider}:{model} 输出 {len(probe[0])} 维，与声明的 {dimension} 维不一致")
+        reducer = get_dimension_reducer()
+        if reducer.enabled and reducer.dimension > dimension:
+            raise ValueError(f"模型输出 {dimension} 维，小于截断后的维度 {reducer.dimension}")
+
+    def start(self, org_id: int, provider: str, model: str, dimension: int) -> EmbeddingMigration:
+        """校验目标模型并创建切换记录（回填由 reembed_organization 任务执行）"""
+        if settings.VECTOR_DB_TYPE != "faiss":
+            raise ValueError(f"{settings.VECTOR_DB_TYPE} 不支持影子索引")
+        self._validate_model(provider, model, dimension)
+
+        db = self.session_factory()
+        try:
+            pending = db.query(EmbeddingMigration).filter(
+                EmbeddingMigration.org_id == org_id,
+                EmbeddingMigration.status.in_(self.PENDING_STATUSES)
+            ).first()
+            if pending is not None:
+                raise ValueError(f"组织 {org_id} 已有未完成的模型切换: {pending.id}")
+
+            migration = EmbeddingMigration(
+                org_id=org_id,
+                provider=provider,
+                model=model,
+                dimension=dimension,
+                status=EmbeddingMigrationStatus.BUILDING.value,
+                last_chunk_id=0,
+                processed_chunks=0,
+                total_chunks=self._chunks_query(db, org_id).count()
+            )
+            db.add(migration)
+            db.commit()
+            db.refresh(migration)
+            db.expunge(migration)
+            return migration
+        finally:
+            db.close()
+
+    def _write(self, migration: EmbeddingMigration, rows) -> int:
+        """用目标模型为分块生成向量并写入影子索引（已存在的 chunk_id 跳过）"""
+        if not rows:
+            return 0
+
+        service = self.router.service(migration.provider, migration.model, migration.dimension)
+        embeddings = asyncio.run(service.embed_batch(
+            [row[2] for row in rows], [row[3] for row in rows]
+        ))
+        metadata = [
+            {
+                "file_id": file_id,
+                "org_id": migration.org_id,
+                "file_name": file_name,
+                "page": page,
+                "heading": heading
+            }
+            for _, _, _, _, page, heading, file_id, file_name in rows
+        ]
+        # 直接提交而不经过写入队列：reconcile 要检查自己的写入结果，切换前影子索引必须已经完整
+        asyncio.run(VectorService().add_vectors(
+            [row[1] for row in rows], embeddings, metadata,
+            namespace=migration.namespace,
+            skip_existing=True,
+            direct=True
+        ))
+        return len(rows)
+
+    def run_batches(self, migration_id: int, max_batches: Optional[int] = None) -> Dict:
+        """回填影子索引
+
+        每批 EMBEDDING_MIGRATION_BATCH_SIZE 个分块，批次之间间隔 EMBEDDING_MIGRATION_BATCH_INTERVAL 秒；
+        每批完成后提交游标，中断后再次调用从游标继续
+        """
+        max_batches = max_batches or settings.EMBEDDING_MIGRATION_BATCHES_PER_TASK
+        db = self.session_factory()
+        try:
+            for batch in range(max_batches):
+                migration = db.get(EmbeddingMigration, migration_id)
+                if migration is None or migration.status != EmbeddingMigrationStatus.BUILDING.value:
+                    break
+
+                rows = self._chunks_query(db, migration.org_id).filter(
+                    Chunk.id > migration.last_chunk_id
+                ).order_by(Chunk.id).limit(settings.EMBEDDING_MIGRATION_BATCH_SIZE).all()
+
+                if not rows:
+                    migration.status = EmbeddingMigrationStatus.READY.value
+                    db.commit()
+                    print(f"组织 {migration.org_id} 影子索引回填完成，共 {migration.processed_chunks} 个分块")
+                    break
+
+                try:
+                    self._write(migration, rows)
+                except Exception as e:
+                    migration.error_message = str(e)
+                    db.commit()
+                    raise
+
+                migration.last_chunk_id = rows[-1][0]
+                migration.processed_chunks += len(rows)
+                migration.error_message = None
+                db.commit()
+
+                if batch < max_batches - 1 and settings.EMBEDDING_MIGRATION_BATCH_INTERVAL > 0:
+                    time.sleep(settings.EMBEDDING_MIGRATION_BATCH_INTERVAL)
+
+            migration = db.get(EmbeddingMigration, migration_id)
+            if migration is None:
+                return {"status": "not_found"}
+            return {
+                "status": migration.status,
+                "processed": migration.processed_chunks,
+                "total": migration.total_chunks
+            }
+        finally:
+            db.close()
+
+    def reconcile(self, migration_id: int) -> int:
+        """补齐影子索引中缺失的分块（游标之前提交较晚的分块、切换瞬间写入旧索引的分块），返回补写数量"""
+        vector_service = VectorService()
+        db = self.session_factory()
+        try:
+            migration = db.get(EmbeddingMigration, migration_id)
+            if migration is None:
+                return 0
+            db.expunge(migration)
+
+            written, last_id = 0, 0
+            while True:
+                rows = self._chunks_query(db, migration.org_id).filter(
+                    Chunk.id > last_id
+                ).order_by(Chunk.id).limit(settings.EMBEDDING_MIGRATION_BATCH_SIZE).all()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+
+                missing = set(vector_service.missing_chunk_ids(
+                    [row[1] for row in rows], migration.org_id, migration.namespace
+                ))
+                written += self._write(migration, [row for row in rows if row[1] in missing])
+
+            if written:
+                print(f"组织 {migration.org_id} 影子索引补写 {written} 个分块")
+            return written
+        finally:
+            db.close()
+
+    def cutover(self, migration_id: int) -> EmbeddingMigration:
+        """切换组织的查询和新文档到新模型（回填需已追上）"""
+        db = self.session_factory()
+        try:
+            migration = db.get(EmbeddingMigration, migration_id)
+            if migration is None:
+                raise ValueError(f"模型切换不存在: {migration_id}")
+            if migration.status != EmbeddingMigrationStatus.READY.value:
+                raise ValueError(f"模型切换 {migration_id} 的回填尚未完成（当前状态 {migration.status}）")
+
+            self.reconcile(migration_id)
+
+            db.query(EmbeddingMigration).filter(
+                EmbeddingMigration.org_id == migration.org_id,
+                EmbeddingMigration.status == EmbeddingMigrationStatus.ACTIVE.value
+            ).update({"status": EmbeddingMigrationStatus.RETIRED.value}, synchronize_session=False)
+            migration.status = EmbeddingMigrationStatus.ACTIVE.value
+            migration.activated_at = datetime.utcnow()
+            db.commit()
+            db.refresh(migration)
+            db.expunge(migration)
+        finally:
+            db.close()
+
+        self.router.invalidate(migration.org_id)
+        try:
+            from app.services.cache_service import cache_service
+            cache_service.invalidate_vector_cache(migration.org_id)
+            cache_service.invalidate_query_cache(migration.org_id)
+        except Exception as e:
+            print(f"清除组织 {migration.org_id} 的检索缓存失败: {e}")
+
+        print(f"组织 {migration.org_id} 已切换到 embedding 模型 {migration.provider}:{migration.model}")
+        return migration
+
+    def cancel(self, migration_id: int) -> bool:
+        """取消未完成的切换（影子索引保留在磁盘上，可手动删除）"""
+        db = self.session_factory()
+        try:
+            updated = db.query(EmbeddingMigration).filter(
+                EmbeddingMigration.id == migration_id,
+                EmbeddingMigration.status.in_(self.PENDING_STATUSES)
+            ).update({"status": EmbeddingMigrationStatus.CANCELLED.value}, synchronize_session=False)
+            db.commit()
+            return bool(updated)
+        finally:
+            db.close()
+
+    def list_migrations(self, org_id: int) -> List[EmbeddingMigration]:
+        """组织的切换记录（新的在前）"""
+        db = self.session_factory()
+        try:
+            migrations = db.query(EmbeddingMigration).filter(
+                EmbeddingMigration.org_id == org_id
+            ).order_by(EmbeddingMigration.id.desc()).all()
+            db.expunge_all()
+            return migrations
+        finally:
+            db.close()
+
+
+# 全局 embedding 路由实例
+embedding_router = EmbeddingRouter()
+
+# 全局 embedding 模型切换服务实例
+embedding_migration_service = EmbeddingMigrationService()
@@ -3,18 +3,114 @@ Embedding 服务
 将文本转换为向量
 """
 
-from typing import List
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+import asyncio
+import random
+import weakref
 import openai
+import tiktoken
 from app.config import settings
+from app.services.dimension_reducer import get_dimension_reducer
+from app.services.embedding_cache import embedding_cache
+from app.services.inference_executor import local_inference_executor
+from app.services.model_registry import model_registry
+from app.services.query_embedding_cache import query_embedding_cache
+
+
+# 可重试的 OpenAI 错误：限流、超时、连接失败和服务端错误（同时兼容 0.x / 1.x SDK 的异常类）
+RETRYABLE_OPENAI_ERRORS = tuple(
+    getattr(module, name)
+    for module in (openai, getattr(openai, "error", None)) if module is not None
+    for name in (
+        "RateLimitError", "APITimeoutError", "APIConnectionError", "InternalServerError",
+        "Timeout", "ServiceUnavailableError", "TryAgain"
+    )
+    if isinstance(getattr(module, name, None), type) and issubclass(getattr(module, name), Exception)
+) + (asyncio.TimeoutError, ConnectionError)
+
+
+def is_retryable_openai_error(error: Exception) -> bool:
+    """只有暂时性错误值得重试；参数错误、认证失败、接口不兼容等永久错误立即失败"""
+    if isinstance(error, RETRYABLE_OPENAI_ERRORS):
+        return True
+    status = getattr(error, "status_code", None) or getattr(error, "http_status", None)
+    return isinstance(status, int) and (status in (408, 409, 429) or status >= 500)
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """与切片服务相同的 tokenizer（进程内只加载一次）"""
+    return tiktoken.get_encoding("cl100k_base")
+
+
+class QueryEmbeddingBatcher:
+    """查询向量微批处理器
+    
+    并发的单条查询先收集 EMBEDDING_MICRO_BATCH_WAIT_MS 毫秒（或凑满 EMBEDDING_MICRO_BATCH_MAX_SIZE 条），
+    合并为一次批量推理 / API 调用后把结果分发给各调用方。每个事件循环一个实例。
+    """
+    
+    def __init__(self, embed_fn: Callable[[List[str]], Awaitable[List[List[float]]]]):
+        self.embed_fn = embed_fn
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # 进行中的批量任务（事件循环只保留弱引用，需持有引用防止任务被回收）
+        self._tasks: Set[asyncio.Task] = set()
+    
+    async def embed(self, text: str) -> List[float]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        
+        if len(self._pending) >= settings.EMBEDDING_MICRO_BATCH_MAX_SIZE:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(settings.EMBEDDING_MICRO_BATCH_WAIT_MS / 1000, self._flush)
+        
+        return await future
+    
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+    
+    async def _run(self, batch: List[Tuple[str, asyncio.Future]]):
+        # 相同的问题只计算一次
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            embeddings = dict(zip(texts, await self.embed_fn(texts)))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for text, future in batch:
+            # 调用方可能已取消等待
+            if not future.done():
+                future.set_result(embeddings[text])
+
+
+# 每个事件循环、每个模型各一个微批处理器（Celery 任务中每次 asyncio.run 都是新的事件循环）
+_query_batchers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, QueryEmbeddingBatcher]]" = (
+    weakref.WeakKeyDictionary()
+)
 
 
 class EmbeddingService:
     """Embedding 服务"""
     
-    def __init__(self):
-        self.provider = settings.EMBEDDING_PROVIDER
-        self.model = settings.EMBEDDING_MODEL
-        self.dimension = settings.EMBEDDING_DIMENSION
+    def __init__(self, provider: Optional[str] = None, model: Optional[str] = None, dimension: Optional[int] = None):
+        """默认使用当前配置的模型；切换模型时的影子索引回填和已切换组织的查询显式指定模型"""
+        self.provider = provider or settings.EMBEDDING_PROVIDER
+        self.model = model or settings.EMBEDDING_MODEL
+        self.dimension = dimension or settings.EMBEDDING_DIMENSION
         self.batch_size = settings.EMBEDDING_BATCH_SIZE
 
         # 如果配置为 openai 但未提供 API Key，则自动回退到本地模型
@@ -29,49 +125,196 @@ class EmbeddingService:
             openai.api_base = settings.OPENAI_API_BASE
     
     async def embed_text(self, text: str) -> List[float]:
-        """将单个文本转换为向量"""
-        embeddings = await self.embed_batch([text])
-        return embeddings[0]
+        """将单个文本转换为向量
+        
+        先查查询向量缓存；未命中时计算（开启微批处理则与同一时刻的其他查询合并为一次批量调用）并写回缓存。
+        返回的向量与写入索引的向量经过同样的降维
+        """
+        use_cache = settings.QUERY_EMBEDDING_CACHE_ENABLED
+        if use_cache:
+            cache_model = self.query_cache_model
+            cached = query_embedding_cache.get(cache_model, text)
+            if cached is not None:
+                return cached
+        
+        if settings.EMBEDDING_MICRO_BATCH_ENABLED:
+            embedding = self._reduce([await self._query_batcher().embed(text)])[0]
+        else:
+            embedding = (await self.embed_batch([text]))[0]
+        
+        if use_cache:
+            query_embedding_cache.set(cache_model, text, embedding)
+        return embedding
+    
+    def _query_batcher(self) -> QueryEmbeddingBatcher:
+        """当前事件循环中该模型的微批处理器"""
+        batchers = _query_batchers.setdefault(asyncio.get_running_loop(), {})
+        key = f"{self.provider}:{self.model}"
+        if key not in batchers:
+            batchers[key] = QueryEmbeddingBatcher(self._embed_uncached)
+        return batchers[key]
+    
+    @property
+    def cache_model(self) -> str:
+        """embedding 缓存中区分模型的键（模型、量化方式或维度变化时缓存自然失效）"""
+        provider = self.provider
+        if provider == "onnx" and settings.EMBEDDING_ONNX_QUANTIZE:
+            provider = "onnx-int8"
+        return f"{provider}:{self.model}:{self.dimension}"
+    
+    @property
+    def query_cache_model(self) -> str:
+        """查询向量缓存中区分模型的键（缓存的是降维后的向量，降维配置也是键的一部分）"""
+        return f"{self.cache_model}:{get_dimension_reducer().signature}"
     
-    async def embed_batch(self, texts: List[str]) -> List[List[float]]:
-        """批量将文本转换为向量"""
+    def _reduce(self, embeddings: List[List[float]]) -> List[List[float]]:
+        """按 EMBEDDING_REDUCTION 降维（未开启时原样返回）"""
+        reducer = get_dimension_reducer()
+        if not reducer.enabled or not embeddings:
+            return embeddings
+        return reducer.transform(embeddings).tolist()
+    
+    async def embed_batch(
+        self,
+        texts: List[str],
+        text_hashes: Optional[List[str]] = None
+    ) -> List[List[float]]:
+        """批量将文本转换为向量
+        
+        Args:
+            texts: 文本列表
+            text_hashes: 与 texts 一一对应的 sha256（即 Chunk.text_hash），
+                传入时先查 embedding 缓存，只为未命中的文本调用模型
+        
+        embedding 缓存保存模型输出的完整向量，降维在最后一步进行，
+        因此调整降维配置后重新 embedding 不需要再次调用模型
+        """
+        
+        if text_hashes is not None and settings.EMBEDDING_CACHE_ENABLED:
+            embeddings = await self._embed_cached(texts, text_hashes)
+        else:
+            embeddings = await self._embed_uncached(texts)
+        return self._reduce(embeddings)
+    
+    async def _embed_cached(self, texts: List[str], text_hashes: List[str]) -> List[List[float]]:
+        """先查缓存，未命中的文本（同一批内相同内容只计算一次）调用模型后写回缓存"""
+        embeddings = embedding_cache.get_many(self.cache_model, text_hashes)
+        
+        missing = {}
+        for text, text_hash in zip(texts, text_hashes):
+            if text_hash not in embeddings:
+                missing.setdefault(text_hash, text)
+        
+        if missing:
+            computed = dict(zip(missing, await self._embed_uncached(list(missing.values()))))
+            embedding_cache.put_many(self.cache_model, computed)
+            embeddings.update(computed)
+        
+        return [embeddings[text_hash] for text_hash in text_hashes]
+    
+    async def _embed_uncached(self, texts: List[str]) -> List[List[float]]:
+        """调用 embedding 模型"""
         
         if self.provider == "openai":
             return await self._embed_openai(texts)
-        if self.provider == "local":
+        if self.provider in ("local", "onnx"):
             return await self._embed_local(texts)
         raise ValueError(f"不支持的 embedding 提供商: {self.provider}")
     
+    def count_tokens(self, text: str) -> int:
+        """计算文本的 token 数量"""
+        return len(_get_encoding().encode(text))
+    
+    def _pack_batches(self, texts: List[str]) -> List[List[str]]:
+        """按 token 预算打包批次（保持原有顺序）
+        
+        每批 token 总数不超过 EMBEDDING_BATCH_MAX_TOKENS，条数不超过 EMBEDDING_BATCH_SIZE；
+        单条超过预算的文本单独成批
+        """
+        batches, batch, batch_tokens = [], [], 0
+        for text in texts:
+            tokens = self.count_tokens(text)
+            if batch and (
+                batch_tokens + tokens > settings.EMBEDDING_BATCH_MAX_TOKENS
+                or len(batch) >= self.batch_size
+            ):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+    
     async def _embed_openai(self, texts: List[str]) -> List[List[float]]:
-        """使用 OpenAI API 生成 embeddings"""
+        """使用 OpenAI API 生成 embeddings
         
-        all_embeddings = []
+        按 token 预算分批，最多 EMBEDDING_MAX_CONCURRENCY 个请求并发执行
+        """
         
-        # 分批处理
-        for i in range(0, len(texts), self.batch_size):
-            batch = texts[i:i + self.batch_size]
-            
+        semaphore = asyncio.Semaphore(settings.EMBEDDING_MAX_CONCURRENCY)
+        
+        async def run(batch: List[str]) -> List[List[float]]:
+            async with semaphore:
+                return await self._embed_openai_batch(batch)
+        
+        results = await asyncio.gather(*(run(batch) for batch in self._pack_batches(texts)))
+        return [embedding for batch_embeddings in results for embedding in batch_embeddings]
+    
+    async def _embed_openai_batch(self, batch: List[str]) -> List[List[float]]:
+        """请求一个批次，暂时性错误按指数退避重试（只重试该批次），其他错误直接抛出"""
+        
+        for attempt in range(settings.EMBEDDING_MAX_RETRIES + 1):
             try:
                 response = await openai.Embedding.acreate(
                     model=self.model,
                     input=batch
                 )
                 
-                batch_embeddings = [item["embedding"] for item in response["data"]]
-                all_embeddings.extend(batch_embeddings)
+                data = sorted(response["data"], key=lambda item: item["index"])
+                return [item["embedding"] for item in data]
                 
             except Exception as e:
-                print(f"OpenAI Embedding 错误: {e}")
-                raise
-        
-        return all_embeddings
+                if attempt == settings.EMBEDDING_MAX_RETRIES or not is_retryable_openai_error(e):
+                    print(f"OpenAI Embedding 错误: {e}")
+                    raise
+                
+                delay = settings.EMBEDDING_RETRY_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5)
+                print(f"OpenAI Embedding 批次失败（第 {attempt + 1} 次），{delay:.1f}s 后重试: {e}")
+                await asyncio.sleep(delay)
     
     async def _embed_local(self, texts: List[str]) -> List[List[float]]:
-        """使用本地模型生成 embeddings（备用方案）"""
-        from sentence_transformers import SentenceTransformer
+        """使用本地模型生成 embeddings（备用方案）
         
-        model = SentenceTransformer(self.model)
+        推理在有界线程池中执行，不阻塞事件循环
+        """
+        return await local_inference_executor.run(self._encode_local, texts)
+    
+    def _encode_local(self, texts: List[str]) -> List[List[float]]:
+        """同步推理（模型由进程级注册表加载一次后复用）
+        
+        provider 为 onnx 时使用 ONNX Runtime（默认 int8 量化）代替 PyTorch
+        """
+        if self.provider == "onnx":
+            model = model_registry.onnx_model(self.model)
+        else:
+            model = model_registry.sentence_transformer(self.model)
         embeddings = model.encode(texts, convert_to_numpy=True)
         
         return embeddings.tolist()
 
+
+def warm_up_embedding_model():
+    """预加载本地 embedding 模型并执行一次推理（进程启动时调用，避免首个请求承担加载耗时）"""
+    if not settings.EMBEDDING_WARMUP:
+        return
+    
+    service = EmbeddingService()
+    if service.provider not in ("local", "onnx"):
+        return
+    
+    try:
+        service._encode_local(["warm up"])
+    except Exception as e:
+        print(f"本地 embedding 模型预热失败: {e}")
+
@@ -107,7 +107,7 @@ class FileService:
         # 从向量数据库删除
         from app.services.vector_service import VectorService
         vector_service = VectorService()
-        await vector_service.delete_file_vectors(file.id)
+        await vector_service.delete_file_vectors(file.id, org_id=file.org_id)
         
         # 从数据库删除
         await self.db.delete(file)
@@ -0,0 +1,115 @@
+"""
+本地推理执行器
+把同步的模型推理放到有界线程池中执行，避免阻塞事件循环，并记录排队和执行耗时
+"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from app.config import settings
+
+
+class InferenceQueueFullError(RuntimeError):
+    """推理队列已满（调用方可返回 503 让客户端稍后重试）"""
+
+
+class InferenceExecutor:
+    """有界推理线程池
+
+    - 同时执行的任务数为 max_workers（PyTorch 推理时释放 GIL，本身也会使用多线程）
+    - 等待中的任务超过 max_queue 时直接拒绝，避免请求无限堆积
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.pending = 0  # 排队中 + 执行中
+        self.running = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.total_run = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix=self.name
+                )
+            return self._executor
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """在线程池中执行 fn 并等待结果（不阻塞事件循环）"""
+        with self._lock:
+            if self.pending >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise InferenceQueueFullError(f"{self.name} 推理队列已满（{self.pending} 个任务）")
+            self.pending += 1
+            self.submitted += 1
+
+        enqueued_at = time.perf_counter()
+
+        def task():
+            started_at = time.perf_counter()
+            with self._lock:
+                self.running += 1
+                wait = started_at - enqueued_at
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.total_run += time.perf_counter() - started_at
+
+        try:
+            result = await asyncio.wrap_future(self.executor.submit(task))
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+        with self._lock:
+            self.completed += 1
+        return result
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取执行器统计信息"""
+        with self._lock:
+            started = self.completed + self.failed
+            return {
+                "name": self.name,
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "running": self.running,
+                "queued": self.pending - self.running,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "avg_wait_ms": round(self.total_wait / started * 1000, 2) if started else 0.0,
+                "max_wait_ms": round(self.max_wait * 1000, 2),
+                "avg_run_ms": round(self.total_run / started * 1000, 2) if started else 0.0,
+            }
+
+
+# 本地 embedding 推理执行器
+local_inference_executor = InferenceExecutor(
+    "local-embedding",
+    max_workers=settings.EMBEDDING_LOCAL_WORKERS,
+    max_queue=settings.EMBEDDING_LOCAL_QUEUE_SIZE,
+)
@@ -0,0 +1,65 @@
+"""
+本地模型注册表
+每个进程内每个模型只加载一次，之后所有请求共享同一份权重
+"""
+
+import threading
+import time
+from typing import Any, Callable, Dict
+
+from app.config import settings
+
+
+class ModelRegistry:
+    """进程级模型注册表（线程安全，按名称懒加载）"""
+
+    def __init__(self):
+        self._models: Dict[str, Any] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str, loader: Callable[[], Any]) -> Any:
+        """获取模型，首次访问时调用 loader 加载（同一模型并发访问时只加载一次）"""
+        model = self._models.get(key)
+        if model is not None:
+            return model
+
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._models:
+                start = time.time()
+                self._models[key] = loader()
+                print(f"模型 {key} 加载完成，耗时 {time.time() - start:.2f}s")
+            return self._models[key]
+
+    def sentence_transformer(self, model_name: str):
+        """获取 sentence-transformers 模型"""
+        def load():
+            from sentence_transformers import SentenceTransformer
+            return SentenceTransformer(model_name, device=settings.EMBEDDING_DEVICE or None)
+
+        return self.get(f"sentence_transformer:{model_name}", load)
+
+    def onnx_model(self, model_name: str):
+        """获取 ONNX Runtime 推理的 embedding 模型（首次使用时导出）"""
+        def load():
+            from app.services.onnx_embedding import OnnxEmbeddingModel
+            return OnnxEmbeddingModel(model_name)
+
+        quantized = "int8" if settings.EMBEDDING_ONNX_QUANTIZE else "fp32"
+        return self.get(f"onnx:{quantized}:{model_name}", load)
+
+    def loaded(self) -> list:
+        """已加载的模型"""
+        return list(self._models)
+
+    def clear(self):
+        """释放所有模型（测试时使用）"""
+        with self._lock:
+            self._models.clear()
+            self._locks.clear()
+
+
+# 全局模型注册表实例
+model_registry = ModelRegistry()
@@ -0,0 +1,169 @@
+"""
+ONNX Runtime embedding 模型
+把 sentence-transformers 模型导出为 ONNX（可选 int8 动态量化），在无 GPU 的节点上替代 PyTorch 推理
+"""
+
+import inspect
+import json
+import os
+import re
+import shutil
+import tempfile
+from typing import List
+
+import numpy as np
+
+from app.config import settings
+
+
+POOLING_MODES = ("mean", "cls", "max")
+
+
+class OnnxEmbeddingModel:
+    """ONNX Runtime 推理的 sentence-transformers 模型
+
+    首次使用时导出到 EMBEDDING_ONNX_CACHE_DIR 下，之后直接加载导出结果；
+    encode 与 SentenceTransformer.encode 的常用参数兼容
+    """
+
+    MODEL_FILE = "model.onnx"
+    QUANTIZED_MODEL_FILE = "model.int8.onnx"
+    CONFIG_FILE = "embedding_config.json"
+
+    def __init__(self, model_name: str, cache_dir: str = None, quantize: bool = None):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.model_name = model_name
+        self.quantize = settings.EMBEDDING_ONNX_QUANTIZE if quantize is None else quantize
+        cache_dir = cache_dir or settings.EMBEDDING_ONNX_CACHE_DIR
+        self.export_dir = os.path.join(cache_dir, re.sub(r"[^\w.-]+", "_", model_name).strip("_"))
+
+        if not os.path.exists(os.path.join(self.export_dir, self.CONFIG_FILE)):
+            self.export(model_name, self.export_dir)
+
+        with open(os.path.join(self.export_dir, self.CONFIG_FILE), "r") as f:
+            self.config = json.load(f)
+        self.tokenizer = AutoTokenizer.from_pretrained(self.export_dir)
+
+        model_file = self.QUANTIZED_MODEL_FILE if self.quantize else self.MODEL_FILE
+        options = ort.SessionOptions()
+        if settings.EMBEDDING_ONNX_THREADS > 0:
+            options.intra_op_num_threads = settings.EMBEDDING_ONNX_THREADS
+        self.session = ort.InferenceSession(
+            os.path.join(self.export_dir, model_file),
+            sess_options=options,
+            providers=["CPUExecutionProvider"]
+        )
+
+    @classmethod
+    def export(cls, model_name: str, export_dir: str):
+        """导出 ONNX 模型（fp32 与 int8 动态量化两个版本）、tokenizer 和池化配置
+
+        先写到临时目录，完整导出后再重命名，多个进程同时导出时不会读到半成品
+        """
+        import torch
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        from sentence_transformers import SentenceTransformer
+        from sentence_transformers.models import Normalize, Pooling
+
+        model = SentenceTransformer(model_name, device="cpu")
+        transformer = model[0]
+        pooling = next(m for m in model if isinstance(m, Pooling))
+        pooling_mode = pooling.get_pooling_mode_str()
+        if pooling_mode not in POOLING_MODES:
+            raise ValueError(f"ONNX 后端不支持的池化方式: {pooling_mode}")
+
+        auto_model = transformer.auto_model.eval()
+        tokenizer = transformer.tokenizer
+        dummy = tokenizer(["warm up export"], return_tensors="pt")
+        accepted = inspect.signature(auto_model.forward).parameters
+        input_names = [name for name in dummy.keys() if name in accepted]
+
+        class HiddenStates(torch.nn.Module):
+            """只输出最后一层隐状态，池化在 numpy 中完成"""
+
+            def __init__(self, inner):
+                super().__init__()
+                self.inner = inner
+
+            def forward(self, *inputs):
+                return self.inner(**dict(zip(input_names, inputs))).last_hidden_state
+
+        os.makedirs(os.path.dirname(os.path.abspath(export_dir)), exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(export_dir)))
+        try:
+            model_path = os.path.join(tmp_dir, cls.MODEL_FILE)
+            dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+            dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+            # 较新的 torch 默认使用 dynamo 导出，这里固定使用 TorchScript 导出；旧版本没有该参数
+            export_options = {}
+            if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+                export_options["dynamo"] = False
+            with torch.no_grad():
+                torch.onnx.export(
+                    HiddenStates(auto_model),
+                    tuple(dummy[name] for name in input_names),
+                    model_path,
+                    input_names=input_names,
+                    output_names=["last_hidden_state"],
+                    dynamic_axes=dynamic_axes,
+                    opset_version=14,
+                    **export_options
+                )
+            quantize_dynamic(
+                model_path,
+                os.path.join(tmp_dir, cls.QUANTIZED_MODEL_FILE),
+                weight_type=QuantType.QInt8
+            )
+
+            tokenizer.save_pretrained(tmp_dir)
+            with open(os.path.join(tmp_dir, cls.CONFIG_FILE), "w") as f:
+                json.dump({
+                    "model_name": model_name,
+                    "input_names": input_names,
+                    "pooling": pooling_mode,
+                    "normalize": any(isinstance(m, Normalize) for m in model),
+                    "max_seq_length": model.max_seq_length,
+                    "dimension": model.get_sentence_embedding_dimension()
+                }, f, ensure_ascii=False)
+
+            try:
+                os.rename(tmp_dir, export_dir)
+            except OSError:
+                # 其他进程已完成导出
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+    def _pool(self, hidden: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+        mode = self.config["pooling"]
+        if mode == "cls":
+            return hidden[:, 0]
+        mask = attention_mask[:, :, None].astype(hidden.dtype)
+        if mode == "max":
+            return np.where(mask > 0, hidden, -1e9).max(axis=1)
+        return (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+    def encode(self, texts: List[str], batch_size: int = 32, convert_to_numpy: bool = True, **kwargs) -> np.ndarray:
+        """批量推理（按长度排序分批以减少 padding，输出顺序与输入一致）"""
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+        embeddings = np.zeros((len(texts), self.config["dimension"]), dtype=np.float32)
+
+        for start in range(0, len(texts), batch_size):
+            rows = order[start:start + batch_size]
+            encoded = self.tokenizer(
+                [texts[i] for i in rows],
+                padding=True,
+                truncation=True,
+                max_length=self.config["max_seq_length"],
+                return_tensors="np"
+            )
+            feeds = {name: encoded[name].astype(np.int64) for name in self.config["input_names"]}
+            hidden = self.session.run(None, feeds)[0]
+            embeddings[rows] = self._pool(hidden, encoded["attention_mask"])
+
+        if self.config["normalize"]:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings
@@ -0,0 +1,101 @@
+"""
+查询向量缓存
+按 (模型, 规范化后的问题) 缓存问题的向量：进程内 LRU 为第一级，Redis（float16 字节）为第二级
+"""
+
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+import redis
+
+from app.config import settings
+
+
+class QueryEmbeddingCache:
+    """两级查询向量缓存
+
+    Redis 不可用时只使用进程内缓存，不影响问答流程
+    """
+
+    KEY_PREFIX = "query_embedding"
+
+    def __init__(self):
+        self._lru: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis_client = None
+
+    @property
+    def redis_client(self) -> redis.Redis:
+        # 向量以二进制保存，不做字符串解码
+        if self._redis_client is None:
+            self._redis_client = redis.Redis(
+                host=settings.REDIS_HOST,
+                port=settings.REDIS_PORT,
+                password=settings.REDIS_PASSWORD,
+                db=settings.REDIS_DB,
+                decode_responses=False
+            )
+        return self._redis_client
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """规范化问题：全角转半角、合并空白、英文小写"""
+        text = unicodedata.normalize("NFKC", text)
+        return " ".join(text.split()).lower()
+
+    def _key(self, model: str, text: str) -> str:
+        digest = hashlib.sha256(self.normalize(text).encode("utf-8")).hexdigest()
+        return f"{self.KEY_PREFIX}:{model}:{digest}"
+
+    def _remember(self, key: str, vector: np.ndarray):
+        with self._lock:
+            self._lru[key] = vector
+            self._lru.move_to_end(key)
+            while len(self._lru) > settings.QUERY_EMBEDDING_CACHE_SIZE:
+                self._lru.popitem(last=False)
+
+    def get(self, model: str, text: str) -> Optional[List[float]]:
+        """查询缓存，进程内未命中时查 Redis 并回填"""
+        key = self._key(model, text)
+
+        with self._lock:
+            vector = self._lru.get(key)
+            if vector is not None:
+                self._lru.move_to_end(key)
+
+        if vector is None:
+            try:
+                data = self.redis_client.get(key)
+            except Exception as e:
+                print(f"读取查询向量缓存失败: {e}")
+                return None
+            if data is None:
+                return None
+            vector = np.frombuffer(data, dtype=np.float16)
+            self._remember(key, vector)
+
+        return vector.astype(np.float32).tolist()
+
+    def set(self, model: str, text: str, embedding: List[float]):
+        """写入两级缓存（float16 保存，余弦相似度误差可忽略）"""
+        key = self._key(model, text)
+        vector = np.asarray(embedding, dtype=np.float16)
+        self._remember(key, vector)
+
+        try:
+            self.redis_client.setex(key, settings.QUERY_EMBEDDING_CACHE_TTL, vector.tobytes())
+        except Exception as e:
+            print(f"写入查询向量缓存失败: {e}")
+
+    def clear_local(self):
+        """清空进程内缓存"""
+        with self._lock:
+            self._lru.clear()
+
+
+# 全局查询向量缓存实例
+query_embedding_cache = QueryEmbeddingCache()
@@ -3,28 +3,34 @@ RAG (Retrieval Augmented Generation) 服务
 检索增强生成服务，整合检索和 LLM
 """
 
-from typing import List, Dict, Optional, AsyncGenerator
+from typing import List, Dict, Optional, AsyncGenerator, Tuple
+import time
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 import openai
 
 from app.models.chunk import Chunk
 from app.models.file import File
+from app.models.document_tag import document_tags
 from app.models.message import Message
+from app.models.organization import Organization
 from app.services.vector_service import VectorService
-from app.services.embedding_service import EmbeddingService
+from app.services.embedding_migration import embedding_router
 from app.services.security_service import SecurityService
 from app.services.model_orchestrator import model_orchestrator, TaskType
 from app.config import settings
 
 
+# 组织级检索参数的进程内缓存：org_id -> (读取时间, 参数)
+_search_params_cache: Dict[int, Tuple[float, Optional[Dict]]] = {}
+
+
 class RAGService:
     """RAG 服务"""
     
     def __init__(self, db: AsyncSession):
         self.db = db
         self.vector_service = VectorService()
-        self.embedding_service = EmbeddingService()
         self.security_service = SecurityService(db)
         
         # 配置 OpenAI
@@ -35,17 +41,31 @@ class RAGService:
         self,
         question: str,
         conversation_id: int,
-        org_id: int
+        org_id: int,
+        file_ids: Optional[List[int]] = None,
+        tag_ids: Optional[List[int]] = None,
+        latest_only: bool = False
     ) -> Dict:
-        """生成答案（完整 RAG 流程）"""
+        """生成答案（完整 RAG 流程）
+        
+        Args:
+            file_ids: 只在这些文件中检索
+            tag_ids: 只在带有这些标签的文件中检索
+            latest_only: 只检索最新版本的文件
+        """
         
-        # 1. 生成问题的 embedding
-        query_embedding = await self.embedding_service.embed_text(question)
+        # 1. 生成问题的 embedding（使用组织当前的 embedding 模型）
+        embedding_service, namespace = await embedding_router.aresolve(org_id)
+        query_embedding = await embedding_service.embed_text(question)
         
         # 2. 向量检索 Top-N
         search_results = await self.vector_service.search(
             query_embedding=query_embedding,
-            top_k=settings.RETRIEVAL_TOP_N
+            top_k=settings.RETRIEVAL_TOP_N,
+            filters=await self._build_search_filters(org_id, file_ids, tag_ids, latest_only),
+            search_params=await self._get_search_params(org_id),
+            min_similarity=settings.SIMILARITY_THRESHOLD,
+            namespace=namespace
         )
         
         if not search_results:
@@ -178,6 +198,52 @@ class RAGService:
             }
         }
     
+    async def _build_search_filters(
+        self,
+        org_id: int,
+        file_ids: Optional[List[int]] = None,
+        tag_ids: Optional[List[int]] = None,
+        latest_only: bool = False
+    ) -> Dict:
+        """构建向量检索过滤条件
+        
+        文件、标签、版本限制在数据库中解析为允许的文件 ID 列表，
+        由向量服务在索引扫描时过滤，而不是检索后再筛选
+        """
+        filters = {"org_id": org_id}
+        if file_ids is None and not tag_ids and not latest_only:
+            return filters
+        
+        query = select(File.id).where(File.org_id == org_id)
+        if file_ids is not None:
+            query = query.where(File.id.in_(file_ids))
+        if tag_ids:
+            query = query.where(File.id.in_(
+                select(document_tags.c.document_id).where(document_tags.c.tag_id.in_(tag_ids))
+            ))
+        if latest_only:
+            query = query.where(File.is_latest_version == 1)
+        
+        result = await self.db.execute(query)
+        filters["file_ids"] = [row[0] for row in result.all()]
+        return filters
+    
+    async def _get_search_params(self, org_id: int) -> Optional[Dict]:
+        """获取组织级向量检索参数
+        
+        在 Organization.settings["vector_search"] 中配置，例如 {"nprobe": 32, "ef_search": 128}；
+        进程内缓存 ORG_SEARCH_PARAMS_CACHE_TTL 秒，避免每次查询都读取组织记录
+        """
+        now = time.monotonic()
+        cached = _search_params_cache.get(org_id)
+        if cached is not None and now - cached[0] < settings.ORG_SEARCH_PARAMS_CACHE_TTL:
+            return cached[1]
+        
+        org = await self.db.get(Organization, org_id)
+        params = org.settings.get("vector_search") if org and org.settings else None
+        _search_params_cache[org_id] = (now, params)
+        return params
+    
     def _get_confidence_level(self, confidence: float) -> str:
         """获取置信度等级"""
         if confidence >= 0.9:
@@ -267,18 +333,28 @@ class RAGService:
         self,
         question: str,
         conversation_id: int,
-        org_id: int
+        org_id: int,
+        file_ids: Optional[List[int]] = None,
+        tag_ids: Optional[List[int]] = None,
+        latest_only: bool = False
     ) -> AsyncGenerator[str, None]:
         """流式生成答案（实时输出）
         
+        检索范围参数与 generate_answer 相同
+        
         Yields:
             每个文本块
         """
         # 1-6步与普通生成相同（检索和准备）
-        query_embedding = await self.embedding_service.embed_text(question)
+        embedding_service, namespace = await embedding_router.aresolve(org_id)
+        query_embedding = await embedding_service.embed_text(question)
         search_results = await self.vector_service.search(
             query_embedding=query_embedding,
-            top_k=settings.RETRIEVAL_TOP_N
+            top_k=settings.RETRIEVAL_TOP_N,
+            filters=await self._build_search_filters(org_id, file_ids, tag_ids, latest_only),
+            search_params=await self._get_search_params(org_id),
+            min_similarity=settings.SIMILARITY_THRESHOLD,
+            namespace=namespace
         )
         
         if not search_results:
@@ -0,0 +1,98 @@
+"""
+原始向量存储
+按索引行号顺序追加保存 float32 向量，通过内存映射读取，
+用于压缩索引（SQ8 / PQ）召回后的精确重排以及索引重建
+"""
+
+import os
+from typing import Optional
+
+import numpy as np
+
+
+class RawVectorStore:
+    """原始 float32 向量文件（第 i 行对应索引第 i 个向量）
+
+    文件只追加；需要整体重写（压缩、归一化）时写入新文件，
+    仍在使用旧快照的进程继续读取旧文件
+    """
+
+    FILE_NAME = "vectors.f32"
+
+    def __init__(self, path: str, dimension: int, file_name: Optional[str] = None):
+        self.file_name = file_name or self.FILE_NAME
+        self.file_path = os.path.join(path, self.file_name)
+        self.dimension = dimension
+        self._mmap: Optional[np.memmap] = None
+
+    def _row_bytes(self) -> int:
+        return self.dimension * 4
+
+    def __len__(self) -> int:
+        try:
+            return os.path.getsize(self.file_path) // self._row_bytes()
+        except FileNotFoundError:
+            return 0
+
+    def _mapped(self) -> np.ndarray:
+        """获取内存映射（文件增长后重新映射）"""
+        n = len(self)
+        if n == 0:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        if self._mmap is None or self._mmap.shape[0] != n:
+            self._mmap = np.memmap(self.file_path, dtype=np.float32, mode="r", shape=(n, self.dimension))
+        return self._mmap
+
+    def append(self, vectors: np.ndarray, fsync: bool = False):
+        """追加向量
+
+        Args:
+            fsync: 返回前落盘（引用这些行的日志记录落盘之前必须先落盘原始向量）
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with open(self.file_path, "ab") as f:
+            f.write(vectors.tobytes())
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        self._mmap = None
+
+    def discard_partial_row(self):
+        """截掉末尾不完整的行（追加过程中断电或进程崩溃留下的半行），否则之后追加的行全部错位
+
+        只能在持有索引写锁时调用，避免截掉其他进程正在追加的数据
+        """
+        try:
+            size = os.path.getsize(self.file_path)
+        except FileNotFoundError:
+            return
+        if size % self._row_bytes():
+            with open(self.file_path, "r+b") as f:
+                f.truncate(size - size % self._row_bytes())
+                os.fsync(f.fileno())
+            self._mmap = None
+
+    def truncate(self, n: int):
+        """截断到前 n 行（丢弃未成功写入索引的向量）"""
+        if len(self) > n:
+            with open(self.file_path, "r+b") as f:
+                f.truncate(n * self._row_bytes())
+            self._mmap = None
+
+    def rewrite(self, vectors: np.ndarray):
+        """整体重写向量文件（原地替换，仅用于新文件）"""
+        tmp_path = self.file_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.file_path)
+        self._mmap = None
+
+    def get(self, rows: np.ndarray) -> np.ndarray:
+        """按行号读取向量"""
+        return np.asarray(self._mapped()[rows])
+
+    def all(self) -> np.ndarray:
+        """读取全部向量（内存映射，不会一次性载入内存）"""
+        return self._mapped()
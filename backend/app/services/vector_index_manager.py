@@ -0,0 +1,852 @@
+"""
+向量索引管理器
+进程级共享 FAISS 索引，每个索引只从磁盘加载一次；
+增量写入记录到预写日志，定期合并为新的快照
+"""
+
+import fcntl
+import json
+import os
+import pickle
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import numpy as np
+import faiss
+
+from app.config import settings
+from app.services.raw_vector_store import RawVectorStore
+from app.services.vector_wal import VectorWAL, WALCursor
+from app.services.vector_metadata_store import ColumnarMetadataStore
+
+
+# 支持的索引类型
+INDEX_TYPES = ("flat", "ivf_flat", "hnsw", "ivf_pq", "sq8", "pq", "ivf_sq8")
+
+# 需要训练的索引类型（训练数据不足时先使用 Flat）
+TRAINED_INDEX_TYPES = ("ivf_flat", "ivf_pq", "sq8", "pq", "ivf_sq8")
+
+# 有损压缩的索引类型（召回后使用原始向量精确重排）
+LOSSY_INDEX_TYPES = ("ivf_pq", "sq8", "pq", "ivf_sq8")
+
+# 支持的相似度度量（cosine 使用归一化向量 + 内积）
+METRICS = ("l2", "cosine")
+
+
+def is_id_map(index) -> bool:
+    """索引是否使用 IndexIDMap 包装（稳定的 int64 ID）"""
+    return isinstance(faiss.downcast_index(index), faiss.IndexIDMap)
+
+
+def unwrap_index(index):
+    """取出 IndexIDMap 内部的实际索引"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def get_index_type(index) -> str:
+    """识别 FAISS 索引的类型"""
+    index = unwrap_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVFScalarQuantizer):
+        return "ivf_sq8"
+    if isinstance(index, faiss.IndexIVFFlat):
+        return "ivf_flat"
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        return "sq8"
+    if isinstance(index, faiss.IndexPQ):
+        return "pq"
+    if isinstance(index, faiss.IndexFlat):
+        return "flat"
+    return type(index).__name__
+
+
+def get_metric(index) -> str:
+    """识别索引的相似度度量"""
+    if unwrap_index(index).metric_type == faiss.METRIC_INNER_PRODUCT:
+        return "cosine"
+    return "l2"
+
+
+def _faiss_metric(metric: str):
+    if metric not in METRICS:
+        raise ValueError(f"不支持的相似度度量: {metric}")
+    return faiss.METRIC_INNER_PRODUCT if metric == "cosine" else faiss.METRIC_L2
+
+
+def normalize_vectors(vectors: np.ndarray) -> np.ndarray:
+    """返回 L2 归一化后的向量副本（用于 cosine 度量）"""
+    vectors = np.array(vectors, dtype=np.float32, copy=True).reshape(len(vectors), -1)
+    if len(vectors):
+        faiss.normalize_L2(vectors)
+    return vectors
+
+
+def _choose_nlist(n: int) -> int:
+    """IVF 聚类中心数量：未配置时按 4*sqrt(n) 选择，且保证每个中心至少 39 个训练样本"""
+    if settings.VECTOR_IVF_NLIST > 0:
+        return settings.VECTOR_IVF_NLIST
+    return max(1, min(int(4 * np.sqrt(n)), n // 39))
+
+
+def build_faiss_index(
+    index_type: str,
+    dimension: int,
+    train_vectors: Optional[np.ndarray] = None,
+    metric: str = "l2"
+):
+    """按类型创建 FAISS 索引
+
+    IVF 类索引需要训练数据；训练数据不足时返回 Flat 索引，等向量足够后再迁移。
+    metric 为 cosine 时创建内积索引，调用方负责传入归一化的向量。
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"不支持的向量索引类型: {index_type}")
+    faiss_metric = _faiss_metric(metric)
+
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, settings.VECTOR_HNSW_M, faiss_metric)
+        index.hnsw.efConstruction = settings.VECTOR_HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = settings.VECTOR_HNSW_EF_SEARCH
+        return index
+
+    if index_type in TRAINED_INDEX_TYPES:
+        n = 0 if train_vectors is None else len(train_vectors)
+        if n < settings.VECTOR_INDEX_MIN_TRAIN_SIZE:
+            return faiss.IndexFlat(dimension, faiss_metric)
+
+        if index_type == "sq8":
+            index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit, faiss_metric)
+            index.train(train_vectors)
+            return index
+        if index_type == "pq":
+            index = faiss.IndexPQ(dimension, settings.VECTOR_PQ_M, settings.VECTOR_PQ_NBITS, faiss_metric)
+            index.train(train_vectors)
+            return index
+
+        nlist = _choose_nlist(n)
+        quantizer = faiss.IndexFlat(dimension, faiss_metric)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss_metric)
+        elif index_type == "ivf_sq8":
+            index = faiss.IndexIVFScalarQuantizer(
+                quantizer, dimension, nlist, faiss.ScalarQuantizer.QT_8bit, faiss_metric
+            )
+        else:
+            index = faiss.IndexIVFPQ(
+                quantizer, dimension, nlist,
+                settings.VECTOR_PQ_M, settings.VECTOR_PQ_NBITS, faiss_metric
+            )
+        index.train(train_vectors)
+        index.nprobe = settings.VECTOR_IVF_NPROBE
+        # quantizer 需要随索引一起存活
+        index.own_fields = True
+        quantizer.this.disown()
+        return index
+
+    return faiss.IndexFlat(dimension, faiss_metric)
+
+
+def build_id_map_index(
+    index_type: str,
+    dimension: int,
+    ids: np.ndarray,
+    vectors: np.ndarray,
+    metric: str = "l2"
+):
+    """创建 IndexIDMap 包装的索引，并以指定 ID 加入向量"""
+    inner = build_faiss_index(index_type, dimension, vectors, metric)
+    index = faiss.IndexIDMap(inner)
+    index.own_fields = True
+    inner.this.disown()
+    if len(vectors):
+        index.add_with_ids(vectors, ids)
+    return index
+
+
+def supports_remove(index) -> bool:
+    """索引是否支持 remove_ids（HNSW 不支持，只能标记删除）"""
+    return get_index_type(index) != "hnsw"
+
+
+def make_search_params(index, search_params: Optional[Dict] = None, sel=None):
+    """构造搜索参数（nprobe / ef_search / ID 过滤），未指定时使用全局配置"""
+    search_params = search_params or {}
+    index_type = get_index_type(index)
+
+    if index_type in ("ivf_flat", "ivf_pq", "ivf_sq8"):
+        nprobe = search_params.get("nprobe") or settings.VECTOR_IVF_NPROBE
+        return faiss.SearchParametersIVF(nprobe=int(nprobe), sel=sel)
+    if index_type == "hnsw":
+        ef_search = search_params.get("ef_search") or settings.VECTOR_HNSW_EF_SEARCH
+        return faiss.SearchParametersHNSW(efSearch=int(ef_search), sel=sel)
+    if sel is not None:
+        return faiss.SearchParameters(sel=sel)
+    return None
+
+
+def reconstruct_all(index) -> np.ndarray:
+    """取出旧版（无 IDMap）索引中的全部向量（按行号顺序）"""
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+
+class FaissIndexEntry:
+    """已加载到内存的 FAISS 索引及其元数据"""
+
+    def __init__(
+        self,
+        name: str,
+        path: str,
+        index,
+        metadata_store: ColumnarMetadataStore,
+        generation: int,
+        tombstones: Optional[set] = None,
+        checkpoint_lsn: int = 0,
+        mmapped: bool = False,
+        raw_file: Optional[str] = None
+    ):
+        self.name = name
+        self.path = path
+        self.index = index
+        # 索引是否为只读内存映射（写入前需要重新加载为普通索引）
+        self.mmapped = mmapped
+        # 向量 ID -> 元数据（列式存储，删除的行不再有效）
+        self.metadata_store = metadata_store
+        # 已删除但仍留在索引中的向量 ID（HNSW 不支持 remove_ids）
+        self.tombstones = tombstones or set()
+        # 原始向量（第 i 行对应 ID 为 i 的向量），用于精确重排和重建索引
+        self.raw_vectors = RawVectorStore(path, index.d, raw_file)
+        self.generation = generation
+        self.last_checked = time.monotonic()
+        # 快照包含的最后一条日志记录，以及内存中已应用的最后一条日志记录
+        self.checkpoint_lsn = checkpoint_lsn
+        self.applied_lsn = checkpoint_lsn
+        self.wal_cursor = WALCursor()
+        # 上次检查点之后写入日志的向量数
+        self.rows_since_checkpoint = 0
+        # 写操作（添加、删除、保存）需要持有该锁
+        self.lock = threading.RLock()
+        # 跨进程写锁的重入深度及锁文件
+        self.write_depth = 0
+        self.write_lock_file = None
+
+    def next_id(self) -> int:
+        """下一个可分配的向量 ID（ID 即原始向量文件的行号）"""
+        return len(self.raw_vectors)
+
+    def garbage_ratio(self) -> float:
+        """已删除向量占原始向量文件的比例"""
+        total = len(self.raw_vectors)
+        if total == 0:
+            return 0.0
+        return 1 - len(self.metadata_store) / total
+
+    def exclusion_selector(self):
+        """排除已标记删除向量的 ID 过滤器"""
+        if not self.tombstones:
+            return None
+        ids = np.fromiter(self.tombstones, dtype=np.int64, count=len(self.tombstones))
+        return faiss.IDSelectorNot(faiss.IDSelectorBatch(ids))
+
+
+class FaissIndexManager:
+    """FAISS 索引管理器
+
+    - 每个索引在进程内只加载一次，所有 VectorService 实例共享
+    - 添加 / 删除只追加到预写日志（WAL），不重写整个索引文件
+    - 写操作持有索引目录上的跨进程文件锁，并在加锁后与磁盘最新状态对齐
+    - 日志积累到 VECTOR_WAL_CHECKPOINT_ROWS 后做检查点：写入新的版本化快照目录、
+      更新 CURRENT 指针（generation）、清理日志和过期快照
+    - 快照目录写完后才原子地发布，已发布的快照不再修改，正在读取旧快照的进程不受影响
+    - 加载时在快照之上重放日志；其他进程按最小间隔检查 generation 和日志增量，
+      发现新快照时在后台线程加载，加载完成后再替换，期间搜索继续使用旧索引
+    - 开启 VECTOR_INDEX_MMAP 时快照以只读内存映射加载，同一节点的多个 worker 共享页缓存；
+      需要应用日志或写入时再转为普通加载
+    """
+
+    INDEX_FILE = "index.faiss"
+    TOMBSTONES_FILE = "tombstones.npy"
+    MANIFEST_FILE = "manifest.json"
+    SNAPSHOTS_DIR = "snapshots"
+    # 当前快照的 generation 指针
+    CURRENT_FILE = "CURRENT"
+    # 旧版布局：快照文件直接位于索引目录，metadata.pkl 为 pickle 元数据
+    LEGACY_METADATA_FILE = "metadata.pkl"
+    LEGACY_CHECKPOINT_FILE = "checkpoint"
+    LEGACY_GENERATION_FILE = "generation"
+    WRITE_LOCK_FILE = ".write.lock"
+
+    def __init__(self):
+        self._entries: Dict[str, FaissIndexEntry] = {}
+        self._lock = threading.Lock()
+        # 正在后台加载新快照的索引
+        self._reloading = set()
+
+    def _index_dir(self, name: str) -> str:
+        """索引所在目录（default 索引保持原有路径）"""
+        if name == "default":
+            return settings.VECTOR_DB_PATH
+        return os.path.join(settings.VECTOR_DB_PATH, name)
+
+    def _wal(self, path: str) -> VectorWAL:
+        return VectorWAL(path, settings.VECTOR_WAL_SEGMENT_BYTES, settings.VECTOR_WAL_FSYNC)
+
+    def _has_snapshot(self, path: str) -> bool:
+        """目录中是否有已发布的快照（含旧版布局）"""
+        return (
+            os.path.exists(os.path.join(path, self.CURRENT_FILE))
+            or os.path.exists(os.path.join(path, self.INDEX_FILE))
+        )
+
+    def _snapshot_dir(self, path: str, generation: int) -> str:
+        return os.path.join(path, self.SNAPSHOTS_DIR, f"gen-{generation:010d}")
+
+    def exists(self, name: str) -> bool:
+        """索引是否已加载或已在磁盘上存在"""
+        if name in self._entries:
+            return True
+        return self._has_snapshot(self._index_dir(name))
+
+    def list_partitions(self) -> List[str]:
+        """列出磁盘上所有索引分区"""
+        partitions = {"default", *self._entries.keys()}
+        if os.path.isdir(settings.VECTOR_DB_PATH):
+            for name in os.listdir(settings.VECTOR_DB_PATH):
+                if self._has_snapshot(os.path.join(settings.VECTOR_DB_PATH, name)):
+                    partitions.add(name)
+        return sorted(partitions)
+
+    def _read_int(self, path: str, file_name: str) -> int:
+        """读取保存单个整数的小文件"""
+        try:
+            with open(os.path.join(path, file_name), "r") as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _write_int(self, path: str, file_name: str, value: int):
+        """原子写入保存单个整数的小文件"""
+        target = os.path.join(path, file_name)
+        tmp_path = target + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(value))
+        os.replace(tmp_path, target)
+
+    def _read_generation(self, path: str) -> int:
+        """读取磁盘上当前发布的快照版本号"""
+        if os.path.exists(os.path.join(path, self.CURRENT_FILE)):
+            return self._read_int(path, self.CURRENT_FILE)
+        return self._read_int(path, self.LEGACY_GENERATION_FILE)
+
+    def _read_manifest(self, path: str, generation: int):
+        """定位快照，返回 (快照目录, manifest)
+
+        manifest 记录快照包含的最后一条日志 LSN 和使用的原始向量文件
+        """
+        if os.path.exists(os.path.join(path, self.CURRENT_FILE)):
+            snapshot_dir = self._snapshot_dir(path, generation)
+            with open(os.path.join(snapshot_dir, self.MANIFEST_FILE), "r") as f:
+                return snapshot_dir, json.load(f)
+        # 旧版布局或尚无快照
+        return path, {
+            "checkpoint_lsn": self._read_int(path, self.LEGACY_CHECKPOINT_FILE),
+            "raw_file": RawVectorStore.FILE_NAME,
+        }
+
+    def _read_index(self, index_path: str, mmap: bool):
+        """读取索引快照，返回 (索引, 是否内存映射)
+
+        FAISS 只对 IVF 的倒排表做内存映射，Flat / HNSW / SQ8 / PQ 仍完整读入内存，
+        这些类型按普通加载处理（可直接写入）；读取失败时回退为普通读取
+        """
+        if mmap:
+            try:
+                index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+                return index, isinstance(unwrap_index(index), faiss.IndexIVF)
+            except RuntimeError as e:
+                print(f"内存映射加载索引失败，改为普通加载: {str(e)}")
+        return faiss.read_index(index_path), False
+
+    def _load(self, name: str, mmap: Optional[bool] = None, dimension: Optional[int] = None) -> FaissIndexEntry:
+        """从磁盘加载快照并重放日志，不存在则创建空索引
+
+        Args:
+            name: 索引名称
+            mmap: 是否以只读内存映射加载快照，默认取 VECTOR_INDEX_MMAP
+            dimension: 新建索引的维度，默认取 VECTOR_DIMENSION
+        """
+        if mmap is None:
+            mmap = settings.VECTOR_INDEX_MMAP
+        path = self._index_dir(name)
+        os.makedirs(path, exist_ok=True)
+
+        try:
+            generation = self._read_generation(path)
+            snapshot_dir, manifest = self._read_manifest(path, generation)
+        except FileNotFoundError:
+            # 读取指针后快照恰好被清理（已有更新的快照），重新读取指针
+            generation = self._read_generation(path)
+            snapshot_dir, manifest = self._read_manifest(path, generation)
+        index_path = os.path.join(snapshot_dir, self.INDEX_FILE)
+        legacy_metadata_path = os.path.join(snapshot_dir, self.LEGACY_METADATA_FILE)
+        tombstones_path = os.path.join(snapshot_dir, self.TOMBSTONES_FILE)
+
+        metadata_store = ColumnarMetadataStore()
+        tombstones = set()
+        mmapped = False
+        if os.path.exists(index_path):
+            index, mmapped = self._read_index(index_path, mmap)
+            if ColumnarMetadataStore.exists(snapshot_dir):
+                metadata_store = ColumnarMetadataStore.load(snapshot_dir)
+            elif os.path.exists(legacy_metadata_path):
+                with open(legacy_metadata_path, 'rb') as f:
+                    metadata_store = ColumnarMetadataStore.from_dict(pickle.load(f))
+            if os.path.exists(tombstones_path):
+                tombstones = set(np.load(tombstones_path).tolist())
+        else:
+            # 创建新索引（使用 L2 距离）
+            dimension = dimension or settings.VECTOR_DIMENSION
+            index = build_id_map_index(
+                settings.VECTOR_INDEX_TYPE,
+                dimension,
+                np.zeros(0, dtype=np.int64),
+                np.zeros((0, dimension), dtype=np.float32),
+                settings.VECTOR_METRIC
+            )
+
+        entry = FaissIndexEntry(
+            name, path, index, metadata_store, generation, tombstones,
+            checkpoint_lsn=manifest["checkpoint_lsn"],
+            mmapped=mmapped,
+            raw_file=manifest["raw_file"]
+        )
+        if not self._replay(entry):
+            # 内存映射的快照之后还有日志，直接改为普通加载
+            return self._load(name, mmap=False, dimension=dimension)
+        return entry
+
+    def _reload(self, entry: FaissIndexEntry) -> FaissIndexEntry:
+        """以普通方式（非内存映射）重新加载最新快照并重放日志，返回新的索引对象
+
+        新对象完整加载后一次性替换 _entries 中的旧对象，正在使用旧对象的搜索不会看到加载到一半的状态；
+        新对象沿用旧对象的锁和写锁状态，调用方之后改用返回的对象
+        """
+        with entry.lock:
+            fresh = self._load(entry.name, mmap=False)
+            fresh.lock = entry.lock
+            fresh.write_depth, fresh.write_lock_file = entry.write_depth, entry.write_lock_file
+            entry.write_depth, entry.write_lock_file = 0, None
+            with self._lock:
+                self._entries[entry.name] = fresh
+            return fresh
+
+    def _make_writable(self, entry: FaissIndexEntry) -> FaissIndexEntry:
+        """内存映射的索引不能修改，转为普通加载，返回可写的索引对象"""
+        if entry.mmapped:
+            return self._reload(entry)
+        return entry
+
+    def _sync_for_write(self, entry: FaissIndexEntry) -> FaissIndexEntry:
+        """写入前与磁盘对齐：有新快照（其他进程做了检查点或压缩）时重新加载，否则重放日志
+
+        持有写锁时顺便截掉原始向量文件末尾的半行，保证新分配的 ID 与文件行号对齐；
+        返回对齐后的索引对象
+        """
+        if entry.mmapped or self._read_generation(entry.path) != entry.generation:
+            entry = self._reload(entry)
+        else:
+            self._replay(entry)
+        entry.raw_vectors.discard_partial_row()
+        return entry
+
+    @contextmanager
+    def write_lock(self, entry: FaissIndexEntry):
+        """索引写锁（进程内线程锁 + 跨进程文件锁，可重入）
+
+        同一索引目录同时只有一个写入者；首次加锁后先与磁盘最新状态对齐，
+        保证分配的向量 ID 和日志 LSN 不与其他进程冲突。
+        对齐时可能重新加载为新对象，调用方应使用 with ... as entry 得到的对象
+        """
+        with entry.lock:
+            if entry.write_depth == 0:
+                lock_file = open(os.path.join(entry.path, self.WRITE_LOCK_FILE), "a")
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                entry.write_lock_file = lock_file
+            entry.write_depth += 1
+            current = entry
+            try:
+                if entry.write_depth == 1:
+                    current = self._sync_for_write(entry)
+                yield current
+            finally:
+                current.write_depth -= 1
+                if current.write_depth == 0:
+                    fcntl.flock(current.write_lock_file, fcntl.LOCK_UN)
+                    current.write_lock_file.close()
+                    current.write_lock_file = None
+
+    def _replay(self, entry: FaissIndexEntry) -> bool:
+        """应用日志中尚未应用的记录
+
+        内存映射的索引不能应用日志：遇到待应用的记录时返回 False，由调用方改为普通加载
+        """
+        with entry.lock:
+            for lsn, record in self._wal(entry.path).read(entry.applied_lsn, entry.wal_cursor):
+                if record.get("generation", entry.generation) > entry.generation:
+                    # 记录基于更新的快照（可能已重新编号），等待加载新快照
+                    entry.wal_cursor = WALCursor()
+                    break
+                if entry.mmapped:
+                    entry.wal_cursor = WALCursor()
+                    return False
+                if record["op"] == "add":
+                    ids = np.asarray(record["ids"], dtype=np.int64)
+                    if len(entry.raw_vectors) <= ids.max():
+                        # 原始向量尚未完整写入，下次从头重新读取日志
+                        entry.wal_cursor = WALCursor()
+                        break
+                    self._apply_add(entry, ids, entry.raw_vectors.get(ids), record["metadata"])
+                    entry.rows_since_checkpoint += len(ids)
+                elif record["op"] == "delete":
+                    self._apply_delete(entry, record["ids"])
+                    entry.rows_since_checkpoint += len(record["ids"])
+                entry.applied_lsn = lsn
+        return True
+
+    def get(self, name: str = "default", force_check: bool = False, dimension: Optional[int] = None) -> FaissIndexEntry:
+        """获取索引
+
+        Args:
+            name: 索引名称
+            force_check: 忽略检查间隔，立即检查磁盘版本（写入前使用）
+            dimension: 索引不存在时新建索引的维度（影子索引的模型维度可能与当前配置不同）
+        """
+        entry = self._entries.get(name)
+        if entry is None:
+            with self._lock:
+                entry = self._entries.get(name)
+                if entry is None:
+                    entry = self._load(name, dimension=dimension)
+                    self._entries[name] = entry
+            return entry
+
+        now = time.monotonic()
+        if not force_check and now - entry.last_checked < settings.VECTOR_INDEX_RELOAD_INTERVAL:
+            return entry
+
+        entry.last_checked = now
+        if self._read_generation(entry.path) == entry.generation:
+            # 快照未变化，只应用其他进程追加的日志
+            if self._replay(entry):
+                return entry
+            if settings.VECTOR_INDEX_BACKGROUND_RELOAD and not force_check:
+                # 内存映射的快照之后有新日志：在后台转为普通加载，完成前继续使用当前快照
+                self._reload_in_background(name, entry, mmap=False)
+                return entry
+            return self._make_writable(entry)
+
+        if settings.VECTOR_INDEX_BACKGROUND_RELOAD and not force_check:
+            # 读请求不等待加载，新快照就绪后再替换
+            self._reload_in_background(name, entry)
+            return entry
+
+        # 磁盘上有新快照，重新加载并替换（正在进行的搜索继续使用旧对象）
+        with entry.lock:
+            current = self._entries.get(name)
+            if current is not entry:
+                return current
+            reloaded = self._load(name)
+            self._entries[name] = reloaded
+            return reloaded
+
+    def _reload_in_background(self, name: str, entry: FaissIndexEntry, mmap: Optional[bool] = None):
+        """在后台线程加载新快照，完成后替换（同一索引同时只有一个加载线程）"""
+        with self._lock:
+            if name in self._reloading:
+                return
+            self._reloading.add(name)
+
+        def run():
+            try:
+                reloaded = self._load(name, mmap=mmap)
+                with self._lock:
+                    if self._entries.get(name) is entry:
+                        self._entries[name] = reloaded
+            except Exception as e:
+                print(f"后台加载向量索引 {name} 失败: {str(e)}")
+            finally:
+                with self._lock:
+                    self._reloading.discard(name)
+
+        threading.Thread(target=run, name=f"faiss-reload-{name}", daemon=True).start()
+
+    def _apply_add(self, entry: FaissIndexEntry, ids: np.ndarray, vectors: np.ndarray, metadata: List[Dict]):
+        """把向量和元数据加入内存索引"""
+        entry.index.add_with_ids(vectors, ids)
+        entry.metadata_store.add(ids, metadata)
+
+    def _apply_delete(self, entry: FaissIndexEntry, ids: List[int]):
+        """从内存索引删除向量：支持 remove_ids 的索引直接移除，HNSW 记为墓碑"""
+        entry.metadata_store.delete(ids)
+        if supports_remove(entry.index):
+            entry.index.remove_ids(np.array(ids, dtype=np.int64))
+        else:
+            entry.tombstones.update(int(i) for i in ids)
+
+    def _commit(self, entry: FaissIndexEntry, record: Dict, rows: int, force_checkpoint: bool = False):
+        """记录一次写操作：追加日志，必要时做检查点"""
+        if force_checkpoint or not self._has_snapshot(entry.path):
+            self.save(entry)
+            return
+
+        lsn = entry.applied_lsn + 1
+        # 标记记录基于的快照版本，旧版本的读者遇到后改为加载新快照
+        self._wal(entry.path).append(lsn, {**record, "generation": entry.generation}, entry.wal_cursor)
+        entry.applied_lsn = lsn
+        entry.rows_since_checkpoint += rows
+
+        if entry.rows_since_checkpoint >= settings.VECTOR_WAL_CHECKPOINT_ROWS:
+            self.save(entry)
+
+    def add(self, entry: FaissIndexEntry, vectors: np.ndarray, metadata: List[Dict]) -> np.ndarray:
+        """添加向量，返回分配的向量 ID
+
+        原始向量追加到 vectors.f32，ID 和元数据写入日志；
+        索引类型需要迁移时直接做检查点。
+        """
+        # 加锁时已与其他进程的写入对齐，再分配连续的向量 ID（即原始向量文件中的行号）
+        with self.write_lock(entry) as entry:
+            converted = self.ensure_id_map(entry)
+            if get_metric(entry.index) == "cosine":
+                vectors = normalize_vectors(vectors)
+            start_id = entry.next_id()
+            ids = np.arange(start_id, start_id + len(vectors), dtype=np.int64)
+
+            # 原始向量先于引用它们的日志记录落盘，断电后日志不会指向不存在的行
+            entry.raw_vectors.append(vectors, fsync=settings.VECTOR_WAL_FSYNC)
+            self._apply_add(entry, ids, vectors, metadata)
+
+            # 索引类型与配置不一致（如 Flat 已积累足够向量可训练 IVF）时自动迁移
+            migrated = self.needs_migration(entry)
+            if migrated:
+                self.migrate(entry)
+
+            self._commit(
+                entry,
+                {"op": "add", "ids": ids, "metadata": metadata},
+                len(ids),
+                force_checkpoint=converted or migrated
+            )
+            return ids
+
+    def delete(self, entry: FaissIndexEntry, ids: List[int]):
+        """删除向量（原始向量文件中的空间由压缩任务回收）"""
+        if not ids:
+            return
+        with self.write_lock(entry) as entry:
+            converted = self.ensure_id_map(entry)
+            ids = [int(i) for i in ids if i in entry.metadata_store]
+            if not ids:
+                return
+            self._apply_delete(entry, ids)
+            self._commit(entry, {"op": "delete", "ids": ids}, len(ids), force_checkpoint=converted)
+
+    def save(self, entry: FaissIndexEntry):
+        """检查点：写入新的快照目录并发布，清理已合并的日志和过期快照
+
+        快照先写到临时目录，完整写入后重命名，最后原子地更新 CURRENT 指针
+        """
+        with self.write_lock(entry) as entry:
+            generation = self._read_generation(entry.path) + 1
+            target = self._snapshot_dir(entry.path, generation)
+            tmp_dir = target + ".tmp"
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            shutil.rmtree(target, ignore_errors=True)
+            os.makedirs(tmp_dir)
+
+            faiss.write_index(entry.index, os.path.join(tmp_dir, self.INDEX_FILE))
+            entry.metadata_store.save(tmp_dir)
+            np.save(
+                os.path.join(tmp_dir, self.TOMBSTONES_FILE),
+                np.array(sorted(entry.tombstones), dtype=np.int64)
+            )
+            with open(os.path.join(tmp_dir, self.MANIFEST_FILE), "w") as f:
+                json.dump({
+                    "generation": generation,
+                    "checkpoint_lsn": entry.applied_lsn,
+                    "raw_file": entry.raw_vectors.file_name,
+                }, f)
+            os.rename(tmp_dir, target)
+
+            # 发布新快照
+            self._write_int(entry.path, self.CURRENT_FILE, generation)
+            entry.generation = generation
+            entry.checkpoint_lsn = entry.applied_lsn
+            entry.rows_since_checkpoint = 0
+
+            self._wal(entry.path).truncate(entry.checkpoint_lsn)
+            self._remove_legacy_snapshot(entry.path)
+            self._collect_garbage(entry)
+
+    def _remove_legacy_snapshot(self, path: str):
+        """删除旧版布局中直接位于索引目录的快照文件"""
+        for file_name in (
+            self.INDEX_FILE, self.LEGACY_METADATA_FILE, self.TOMBSTONES_FILE,
+            self.LEGACY_CHECKPOINT_FILE, self.LEGACY_GENERATION_FILE,
+        ):
+            file_path = os.path.join(path, file_name)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+        shutil.rmtree(os.path.join(path, ColumnarMetadataStore.DIR_NAME), ignore_errors=True)
+
+    def _collect_garbage(self, entry: FaissIndexEntry):
+        """只保留最近 VECTOR_SNAPSHOT_RETAIN 个快照，并删除不再被引用的原始向量文件
+
+        保留旧快照是为了让正在加载或读取旧快照的进程有时间切换
+        """
+        snapshots_dir = os.path.join(entry.path, self.SNAPSHOTS_DIR)
+        snapshots = sorted(
+            name for name in os.listdir(snapshots_dir)
+            if name.startswith("gen-") and not name.endswith(".tmp")
+        )
+        keep = snapshots[-max(1, settings.VECTOR_SNAPSHOT_RETAIN):]
+        for name in snapshots:
+            if name not in keep:
+                shutil.rmtree(os.path.join(snapshots_dir, name), ignore_errors=True)
+
+        referenced = {entry.raw_vectors.file_name}
+        for name in keep:
+            try:
+                with open(os.path.join(snapshots_dir, name, self.MANIFEST_FILE), "r") as f:
+                    referenced.add(json.load(f)["raw_file"])
+            except (FileNotFoundError, ValueError, KeyError):
+                continue
+        for file_name in os.listdir(entry.path):
+            if file_name.startswith("vectors") and file_name.endswith(".f32") and file_name not in referenced:
+                os.remove(os.path.join(entry.path, file_name))
+
+    def _rewrite_raw(self, entry: FaissIndexEntry, vectors: np.ndarray):
+        """把原始向量整体写入新文件（以下一个快照版本命名），已发布快照引用的文件保持不变"""
+        file_name = f"vectors-{self._read_generation(entry.path) + 1:010d}.f32"
+        raw_vectors = RawVectorStore(entry.path, entry.index.d, file_name)
+        raw_vectors.rewrite(vectors)
+        entry.raw_vectors = raw_vectors
+
+    def needs_migration(self, entry: FaissIndexEntry) -> bool:
+        """当前索引类型或相似度度量与配置不一致，且满足迁移条件"""
+        if get_metric(entry.index) != settings.VECTOR_METRIC:
+            return True
+        target = settings.VECTOR_INDEX_TYPE
+        if get_index_type(entry.index) == target:
+            return False
+        if target in TRAINED_INDEX_TYPES:
+            return entry.index.ntotal >= settings.VECTOR_INDEX_MIN_TRAIN_SIZE
+        return True
+
+    def has_raw_vectors(self, entry: FaissIndexEntry) -> bool:
+        """原始向量文件是否覆盖索引中的全部向量"""
+        if is_id_map(entry.index):
+            return True
+        return len(entry.raw_vectors) == entry.index.ntotal
+
+    def ensure_id_map(self, entry: FaissIndexEntry) -> bool:
+        """写入前将旧版（按行号）索引转换为 IndexIDMap 索引，发生转换时返回 True
+
+        旧索引的行号即为新 ID，metadata_store 不需要改动；
+        旧版删除只移除了元数据，对应的孤立向量在转换时一并丢弃。
+        调用方需持有写锁（加锁时已转为可写的普通索引）。
+        """
+        if is_id_map(entry.index):
+            return False
+        with entry.lock:
+            if len(entry.raw_vectors) == entry.index.ntotal:
+                vectors = np.asarray(entry.raw_vectors.all())
+            else:
+                vectors = reconstruct_all(entry.index)
+                self._rewrite_raw(entry, vectors)
+            ids = entry.metadata_store.live_ids()
+            entry.index = build_id_map_index(
+                get_index_type(entry.index), entry.index.d, ids, vectors[ids],
+                get_metric(entry.index)
+            )
+        return True
+
+    def needs_compaction(self, entry: FaissIndexEntry) -> bool:
+        """已删除向量比例超过阈值时需要压缩"""
+        return entry.garbage_ratio() > settings.VECTOR_COMPACTION_THRESHOLD
+
+    def migrate(
+        self,
+        entry: FaissIndexEntry,
+        index_type: Optional[str] = None,
+        compact: bool = False,
+        metric: Optional[str] = None
+    ):
+        """用原始向量重建索引（迁移索引类型 / 相似度度量 / 压缩已删除向量）
+
+        - compact=False：保持向量 ID 不变，只更换索引类型
+        - compact=True：丢弃已删除向量，ID 重新编号为连续的行号，并重写原始向量文件和元数据
+        - 从 l2 迁移到 cosine 时原始向量文件改写为归一化向量
+        调用方负责在重建后保存索引。
+        """
+        index_type = index_type or settings.VECTOR_INDEX_TYPE
+        metric = metric or settings.VECTOR_METRIC
+        with self.write_lock(entry) as entry:
+            self.ensure_id_map(entry)
+
+            if metric == "cosine" and get_metric(entry.index) != "cosine" and len(entry.raw_vectors):
+                self._rewrite_raw(entry, normalize_vectors(entry.raw_vectors.all()))
+
+            ids = entry.metadata_store.live_ids()
+            vectors = entry.raw_vectors.get(ids) if len(ids) else np.zeros((0, entry.index.d), dtype=np.float32)
+
+            if compact:
+                entry.metadata_store = entry.metadata_store.compacted(ids)
+                self._rewrite_raw(entry, vectors)
+                ids = np.arange(len(ids), dtype=np.int64)
+
+            entry.index = build_id_map_index(index_type, entry.index.d, ids, vectors, metric)
+            entry.tombstones = set()
+
+    def compact(self, entry: FaissIndexEntry):
+        """压缩索引：移除已删除向量占用的空间"""
+        self.migrate(entry, compact=True)
+
+    def clear(self, entry: FaissIndexEntry):
+        """清空索引（调用方负责保存）"""
+        with self.write_lock(entry) as entry:
+            entry.index = build_id_map_index(
+                settings.VECTOR_INDEX_TYPE,
+                entry.index.d,
+                np.zeros(0, dtype=np.int64),
+                np.zeros((0, entry.index.d), dtype=np.float32),
+                settings.VECTOR_METRIC
+            )
+            entry.metadata_store = ColumnarMetadataStore()
+            entry.tombstones = set()
+            self._rewrite_raw(entry, np.zeros((0, entry.index.d), dtype=np.float32))
+
+    def reset(self, name: Optional[str] = None):
+        """丢弃已加载的索引，下次访问时重新加载"""
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
+
+
+# 全局索引管理器实例
+vector_index_manager = FaissIndexManager()
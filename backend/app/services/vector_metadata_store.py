@@ -0,0 +1,286 @@
+"""
+向量元数据列式存储
+以向量 ID 为行号的定长数组保存 chunk_id / file_id / page 等字段，
+文件名和标题做字符串驻留，避免数百万个 Python 字典占用内存
+"""
+
+import json
+import os
+import pickle
+import shutil
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+
+# 整数列（-1 表示空值）
+_INT_COLUMNS = {
+    "file_id": np.int64,
+    "org_id": np.int64,
+    "page": np.int32,
+}
+
+# 驻留字符串列（保存字符串表中的下标，-1 表示空值）
+_STRING_COLUMNS = ("file_name", "heading")
+
+_NULL = -1
+
+
+class ColumnarMetadataStore:
+    """列式元数据存储
+
+    - 第 i 行对应 ID 为 i 的向量，按 ID 查找为 O(1)
+    - live 列标记行是否有效（删除只清除标记，压缩时才真正移除）
+    - 不属于固定列的字段保存在稀疏的 extras 字典中
+    - 有效行的 chunk_id 计数在首次按 chunk_id 查询时构建，之后随写入 / 删除增量维护
+    """
+
+    DIR_NAME = "metadata"
+    INITIAL_CAPACITY = 1024
+    INITIAL_CHUNK_ID_WIDTH = 32
+
+    def __init__(self):
+        self.size = 0
+        self.columns: Dict[str, np.ndarray] = {}
+        self.strings: Dict[str, List[str]] = {name: [] for name in _STRING_COLUMNS}
+        self._string_ids: Dict[str, Dict[str, int]] = {name: {} for name in _STRING_COLUMNS}
+        self.extras: Dict[int, Dict] = {}
+        self._chunk_counts: Optional[Counter] = None
+        self._allocate(self.INITIAL_CAPACITY, self.INITIAL_CHUNK_ID_WIDTH)
+
+    def _allocate(self, capacity: int, chunk_id_width: int):
+        """按新容量重新分配所有列（保留已有数据）"""
+        columns = {
+            "chunk_id": np.zeros(capacity, dtype=f"S{chunk_id_width}"),
+            "live": np.zeros(capacity, dtype=bool),
+        }
+        for name, dtype in _INT_COLUMNS.items():
+            columns[name] = np.full(capacity, _NULL, dtype=dtype)
+        for name in _STRING_COLUMNS:
+            columns[name] = np.full(capacity, _NULL, dtype=np.int32)
+
+        for name, old in self.columns.items():
+            columns[name][:self.size] = old[:self.size]
+        self.columns = columns
+
+    def _ensure_writable(self, size: int, chunk_id_width: int = 0):
+        """保证容量和 chunk_id 宽度足够，且列可写（内存映射加载的列会被复制）"""
+        capacity = len(self.columns["live"])
+        width = self.columns["chunk_id"].dtype.itemsize
+        writable = all(col.flags.writeable for col in self.columns.values())
+        if size <= capacity and chunk_id_width <= width and writable:
+            return
+        capacity = max(capacity, self.INITIAL_CAPACITY)
+        while capacity < size:
+            capacity *= 2
+        self._allocate(capacity, max(width, chunk_id_width))
+
+    def _chunk_index(self) -> Counter:
+        """有效行的 chunk_id -> 行数（懒构建，加载或压缩后的第一次查询时重建）"""
+        if self._chunk_counts is None:
+            live = self.columns["live"][:self.size]
+            self._chunk_counts = Counter(self.columns["chunk_id"][:self.size][live].tolist())
+        return self._chunk_counts
+
+    def _uncount(self, ids: np.ndarray):
+        """从 chunk_id 计数中移除这些行（仅统计当前有效的行）"""
+        counts = self._chunk_counts
+        if counts is None:
+            return
+        ids = ids[ids < self.size]
+        ids = ids[self.columns["live"][ids]]
+        for chunk_id in self.columns["chunk_id"][ids].tolist():
+            counts[chunk_id] -= 1
+            if counts[chunk_id] <= 0:
+                del counts[chunk_id]
+
+    def _intern(self, column: str, value: Optional[str]) -> int:
+        if value is None:
+            return _NULL
+        table = self._string_ids[column]
+        index = table.get(value)
+        if index is None:
+            index = len(self.strings[column])
+            self.strings[column].append(value)
+            table[value] = index
+        return index
+
+    # ========== 写入 ==========
+
+    def add(self, ids: Iterable[int], metadata: List[Dict]):
+        """写入元数据（ID 即行号）"""
+        ids = np.asarray(list(ids), dtype=np.int64)
+        if len(ids) == 0:
+            return
+        encoded = [str(meta.get("chunk_id") or "").encode("utf-8") for meta in metadata]
+        self._ensure_writable(int(ids.max()) + 1, max(len(c) for c in encoded))
+        unique_ids = np.unique(ids)
+        self._uncount(unique_ids)
+
+        cols = self.columns
+        cols["chunk_id"][ids] = encoded
+        for name in _INT_COLUMNS:
+            cols[name][ids] = [
+                _NULL if meta.get(name) is None else int(meta[name]) for meta in metadata
+            ]
+        for name in _STRING_COLUMNS:
+            cols[name][ids] = [self._intern(name, meta.get(name)) for meta in metadata]
+        cols["live"][ids] = True
+        if self._chunk_counts is not None:
+            self._chunk_counts.update(cols["chunk_id"][unique_ids].tolist())
+
+        fixed = {"chunk_id", *_INT_COLUMNS, *_STRING_COLUMNS}
+        for vector_id, meta in zip(ids.tolist(), metadata):
+            extra = {k: v for k, v in meta.items() if k not in fixed}
+            if extra:
+                self.extras[vector_id] = extra
+            else:
+                self.extras.pop(vector_id, None)
+
+        self.size = max(self.size, int(ids.max()) + 1)
+
+    def delete(self, ids: Iterable[int]):
+        """删除行（清除 live 标记）"""
+        ids = np.asarray(list(ids), dtype=np.int64)
+        ids = ids[ids < self.size]
+        if len(ids) == 0:
+            return
+        self._ensure_writable(self.size)
+        self._uncount(np.unique(ids))
+        self.columns["live"][ids] = False
+        for vector_id in ids.tolist():
+            self.extras.pop(vector_id, None)
+
+    # ========== 读取 ==========
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self.columns["live"][:self.size]))
+
+    def __contains__(self, vector_id) -> bool:
+        return 0 <= int(vector_id) < self.size and bool(self.columns["live"][int(vector_id)])
+
+    def get(self, vector_id: int, default=None) -> Optional[Dict]:
+        """按 ID 取出一行元数据（字典形式）"""
+        if vector_id not in self:
+            return default
+        cols = self.columns
+        meta = {"chunk_id": cols["chunk_id"][vector_id].decode("utf-8")}
+        for name in _INT_COLUMNS:
+            value = int(cols[name][vector_id])
+            meta[name] = None if value == _NULL else value
+        for name in _STRING_COLUMNS:
+            index = int(cols[name][vector_id])
+            meta[name] = None if index == _NULL else self.strings[name][index]
+        meta.update(self.extras.get(int(vector_id), {}))
+        return meta
+
+    def __getitem__(self, vector_id: int) -> Dict:
+        meta = self.get(vector_id)
+        if meta is None:
+            raise KeyError(vector_id)
+        return meta
+
+    def live_ids(self) -> np.ndarray:
+        """所有有效行的 ID（升序）"""
+        return np.flatnonzero(self.columns["live"][:self.size]).astype(np.int64)
+
+    def items(self) -> Iterator[Tuple[int, Dict]]:
+        for vector_id in self.live_ids().tolist():
+            yield vector_id, self.get(vector_id)
+
+    def select(
+        self,
+        file_ids: Optional[Iterable[int]] = None,
+        chunk_ids: Optional[Iterable[str]] = None
+    ) -> np.ndarray:
+        """向量化筛选有效行，返回匹配的 ID"""
+        cols = self.columns
+        mask = cols["live"][:self.size].copy()
+        if file_ids is not None:
+            mask &= np.isin(cols["file_id"][:self.size], np.fromiter(file_ids, dtype=np.int64))
+        if chunk_ids is not None:
+            # 比已存储的最大宽度还长的 chunk_id 不可能匹配，不能截断后参与比较
+            width = cols["chunk_id"].dtype.itemsize
+            encoded = [c.encode("utf-8") for c in chunk_ids]
+            wanted = np.array([c for c in encoded if len(c) <= width], dtype=cols["chunk_id"].dtype)
+            mask &= np.isin(cols["chunk_id"][:self.size], wanted)
+        return np.flatnonzero(mask).astype(np.int64)
+
+    def has_chunk_ids(self, chunk_ids: List[str]) -> np.ndarray:
+        """逐个判断 chunk_id 是否已存在于有效行中（按计数表查找，与分区大小无关）"""
+        counts = self._chunk_index()
+        return np.fromiter(
+            (c.encode("utf-8") in counts for c in chunk_ids), dtype=bool, count=len(chunk_ids)
+        )
+
+    def compacted(self, ids: np.ndarray) -> "ColumnarMetadataStore":
+        """按给定 ID 顺序取出行，生成重新编号（0..n-1）的新存储"""
+        store = ColumnarMetadataStore()
+        store.strings = self.strings
+        store._string_ids = self._string_ids
+        store._allocate(max(len(ids), 1), self.columns["chunk_id"].dtype.itemsize)
+        for name, col in self.columns.items():
+            store.columns[name][:len(ids)] = col[ids]
+        store.size = len(ids)
+        store.extras = {
+            new_id: self.extras[int(old_id)]
+            for new_id, old_id in enumerate(ids.tolist())
+            if int(old_id) in self.extras
+        }
+        return store
+
+    # ========== 持久化 ==========
+
+    def save(self, path: str):
+        """保存到 path/metadata 目录（先写临时目录再替换）"""
+        target = os.path.join(path, self.DIR_NAME)
+        tmp_dir = target + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        for name, col in self.columns.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), col[:self.size])
+        with open(os.path.join(tmp_dir, "strings.json"), "w", encoding="utf-8") as f:
+            json.dump(self.strings, f, ensure_ascii=False)
+        with open(os.path.join(tmp_dir, "extras.pkl"), "wb") as f:
+            pickle.dump(self.extras, f)
+
+        old_dir = target + ".old"
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if os.path.exists(target):
+            os.rename(target, old_dir)
+        os.rename(tmp_dir, target)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    @classmethod
+    def exists(cls, path: str) -> bool:
+        return os.path.isdir(os.path.join(path, cls.DIR_NAME))
+
+    @classmethod
+    def load(cls, path: str) -> "ColumnarMetadataStore":
+        """加载列数据（内存映射，首次写入时才复制到内存）"""
+        source = os.path.join(path, cls.DIR_NAME)
+        store = cls()
+        store.columns = {}
+        for name in ("chunk_id", "live", *_INT_COLUMNS, *_STRING_COLUMNS):
+            store.columns[name] = np.load(os.path.join(source, f"{name}.npy"), mmap_mode="r")
+        store.size = len(store.columns["live"])
+        with open(os.path.join(source, "strings.json"), "r", encoding="utf-8") as f:
+            store.strings = json.load(f)
+        store._string_ids = {
+            name: {value: i for i, value in enumerate(values)}
+            for name, values in store.strings.items()
+        }
+        with open(os.path.join(source, "extras.pkl"), "rb") as f:
+            store.extras = pickle.load(f)
+        return store
+
+    @classmethod
+    def from_dict(cls, metadata_store: Dict[int, Dict]) -> "ColumnarMetadataStore":
+        """从旧版 {ID: 元数据字典} 转换"""
+        store = cls()
+        if metadata_store:
+            ids = sorted(metadata_store)
+            store.add(ids, [metadata_store[i] for i in ids])
+        return store
@@ -3,24 +3,44 @@
 支持 FAISS、Milvus、Chroma
 """
 
-import os
-import pickle
+import asyncio
 from typing import List, Dict, Optional
-import numpy as np
 import faiss
+import numpy as np
 from app.config import settings
+from app.services.vector_index_manager import (
+    vector_index_manager,
+    FaissIndexEntry,
+    make_search_params,
+    get_index_type,
+    get_metric,
+    normalize_vectors,
+    LOSSY_INDEX_TYPES,
+)
+from app.services.vector_metadata_store import ColumnarMetadataStore
+from app.services.vector_write_queue import vector_write_queue
+from app.services.vector_shards import (
+    merge_results,
+    shard_of,
+    shard_partition,
+    shard_partitions,
+    vector_shard_coordinator,
+)
 
 
 class VectorService:
     """向量数据库服务"""
     
+    # 文档级向量分区的名称后缀（每个文件一个向量，用于两阶段检索的粗筛）
+    DOCS_SUFFIX = "__docs"
+    
     def __init__(self):
         self.db_type = settings.VECTOR_DB_TYPE
-        self.dimension = settings.EMBEDDING_DIMENSION
+        self.dimension = settings.VECTOR_DIMENSION
         
         if self.db_type == "faiss":
-            self.index = self._init_faiss()
-            self.metadata_store = {}  # 存储元数据
+            # FAISS 索引由进程级管理器加载和共享，这里不再重复读取磁盘
+            self.index = None
         elif self.db_type == "milvus":
             self.index = self._init_milvus()
         elif self.db_type == "chroma":
@@ -28,36 +48,39 @@ class VectorService:
         else:
             raise ValueError(f"不支持的向量数据库类型: {self.db_type}")
     
-    def _init_faiss(self):
-        """初始化 FAISS 索引"""
-        index_path = os.path.join(settings.VECTOR_DB_PATH, "index.faiss")
-        metadata_path = os.path.join(settings.VECTOR_DB_PATH, "metadata.pkl")
-        
-        # 确保目录存在
-        os.makedirs(settings.VECTOR_DB_PATH, exist_ok=True)
+    @staticmethod
+    def partition_name(org_id: Optional[int] = None, namespace: str = "") -> str:
+        """组织对应的索引分区名称（未指定组织时使用 default 分区）
         
-        if os.path.exists(index_path):
-            # 加载现有索引
-            index = faiss.read_index(index_path)
-            if os.path.exists(metadata_path):
-                with open(metadata_path, 'rb') as f:
-                    self.metadata_store = pickle.load(f)
-        else:
-            # 创建新索引（使用 L2 距离）
-            index = faiss.IndexFlatL2(self.dimension)
-            # 或使用 Inner Product（余弦相似度）
-            # index = faiss.IndexFlatIP(self.dimension)
-        
-        return index
+        namespace 非空时为该组织在新 embedding 模型下的影子索引分区
+        """
+        partition = "default" if org_id is None else f"org_{int(org_id)}"
+        if namespace:
+            return f"{partition}__{namespace}"
+        return partition
     
-    def _save_faiss(self):
-        """保存 FAISS 索引"""
-        index_path = os.path.join(settings.VECTOR_DB_PATH, "index.faiss")
-        metadata_path = os.path.join(settings.VECTOR_DB_PATH, "metadata.pkl")
-        
-        faiss.write_index(self.index, index_path)
-        with open(metadata_path, 'wb') as f:
-            pickle.dump(self.metadata_store, f)
+    @classmethod
+    def docs_partition_name(cls, partition: str) -> str:
+        """分区对应的文档级向量分区名称"""
+        return f"{partition}{cls.DOCS_SUFFIX}"
+    
+    @classmethod
+    def is_docs_partition(cls, partition: str) -> bool:
+        return partition.endswith(cls.DOCS_SUFFIX)
+    
+    def _get_faiss_entry(
+        self,
+        force_check: bool = False,
+        partition: str = "default",
+        dimension: Optional[int] = None
+    ) -> FaissIndexEntry:
+        """获取共享的 FAISS 索引分区（dimension 为分区不存在时新建索引的维度）"""
+        return vector_index_manager.get(partition, force_check=force_check, dimension=dimension)
+    
+    @property
+    def metadata_store(self) -> ColumnarMetadataStore:
+        """FAISS 元数据（default 分区）"""
+        return self._get_faiss_entry().metadata_store
     
     def _init_milvus(self):
         """初始化 Milvus 连接"""
@@ -77,7 +100,9 @@ class VectorService:
         import chromadb
         
         client = chromadb.PersistentClient(path=settings.VECTOR_DB_PATH)
-        collection = client.get_or_create_collection("docagent")
+        # cosine 度量时 Chroma 返回的距离为 1 - 余弦相似度，与 FAISS 的相似度换算一致
+        space = "cosine" if settings.VECTOR_METRIC == "cosine" else "l2"
+        collection = client.get_or_create_collection("docagent", metadata={"hnsw:space": space})
         
         return collection
     
@@ -85,12 +110,35 @@ class VectorService:
         self,
         chunk_ids: List[str],
         embeddings: List[List[float]],
-        metadata: List[Dict]
+        metadata: List[Dict],
+        namespace: str = "",
+        skip_existing: bool = False,
+        direct: bool = False
     ):
-        """添加向量到数据库"""
+        """添加向量到数据库
+        
+        FAISS 开启 VECTOR_SINGLE_WRITER 时只推入写入队列，由 index_writer 进程统一提交
+        
+        Args:
+            namespace: 索引命名空间（切换 embedding 模型时的影子索引），默认为当前索引
+            skip_existing: 跳过已存在的 chunk_id（可重复执行的回填使用）
+            direct: 不经过写入队列、在返回前提交（写入之后需要立即检查索引的调用方使用，
+                跨进程仍由索引写锁保证同一时刻只有一个写入者）
+        """
         
         if self.db_type == "faiss":
-            await self._add_faiss(chunk_ids, embeddings, metadata)
+            if settings.VECTOR_SINGLE_WRITER and not direct:
+                vector_write_queue.enqueue({
+                    "op": "add",
+                    "chunk_ids": list(chunk_ids),
+                    "vectors": np.array(embeddings, dtype=np.float32),
+                    "metadata": metadata,
+                    "namespace": namespace
+                })
+            else:
+                await self._add_faiss(chunk_ids, embeddings, metadata, skip_existing, namespace)
+        elif namespace:
+            raise NotImplementedError(f"{self.db_type} 不支持影子索引")
         elif self.db_type == "chroma":
             await self._add_chroma(chunk_ids, embeddings, metadata)
         else:
@@ -100,29 +148,156 @@ class VectorService:
         self,
         chunk_ids: List[str],
         embeddings: List[List[float]],
-        metadata: List[Dict]
+        metadata: List[Dict],
+        skip_existing: bool = False,
+        namespace: str = ""
     ):
-        """添加向量到 FAISS"""
+        """添加向量到 FAISS
+        
+        按 metadata 中的 org_id 写入对应组织的分区（分片时再按 file_id 写入对应分片）
+        
+        Args:
+            skip_existing: 跳过分区中已存在的 chunk_id（写入队列重试时保证幂等）
+            namespace: 索引命名空间
+        """
+        # cosine 度量的归一化由索引管理器按分区索引的度量处理
         vectors = np.array(embeddings, dtype=np.float32)
         
-        # 归一化（如果使用 Inner Product）
-        # faiss.normalize_L2(vectors)
+        partitions: Dict[str, List[int]] = {}
+        for i, meta in enumerate(metadata):
+            partition = shard_partition(
+                self.partition_name(meta.get("org_id"), namespace), shard_of(meta.get("file_id"))
+            )
+            partitions.setdefault(partition, []).append(i)
         
-        # 获取当前索引大小作为起始 ID
-        start_idx = self.index.ntotal
+        for partition, rows in partitions.items():
+            self._add_to_partition(
+                partition,
+                [chunk_ids[i] for i in rows],
+                vectors[rows],
+                [metadata[i] for i in rows],
+                skip_existing
+            )
+    
+    def _add_to_partition(
+        self,
+        partition: str,
+        chunk_ids: List[str],
+        vectors: np.ndarray,
+        metadata: List[Dict],
+        skip_existing: bool = False
+    ):
+        """添加向量到指定分区"""
+        # 写入前强制检查磁盘版本，避免覆盖其他进程的写入
+        entry = self._get_faiss_entry(force_check=True, partition=partition, dimension=vectors.shape[1])
         
-        # 添加向量
-        self.index.add(vectors)
+        with vector_index_manager.write_lock(entry) as entry:
+            if skip_existing:
+                keep = ~entry.metadata_store.has_chunk_ids(chunk_ids)
+                if not keep.all():
+                    chunk_ids = [c for c, k in zip(chunk_ids, keep) if k]
+                    vectors = vectors[keep]
+                    metadata = [m for m, k in zip(metadata, keep) if k]
+                if not chunk_ids:
+                    return
+            
+            # 原始向量追加到磁盘，ID 和元数据写入预写日志
+            vector_index_manager.add(
+                entry,
+                vectors,
+                [{"chunk_id": chunk_id, **meta} for chunk_id, meta in zip(chunk_ids, metadata)]
+            )
+            
+            if settings.VECTOR_HIERARCHICAL_SEARCH:
+                self._refresh_document_vectors(
+                    partition, entry, {meta.get("file_id") for meta in metadata}
+                )
+    
+    def _refresh_document_vectors(self, partition: str, entry: FaissIndexEntry, file_ids):
+        """重新计算文件的文档级向量（文件所有有效分块向量的均值）
         
-        # 保存元数据
-        for i, chunk_id in enumerate(chunk_ids):
-            self.metadata_store[start_idx + i] = {
-                "chunk_id": chunk_id,
-                **metadata[i]
-            }
+        调用方需持有分区的写锁；文件已没有有效分块时只删除其文档向量
+        """
+        file_ids = sorted(int(f) for f in file_ids if f is not None and int(f) >= 0)
+        if not file_ids or not vector_index_manager.has_raw_vectors(entry):
+            return
         
-        # 保存到磁盘
-        self._save_faiss()
+        store = entry.metadata_store
+        docs_entry = self._get_faiss_entry(
+            force_check=True, partition=self.docs_partition_name(partition), dimension=entry.index.d
+        )
+        
+        with vector_index_manager.write_lock(docs_entry) as docs_entry:
+            stale = docs_entry.metadata_store.select(file_ids=file_ids)
+            vector_index_manager.delete(docs_entry, stale.tolist())
+            
+            # 按文件分组，每个文件读取一次原始向量
+            ids = store.select(file_ids=file_ids)
+            row_file_ids = store.columns["file_id"][ids]
+            vectors, metadata = [], []
+            for file_id in file_ids:
+                file_rows = ids[row_file_ids == file_id]
+                if len(file_rows) == 0:
+                    continue
+                first = store[int(file_rows[0])]
+                vectors.append(entry.raw_vectors.get(file_rows).mean(axis=0))
+                metadata.append({
+                    "chunk_id": f"file_{file_id}",
+                    "file_id": file_id,
+                    "org_id": first.get("org_id"),
+                    "file_name": first.get("file_name"),
+                    "chunk_count": len(file_rows)
+                })
+            
+            if vectors:
+                vector_index_manager.add(docs_entry, np.stack(vectors).astype(np.float32), metadata)
+    
+    def rebuild_document_index(self, partition: str) -> int:
+        """为分区重建全部文档级向量（开启两阶段检索前已有的数据需要回填），返回文件数"""
+        entry = self._get_faiss_entry(force_check=True, partition=partition)
+        docs_entry = self._get_faiss_entry(
+            force_check=True, partition=self.docs_partition_name(partition), dimension=entry.index.d
+        )
+        
+        with vector_index_manager.write_lock(entry) as entry:
+            with vector_index_manager.write_lock(docs_entry) as docs_entry:
+                vector_index_manager.clear(docs_entry)
+                store = entry.metadata_store
+                file_ids = np.unique(store.columns["file_id"][store.live_ids()])
+                self._refresh_document_vectors(partition, entry, file_ids[file_ids >= 0].tolist())
+                vector_index_manager.save(docs_entry)
+        
+        return len(docs_entry.metadata_store)
+    
+    async def apply_write_ops(self, ops: List[Dict]):
+        """按顺序提交写入队列中的一批操作（index_writer 进程调用）
+        
+        连续的添加操作合并为一次写入（每个分区一次索引添加和一条日志记录），
+        删除操作或命名空间变化前先提交已合并的添加，保证与入队顺序一致
+        """
+        pending: List[Dict] = []
+        
+        async def flush():
+            if not pending:
+                return
+            await self._add_faiss(
+                [chunk_id for op in pending for chunk_id in op["chunk_ids"]],
+                np.concatenate([op["vectors"] for op in pending]),
+                [meta for op in pending for meta in op["metadata"]],
+                skip_existing=True,
+                namespace=pending[0].get("namespace", "")
+            )
+            pending.clear()
+        
+        for op in ops:
+            if op["op"] == "add":
+                if pending and pending[0].get("namespace", "") != op.get("namespace", ""):
+                    await flush()
+                pending.append(op)
+            elif op["op"] == "delete":
+                await flush()
+                self._delete_faiss(op.get("org_id"), **op["conditions"])
+        await flush()
     
     async def _add_chroma(
         self,
@@ -141,87 +316,468 @@ class VectorService:
         self,
         query_embedding: List[float],
         top_k: int = 10,
-        filters: Optional[Dict] = None
+        filters: Optional[Dict] = None,
+        search_params: Optional[Dict] = None,
+        min_similarity: Optional[float] = None,
+        namespace: str = ""
     ) -> List[Dict]:
-        """搜索相似向量"""
+        """搜索相似向量
+        
+        Args:
+            query_embedding: 查询向量
+            top_k: 返回数量
+            filters: 过滤条件
+                - org_id: FAISS 下只搜索该组织的分区
+                - file_ids: 只在这些文件的向量中搜索（在索引扫描时过滤）
+            search_params: FAISS 搜索参数（nprobe / ef_search），不传时使用全局配置
+            min_similarity: 丢弃相似度低于该值的结果（相似度统一在 0~1 之间）
+            namespace: 索引命名空间（组织已切换到新 embedding 模型时使用其影子索引）
+        """
+        
+        results = await self.search_batch(
+            [query_embedding], top_k, filters, search_params, min_similarity, namespace
+        )
+        return results[0]
+    
+    async def search_batch(
+        self,
+        query_embeddings: List[List[float]],
+        top_k: int = 10,
+        filters: Optional[Dict] = None,
+        search_params: Optional[Dict] = None,
+        min_similarity: Optional[float] = None,
+        namespace: str = ""
+    ) -> List[List[Dict]]:
+        """批量搜索相似向量（一次索引调用处理多个查询）
+        
+        Args:
+            query_embeddings: 查询向量列表
+            top_k: 每个查询的返回数量
+            filters: 过滤条件（对所有查询生效）
+            search_params: FAISS 搜索参数（nprobe / ef_search）
+            min_similarity: 丢弃相似度低于该值的结果
+            namespace: 索引命名空间
+            
+        Returns:
+            与 query_embeddings 顺序一致的结果列表
+        """
+        
+        if not query_embeddings:
+            return []
+        
+        if filters and filters.get("file_ids") is not None and len(filters["file_ids"]) == 0:
+            # 过滤条件排除了所有文件
+            return [[] for _ in query_embeddings]
         
         if self.db_type == "faiss":
-            return await self._search_faiss(query_embedding, top_k)
+            batch_results = await self._search_faiss(query_embeddings, top_k, search_params, filters, namespace)
         elif self.db_type == "chroma":
-            return await self._search_chroma(query_embedding, top_k, filters)
+            batch_results = await self._search_chroma(query_embeddings, top_k, filters)
         else:
             raise NotImplementedError(f"未实现 {self.db_type} 的搜索功能")
+        
+        if min_similarity is not None:
+            batch_results = [
+                [r for r in results if r["similarity"] >= min_similarity]
+                for results in batch_results
+            ]
+        return batch_results
+    
+    @staticmethod
+    def _to_similarity(metric: str, distance: float) -> float:
+        """把距离转换为 0~1 的相似度
+        
+        - cosine：距离为 1 - 余弦相似度，相似度即余弦值（负值截断为 0）
+        - l2：1 / (1 + 距离)
+        """
+        if metric == "cosine":
+            return min(max(1 - distance, 0.0), 1.0)
+        return 1 / (1 + distance)
     
     async def _search_faiss(
         self,
-        query_embedding: List[float],
+        query_embeddings: List[List[float]],
+        top_k: int,
+        search_params: Optional[Dict] = None,
+        filters: Optional[Dict] = None,
+        namespace: str = ""
+    ) -> List[List[Dict]]:
+        """在 FAISS 中搜索（(n, d) 查询矩阵一次性搜索）
+        
+        分片时由协调器并行搜索各分片后合并 top_k；需要搜索多个分区时同样按距离合并
+        """
+        # 影子索引的维度可能与当前配置不同，以查询向量本身的维度为准
+        query_vectors = np.array(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+        
+        partition_results = []
+        for partition in self._resolve_partitions(filters, namespace):
+            if settings.VECTOR_NUM_SHARDS > 1:
+                # 协调器阻塞等待各分片（线程池或 IPC），放到线程中执行，不阻塞事件循环
+                partition_results.append(await asyncio.to_thread(
+                    vector_shard_coordinator.search,
+                    partition, query_vectors, top_k, search_params, filters
+                ))
+            else:
+                partition_results.append(self._search_partition(
+                    partition, query_vectors, top_k, search_params, filters
+                ))
+        if len(partition_results) == 1:
+            return partition_results[0]
+        return merge_results(partition_results, top_k)
+    
+    def _search_partition(
+        self,
+        partition: str,
+        query_vectors: np.ndarray,
+        top_k: int,
+        search_params: Optional[Dict] = None,
+        filters: Optional[Dict] = None
+    ) -> List[List[Dict]]:
+        """在一个分区（或分区的一个分片）中搜索
+        
+        分区文件数较多且开启两阶段检索时，先在文档级向量中选出候选文件，
+        再只在候选文件的分块中搜索
+        """
+        if not vector_index_manager.exists(partition):
+            # 分区（或分片）还没有数据：直接返回空结果，不为它创建空索引目录
+            return [[] for _ in range(len(query_vectors))]
+        entry = self._get_faiss_entry(partition=partition)
+        
+        candidate_files = self._candidate_files(partition, query_vectors, filters)
+        if candidate_files is None:
+            return self._search_entry(
+                entry, query_vectors, top_k, search_params, self._filter_ids(entry, filters)
+            )
+        
+        # 每个查询的候选文件不同，逐个查询在候选文件的分块中搜索
+        return [
+            self._search_entry(
+                entry,
+                query_vectors[i:i + 1],
+                top_k,
+                search_params,
+                entry.metadata_store.select(file_ids=files)
+            )[0]
+            for i, files in enumerate(candidate_files)
+        ]
+    
+    def _candidate_files(
+        self,
+        partition: str,
+        query_vectors: np.ndarray,
+        filters: Optional[Dict] = None
+    ) -> Optional[List[List[int]]]:
+        """两阶段检索的第一阶段：在文档级向量中为每个查询选出候选文件
+        
+        未开启、文档向量数量少于 VECTOR_HIERARCHICAL_MIN_FILES，或过滤后的文件本来就不多时
+        返回 None（直接搜索全部分块）
+        """
+        if not settings.VECTOR_HIERARCHICAL_SEARCH:
+            return None
+        
+        top_files = settings.VECTOR_HIERARCHICAL_TOP_FILES
+        file_ids = (filters or {}).get("file_ids")
+        if file_ids is not None and len(file_ids) <= top_files:
+            return None
+        
+        docs_partition = self.docs_partition_name(partition)
+        if not vector_index_manager.exists(docs_partition):
+            return None
+        docs_entry = self._get_faiss_entry(partition=docs_partition)
+        if len(docs_entry.metadata_store) < settings.VECTOR_HIERARCHICAL_MIN_FILES:
+            return None
+        
+        allowed_ids = self._filter_ids(docs_entry, filters)
+        doc_results = self._search_entry(docs_entry, query_vectors, top_files, None, allowed_ids)
+        return [[r["metadata"]["file_id"] for r in results] for results in doc_results]
+    
+    def _search_entry(
+        self,
+        entry: FaissIndexEntry,
+        query_vectors: np.ndarray,
+        top_k: int,
+        search_params: Optional[Dict] = None,
+        allowed_ids: Optional[np.ndarray] = None
+    ) -> List[List[Dict]]:
+        """在一个索引分区中搜索，allowed_ids 不为 None 时只在这些向量中搜索
+        
+        cosine 分区的查询向量先归一化，内积转换为距离 1 - cos，与 L2 一样越小越相似
+        """
+        metric = get_metric(entry.index)
+        if metric == "cosine":
+            query_vectors = normalize_vectors(query_vectors)
+        has_raw_vectors = vector_index_manager.has_raw_vectors(entry)
+        
+        if (
+            allowed_ids is not None
+            and len(allowed_ids) <= settings.VECTOR_FILTER_EXACT_MAX
+            and has_raw_vectors
+        ):
+            # 过滤后候选很少，直接对原始向量精确计算，保证返回完整的 top_k
+            distances, indices = self._search_exact(entry, metric, query_vectors, allowed_ids, top_k)
+        else:
+            # 搜索（IVF / HNSW 索引使用 nprobe / ef_search 控制精度与速度，
+            # 在扫描时只保留允许的向量，并排除已标记删除的向量）
+            if allowed_ids is None:
+                selector = entry.exclusion_selector()
+            else:
+                selector = faiss.IDSelectorBatch(allowed_ids)
+            params = make_search_params(entry.index, search_params, selector)
+            rerank = (
+                settings.VECTOR_RERANK_CANDIDATES > 0
+                and get_index_type(entry.index) in LOSSY_INDEX_TYPES
+                and has_raw_vectors
+            )
+            k = max(top_k, settings.VECTOR_RERANK_CANDIDATES) if rerank else top_k
+            distances, indices = entry.index.search(query_vectors, k, params=params)
+            if metric == "cosine":
+                distances = 1 - distances
+            
+            if rerank:
+                distances, indices = self._rerank_exact(entry, metric, query_vectors, indices, top_k)
+        
+        batch_results = []
+        for row_distances, row_indices in zip(distances, indices):
+            results = []
+            for dist, idx in zip(row_distances, row_indices):
+                if idx == -1:  # FAISS 返回 -1 表示未找到
+                    continue
+                
+                metadata = entry.metadata_store.get(int(idx))
+                if metadata is None:  # 已删除的向量
+                    continue
+                
+                results.append({
+                    "chunk_id": metadata.get("chunk_id"),
+                    "distance": float(dist),
+                    "similarity": self._to_similarity(metric, float(dist)),
+                    "metadata": metadata
+                })
+            batch_results.append(results)
+        
+        return batch_results
+    
+    def _resolve_partitions(self, filters: Optional[Dict] = None, namespace: str = "") -> List[str]:
+        """根据过滤条件选择要搜索的分区
+        
+        default 分区中还有分区前写入的旧数据（partition_vector_index 尚未拆分）时，
+        组织分区之外一并搜索 default，避免组织建立分区后旧文档从检索结果中消失；
+        影子索引由回填任务从数据库完整构建，只搜索影子索引本身
+        """
+        org_id = (filters or {}).get("org_id")
+        partition = self.partition_name(org_id, namespace)
+        if namespace or partition == "default":
+            return [partition]
+        
+        partitions = []
+        if any(vector_index_manager.exists(p) for p in shard_partitions(partition)):
+            partitions.append(partition)
+        if not partitions or self._has_vectors("default"):
+            partitions.append("default")
+        return partitions
+    
+    def _has_vectors(self, partition: str) -> bool:
+        """分区（任一分片）中是否还有有效向量"""
+        return any(
+            len(self._get_faiss_entry(partition=p).metadata_store) > 0
+            for p in shard_partitions(partition)
+            if vector_index_manager.exists(p)
+        )
+    
+    def missing_chunk_ids(self, chunk_ids: List[str], org_id: Optional[int] = None, namespace: str = "") -> List[str]:
+        """返回尚未写入该组织（命名空间）索引的 chunk_id"""
+        present = np.zeros(len(chunk_ids), dtype=bool)
+        for partition in shard_partitions(self.partition_name(org_id, namespace)):
+            if chunk_ids and vector_index_manager.exists(partition):
+                entry = self._get_faiss_entry(force_check=True, partition=partition)
+                present |= entry.metadata_store.has_chunk_ids(chunk_ids)
+        return [chunk_id for chunk_id, found in zip(chunk_ids, present) if not found]
+    
+    def _filter_ids(self, entry: FaissIndexEntry, filters: Optional[Dict] = None) -> Optional[np.ndarray]:
+        """根据过滤条件从元数据中选出允许参与搜索的向量 ID，无限制时返回 None"""
+        file_ids = (filters or {}).get("file_ids")
+        if file_ids is None:
+            return None
+        return entry.metadata_store.select(file_ids=file_ids)
+    
+    @staticmethod
+    def _exact_distances(metric: str, query_vectors: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+        """查询向量与候选向量的精确距离矩阵（cosine 为 1 - 内积，l2 为平方距离）"""
+        products = query_vectors @ vectors.T
+        if metric == "cosine":
+            return 1 - products
+        distances = (
+            (query_vectors ** 2).sum(axis=1)[:, None]
+            + (vectors ** 2).sum(axis=1)[None, :]
+            - 2 * products
+        )
+        return np.maximum(distances, 0)
+    
+    def _search_exact(
+        self,
+        entry: FaissIndexEntry,
+        metric: str,
+        query_vectors: np.ndarray,
+        ids: np.ndarray,
         top_k: int
-    ) -> List[Dict]:
-        """在 FAISS 中搜索"""
-        query_vector = np.array([query_embedding], dtype=np.float32)
+    ):
+        """在给定向量 ID 范围内用原始向量精确搜索"""
+        out_distances = np.full((len(query_vectors), top_k), np.inf, dtype=np.float32)
+        out_indices = np.full((len(query_vectors), top_k), -1, dtype=np.int64)
+        if len(ids) == 0:
+            return out_distances, out_indices
+        
+        all_distances = self._exact_distances(metric, query_vectors, entry.raw_vectors.get(ids))
         
-        # 归一化（如果使用 Inner Product）
-        # faiss.normalize_L2(query_vector)
+        k = min(top_k, len(ids))
+        top = np.argpartition(all_distances, k - 1, axis=1)[:, :k]
+        for i in range(len(query_vectors)):
+            order = top[i][np.argsort(all_distances[i, top[i]])]
+            out_distances[i, :k] = all_distances[i, order]
+            out_indices[i, :k] = ids[order]
         
-        # 搜索
-        distances, indices = self.index.search(query_vector, top_k)
+        return out_distances, out_indices
+    
+    def _rerank_exact(
+        self,
+        entry: FaissIndexEntry,
+        metric: str,
+        query_vectors: np.ndarray,
+        indices: np.ndarray,
+        top_k: int
+    ):
+        """用原始 float32 向量对压缩索引的候选结果精确重排（逐个查询）"""
+        out_distances = np.full((len(query_vectors), top_k), np.inf, dtype=np.float32)
+        out_indices = np.full((len(query_vectors), top_k), -1, dtype=np.int64)
         
-        results = []
-        for i, (dist, idx) in enumerate(zip(distances[0], indices[0])):
-            if idx == -1:  # FAISS 返回 -1 表示未找到
+        for i, query_vector in enumerate(query_vectors):
+            candidates = indices[i][indices[i] != -1]
+            if len(candidates) == 0:
                 continue
             
-            metadata = self.metadata_store.get(int(idx), {})
-            results.append({
-                "chunk_id": metadata.get("chunk_id"),
-                "distance": float(dist),
-                "similarity": 1 / (1 + float(dist)),  # 转换为相似度分数
-                "metadata": metadata
-            })
+            # 按行号顺序读取，提高内存映射文件的访问局部性
+            rows = np.sort(candidates)
+            exact_vectors = entry.raw_vectors.get(rows)
+            exact_distances = self._exact_distances(metric, query_vector[None, :], exact_vectors)[0]
+            
+            order = np.argsort(exact_distances)[:top_k]
+            out_distances[i, :len(order)] = exact_distances[order]
+            out_indices[i, :len(order)] = rows[order]
         
-        return results
+        return out_distances, out_indices
     
     async def _search_chroma(
         self,
-        query_embedding: List[float],
+        query_embeddings: List[List[float]],
         top_k: int,
         filters: Optional[Dict] = None
-    ) -> List[Dict]:
+    ) -> List[List[Dict]]:
         """在 Chroma 中搜索"""
         results = self.index.query(
-            query_embeddings=[query_embedding],
+            query_embeddings=query_embeddings,
             n_results=top_k,
-            where=filters
+            where=self._chroma_where(filters)
         )
         
-        formatted_results = []
-        for i in range(len(results['ids'][0])):
-            formatted_results.append({
-                "chunk_id": results['ids'][0][i],
-                "distance": results['distances'][0][i],
-                "similarity": 1 - results['distances'][0][i],
-                "metadata": results['metadatas'][0][i]
-            })
+        batch_results = []
+        for q in range(len(query_embeddings)):
+            formatted_results = []
+            for i in range(len(results['ids'][q])):
+                formatted_results.append({
+                    "chunk_id": results['ids'][q][i],
+                    "distance": results['distances'][q][i],
+                    "similarity": self._to_similarity(settings.VECTOR_METRIC, results['distances'][q][i]),
+                    "metadata": results['metadatas'][q][i]
+                })
+            batch_results.append(formatted_results)
         
-        return formatted_results
+        return batch_results
     
-    async def delete_file_vectors(self, file_id: int):
-        """删除文件的所有向量"""
+    def _chroma_where(self, filters: Optional[Dict] = None) -> Optional[Dict]:
+        """把过滤条件转换为 Chroma 的 where 表达式（file_ids 使用 $in）
+
+        org_id 只用于选择 FAISS 分区：Chroma 中旧数据的元数据没有 org_id，
+        按它过滤会把这些向量全部漏掉，组织隔离由调用方查询数据库时保证
+        """
+        conditions = []
+        for key, value in (filters or {}).items():
+            if key == "org_id":
+                continue
+            if key == "file_ids":
+                conditions.append({"file_id": {"$in": list(value)}})
+            else:
+                conditions.append({key: value})
+        if not conditions:
+            return None
+        return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+    
+    async def delete_file_vectors(self, file_id: int, org_id: Optional[int] = None):
+        """删除文件的所有向量
+        
+        Args:
+            file_id: 文件ID
+            org_id: 文件所属组织，指定时只处理该组织分区和 default 分区
+        """
         
         if self.db_type == "faiss":
-            # FAISS 不支持直接删除，需要重建索引
-            # 这里简化处理，实际应用需要更复杂的逻辑
-            new_metadata = {
-                k: v for k, v in self.metadata_store.items()
-                if v.get("file_id") != file_id
-            }
-            
-            if len(new_metadata) < len(self.metadata_store):
-                # 需要重建索引
-                self.metadata_store = new_metadata
-                self._save_faiss()
+            self._delete_or_enqueue(org_id, file_ids=[file_id])
         
         elif self.db_type == "chroma":
             # Chroma 支持按元数据删除
             self.index.delete(where={"file_id": file_id})
-
+    
+    async def delete_vectors(self, chunk_ids: List[str], org_id: Optional[int] = None):
+        """按 chunk_id 删除向量
+        
+        Args:
+            chunk_ids: 要删除的 chunk ID 列表
+            org_id: 所属组织，指定时只处理该组织分区和 default 分区
+        """
+        
+        if not chunk_ids:
+            return
+        
+        if self.db_type == "faiss":
+            self._delete_or_enqueue(org_id, chunk_ids=list(chunk_ids))
+        
+        elif self.db_type == "chroma":
+            self.index.delete(ids=list(chunk_ids))
+        
+        else:
+            raise NotImplementedError(f"未实现 {self.db_type} 的删除功能")
+    
+    def _delete_or_enqueue(self, org_id: Optional[int] = None, **conditions):
+        """开启单写入进程时推入写入队列，否则直接删除"""
+        if settings.VECTOR_SINGLE_WRITER:
+            vector_write_queue.enqueue({"op": "delete", "org_id": org_id, "conditions": conditions})
+        else:
+            self._delete_faiss(org_id, **conditions)
+    
+    def _delete_faiss(self, org_id: Optional[int] = None, **conditions):
+        """删除满足条件（file_ids / chunk_ids）的向量
+        
+        支持 remove_ids 的索引直接移除向量，HNSW 标记为墓碑；
+        原始向量文件中的空间由压缩任务回收
+        """
+        if org_id is not None:
+            # 组织的当前分区和各影子索引分区（含分片），以及 default 分区
+            base = self.partition_name(org_id)
+            partitions = [
+                p for p in vector_index_manager.list_partitions()
+                if (p == base or p.startswith(f"{base}__")) and not self.is_docs_partition(p)
+            ] + shard_partitions("default")
+        else:
+            partitions = [p for p in vector_index_manager.list_partitions() if not self.is_docs_partition(p)]
+        
+        for partition in partitions:
+            if not vector_index_manager.exists(partition):
+                continue
+            
+            entry = self._get_faiss_entry(force_check=True, partition=partition)
+            with vector_index_manager.write_lock(entry) as entry:
+                ids = entry.metadata_store.select(**conditions)
+                file_ids = np.unique(entry.metadata_store.columns["file_id"][ids]).tolist()
+                vector_index_manager.delete(entry, ids.tolist())
+                
+                if settings.VECTOR_HIERARCHICAL_SEARCH:
+                    self._refresh_document_vectors(partition, entry, file_ids)
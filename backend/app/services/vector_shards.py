@@ -0,0 +1,312 @@
+"""
+向量索引分片
+每个分区按 file_id 拆分为 VECTOR_NUM_SHARDS 个分片，各分片可由独立的分片服务进程加载和搜索，
+协调器把查询并行发送到所有分片后合并 top_k
+
+分片服务与协调器之间的消息为固定格式（JSON 头部 + float32 / int64 原始数组），不使用 pickle；
+连接需通过 VECTOR_SHARD_AUTHKEY 认证，未配置密钥时拒绝启动
+
+启动分片服务：
+    VECTOR_SHARD_AUTHKEY=<密钥> python -m app.services.vector_shards --shard 0 --port 7100
+"""
+
+import argparse
+import json
+import queue
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.config import settings
+
+
+def shard_of(file_id: Optional[int]) -> int:
+    """文件所在的分片（同一文件的分块总在同一分片，按文件删除和文档级向量都只涉及一个分片）"""
+    if file_id is None:
+        return 0
+    return int(file_id) % settings.VECTOR_NUM_SHARDS
+
+
+def shard_partition(partition: str, shard: int) -> str:
+    """分区在指定分片上的名称（未分片时即分区本身）"""
+    if settings.VECTOR_NUM_SHARDS <= 1:
+        return partition
+    return f"{partition}__shard{shard}"
+
+
+def shard_partitions(partition: str) -> List[str]:
+    """分区的所有分片名称"""
+    return [shard_partition(partition, shard) for shard in range(max(settings.VECTOR_NUM_SHARDS, 1))]
+
+
+def merge_results(shard_results: List[List[List[Dict]]], top_k: int) -> List[List[Dict]]:
+    """按距离合并各分片的结果，每个查询保留 top_k 个"""
+    merged = []
+    for per_query in zip(*shard_results):
+        results = [r for results in per_query for r in results]
+        results.sort(key=lambda r: r["distance"])
+        merged.append(results[:top_k])
+    return merged
+
+
+def _parse_address(address: str) -> Tuple[str, int]:
+    host, port = address.strip().rsplit(":", 1)
+    return host, int(port)
+
+
+def _authkey() -> bytes:
+    """分片服务连接认证密钥（没有默认值，未配置时拒绝建立连接或监听）"""
+    if not settings.VECTOR_SHARD_AUTHKEY:
+        raise ValueError("未配置 VECTOR_SHARD_AUTHKEY，无法启动分片服务或连接分片服务")
+    return settings.VECTOR_SHARD_AUTHKEY.encode("utf-8")
+
+
+# 消息中允许出现的数组类型
+MESSAGE_DTYPES = {np.dtype("<f4"), np.dtype("<i8")}
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"无法序列化的类型: {type(value).__name__}")
+
+
+def pack_message(header: Dict, *arrays: np.ndarray) -> bytes:
+    """编码消息：4 字节头部长度 + JSON 头部 + 各数组的原始字节（类型和形状记录在头部）"""
+    arrays = [np.ascontiguousarray(a, dtype=a.dtype.newbyteorder("<")) for a in arrays]
+    for array in arrays:
+        if array.dtype not in MESSAGE_DTYPES:
+            raise TypeError(f"消息不支持的数组类型: {array.dtype}")
+    header = dict(header, arrays=[[array.dtype.str, list(array.shape)] for array in arrays])
+    head = json.dumps(header, ensure_ascii=False, default=_json_default).encode("utf-8")
+    return b"".join([struct.pack("<I", len(head)), head] + [array.tobytes() for array in arrays])
+
+
+def unpack_message(data: bytes) -> Tuple[Dict, List[np.ndarray]]:
+    """解码 pack_message 生成的消息，格式不符时抛出 ValueError"""
+    if len(data) < 4:
+        raise ValueError("消息过短")
+    (head_size,) = struct.unpack_from("<I", data)
+    offset = 4 + head_size
+    header = json.loads(data[4:offset].decode("utf-8"))
+    if not isinstance(header, dict):
+        raise ValueError("消息头部格式错误")
+
+    arrays = []
+    for dtype, shape in header.pop("arrays", []):
+        dtype = np.dtype(dtype)
+        if dtype not in MESSAGE_DTYPES or any(int(n) < 0 for n in shape):
+            raise ValueError(f"消息不支持的数组: {dtype} {shape}")
+        count = int(np.prod(shape, dtype=np.int64))
+        if offset + count * dtype.itemsize > len(data):
+            raise ValueError("消息数组长度不足")
+        arrays.append(np.frombuffer(data, dtype, count, offset).reshape(shape))
+        offset += count * dtype.itemsize
+    if offset != len(data):
+        raise ValueError("消息长度与头部不一致")
+    return header, arrays
+
+
+class ShardClient:
+    """分片服务客户端（连接池，每个连接同一时间只处理一个请求）"""
+
+    def __init__(self, address: Tuple[str, int]):
+        self.address = address
+        self._pool: "queue.Queue[Connection]" = queue.Queue()
+
+    def _connect(self) -> Connection:
+        return Client(self.address, authkey=_authkey())
+
+    def call(self, header: Dict, *arrays: np.ndarray):
+        """发送请求并等待结果；连接失效时重新连接重试一次"""
+        for attempt in range(2):
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+
+            try:
+                conn.send_bytes(pack_message(header, *arrays))
+                ready = conn.poll(settings.VECTOR_SHARD_TIMEOUT)
+                if ready:
+                    response, _ = unpack_message(conn.recv_bytes())
+            except (EOFError, OSError):
+                conn.close()
+                if attempt == 1:
+                    raise
+                continue
+
+            if not ready:
+                # 连接上可能还有迟到的响应，不能放回连接池
+                conn.close()
+                raise TimeoutError(f"分片服务 {self.address} 响应超时")
+            self._pool.put(conn)
+            if response.get("status") != "ok":
+                raise RuntimeError(f"分片服务 {self.address} 返回错误: {response.get('error')}")
+            return response.get("result")
+
+    def close(self):
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+
+
+class ShardCoordinator:
+    """分片查询协调器
+
+    配置了 VECTOR_SHARD_ADDRESSES 时通过 IPC 查询各分片服务，
+    否则在本进程内用线程池并行搜索各分片（FAISS 搜索时释放 GIL）
+    """
+
+    def __init__(self):
+        self._clients: Dict[Tuple[str, int], ShardClient] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=max(settings.VECTOR_NUM_SHARDS, 1),
+                    thread_name_prefix="vector-shard"
+                )
+            return self._executor
+
+    def _client(self, shard: int) -> Optional[ShardClient]:
+        addresses = [a for a in settings.VECTOR_SHARD_ADDRESSES.split(",") if a.strip()]
+        if not addresses:
+            return None
+        if len(addresses) != settings.VECTOR_NUM_SHARDS:
+            raise ValueError(
+                f"VECTOR_SHARD_ADDRESSES 配置了 {len(addresses)} 个地址，与分片数 {settings.VECTOR_NUM_SHARDS} 不一致"
+            )
+        address = _parse_address(addresses[shard])
+        with self._lock:
+            if address not in self._clients:
+                self._clients[address] = ShardClient(address)
+            return self._clients[address]
+
+    def _search_shard(self, shard, partition, query_vectors, top_k, search_params, filters):
+        client = self._client(shard)
+        if client is not None:
+            return client.call(
+                {
+                    "method": "search",
+                    "partition": partition,
+                    "top_k": int(top_k),
+                    "search_params": search_params,
+                    "filters": filters
+                },
+                np.asarray(query_vectors, dtype=np.float32)
+            )
+
+        from app.services.vector_service import VectorService
+        return VectorService()._search_partition(
+            shard_partition(partition, shard), query_vectors, top_k, search_params, filters
+        )
+
+    def search(
+        self,
+        partition: str,
+        query_vectors: np.ndarray,
+        top_k: int,
+        search_params: Optional[Dict] = None,
+        filters: Optional[Dict] = None
+    ) -> List[List[Dict]]:
+        """并行搜索分区的所有分片并合并结果"""
+        futures = [
+            self.executor.submit(
+                self._search_shard, shard, partition, query_vectors, top_k, search_params, filters
+            )
+            for shard in range(settings.VECTOR_NUM_SHARDS)
+        ]
+        return merge_results([future.result() for future in futures], top_k)
+
+    def reset(self):
+        """关闭所有连接（测试或配置变更时使用）"""
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+
+class ShardServer:
+    """分片服务：只搜索本分片的分区，每个连接一个线程"""
+
+    def __init__(self, shard: int, host: str = "127.0.0.1", port: int = 0):
+        self.shard = shard
+        self.listener = Listener((host, port), authkey=_authkey())
+        self.address = self.listener.address
+
+        from app.services.vector_service import VectorService
+        self.vector_service = VectorService()
+
+    def handle(self, request: Dict, arrays: List[np.ndarray]):
+        method = request.get("method")
+        if method == "search":
+            if len(arrays) != 1 or arrays[0].dtype != np.float32 or arrays[0].ndim != 2:
+                raise ValueError("search 请求需要一个二维 float32 查询数组")
+            return self.vector_service._search_partition(
+                shard_partition(str(request["partition"]), self.shard),
+                arrays[0],
+                int(request["top_k"]),
+                request.get("search_params"),
+                request.get("filters")
+            )
+        if method == "ping":
+            return self.shard
+        raise ValueError(f"未知的分片请求: {method}")
+
+    def _serve_connection(self, conn: Connection):
+        with conn:
+            while True:
+                try:
+                    data = conn.recv_bytes()
+                except (EOFError, OSError):
+                    return
+                try:
+                    response = {"status": "ok", "result": self.handle(*unpack_message(data))}
+                except Exception as e:
+                    response = {"status": "error", "error": str(e)}
+                try:
+                    conn.send_bytes(pack_message(response))
+                except (EOFError, OSError):
+                    return
+
+    def serve_forever(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except AuthenticationError:
+                continue
+            except OSError:
+                # 监听已关闭
+                return
+            threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+
+    def close(self):
+        self.listener.close()
+
+
+# 全局分片协调器实例
+vector_shard_coordinator = ShardCoordinator()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="向量索引分片服务")
+    parser.add_argument("--shard", type=int, required=True)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, required=True)
+    options = parser.parse_args()
+
+    server = ShardServer(options.shard, options.host, options.port)
+    print(f"向量分片服务 {options.shard}/{settings.VECTOR_NUM_SHARDS} 监听 {server.address}")
+    server.serve_forever()
@@ -0,0 +1,156 @@
+"""
+向量索引预写日志（WAL）
+增量写入只追加日志记录，由检查点定期合并为新的索引快照
+"""
+
+import os
+import pickle
+import struct
+import zlib
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+# 记录头：payload 长度、LSN、CRC32
+_HEADER = struct.Struct("<IQI")
+
+
+class WALCursor:
+    """日志读取位置"""
+
+    def __init__(self, segment: int = 0, offset: int = 0):
+        self.segment = segment
+        self.offset = offset
+
+
+class VectorWAL:
+    """按段存储的追加日志
+
+    - 每条记录带有单调递增的 LSN，段文件名为该段第一条记录的 LSN
+    - 读取时校验 CRC，遇到不完整的尾部记录（写入中或崩溃）即停止
+    """
+
+    SEGMENT_PREFIX = "segment-"
+    SEGMENT_SUFFIX = ".log"
+
+    def __init__(self, path: str, segment_bytes: int, fsync: bool = True):
+        self.dir = os.path.join(path, "wal")
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        os.makedirs(self.dir, exist_ok=True)
+
+    def _segment_path(self, first_lsn: int) -> str:
+        return os.path.join(self.dir, f"{self.SEGMENT_PREFIX}{first_lsn:016d}{self.SEGMENT_SUFFIX}")
+
+    def segments(self) -> List[int]:
+        """按顺序列出所有段（返回各段第一条记录的 LSN）"""
+        result = []
+        for name in os.listdir(self.dir):
+            if name.startswith(self.SEGMENT_PREFIX) and name.endswith(self.SEGMENT_SUFFIX):
+                result.append(int(name[len(self.SEGMENT_PREFIX):-len(self.SEGMENT_SUFFIX)]))
+        return sorted(result)
+
+    def append(self, lsn: int, record: Dict, cursor: Optional[WALCursor] = None):
+        """追加一条记录（超过段大小时切换到新段）
+
+        调用方需持有写锁。追加前先截掉末段上次写入中断留下的半条记录，
+        否则读取在半条记录处停止，之后追加的记录都读不到。
+        传入 cursor 时从其位置开始校验末段，并把 cursor 推进到新记录之后
+        """
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        data = _HEADER.pack(len(payload), lsn, zlib.crc32(payload)) + payload
+
+        first_lsn = lsn
+        segments = self.segments()
+        if segments:
+            last = segments[-1]
+            last_path = self._segment_path(last)
+            offset = cursor.offset if cursor is not None and cursor.segment == last else 0
+            end = self._valid_end(last, offset)
+            if end == 0:
+                os.remove(last_path)
+            else:
+                if os.path.getsize(last_path) > end:
+                    with open(last_path, "r+b") as f:
+                        f.truncate(end)
+                if end < self.segment_bytes:
+                    first_lsn = last
+
+        with open(self._segment_path(first_lsn), "ab") as f:
+            f.write(data)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+            end = f.tell()
+
+        if cursor is not None:
+            cursor.segment = first_lsn
+            cursor.offset = end
+
+    def _valid_end(self, first_lsn: int, offset: int) -> int:
+        """从段的指定偏移（须为记录边界）向后校验，返回最后一条完整记录的结束位置"""
+        with open(self._segment_path(first_lsn), "rb") as f:
+            f.seek(offset)
+            while True:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    return offset
+                length, _, crc = _HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    return offset
+                offset += _HEADER.size + length
+
+    def _read_segment(self, first_lsn: int, offset: int) -> Iterator[Tuple[int, Dict, int]]:
+        """从段的指定偏移读取记录，返回 (lsn, record, 下一条记录的偏移)"""
+        try:
+            with open(self._segment_path(first_lsn), "rb") as f:
+                f.seek(offset)
+                while True:
+                    header = f.read(_HEADER.size)
+                    if len(header) < _HEADER.size:
+                        return
+                    length, lsn, crc = _HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) < length or zlib.crc32(payload) != crc:
+                        return
+                    offset += _HEADER.size + length
+                    yield lsn, pickle.loads(payload), offset
+        except FileNotFoundError:
+            return
+
+    def read(self, after_lsn: int, cursor: Optional[WALCursor] = None) -> Iterator[Tuple[int, Dict]]:
+        """读取 LSN 大于 after_lsn 的记录
+
+        传入 cursor 时从上次读取的位置继续，并随读取推进 cursor
+        """
+        cursor = cursor or WALCursor()
+        for first_lsn in self.segments():
+            if first_lsn < cursor.segment:
+                continue
+            offset = cursor.offset if first_lsn == cursor.segment else 0
+            for lsn, record, next_offset in self._read_segment(first_lsn, offset):
+                cursor.segment = first_lsn
+                cursor.offset = next_offset
+                if lsn > after_lsn:
+                    yield lsn, record
+
+    def last_lsn(self) -> int:
+        """日志中最后一条完整记录的 LSN"""
+        segments = self.segments()
+        if not segments:
+            return 0
+        last = segments[-1] - 1
+        for lsn, _, _ in self._read_segment(segments[-1], 0):
+            last = lsn
+        return last
+
+    def truncate(self, checkpoint_lsn: int):
+        """删除已全部包含在检查点中的段"""
+        segments = self.segments()
+        for i, first_lsn in enumerate(segments):
+            if i + 1 < len(segments):
+                segment_last = segments[i + 1] - 1
+            else:
+                segment_last = self.last_lsn()
+            if segment_last <= checkpoint_lsn:
+                os.remove(self._segment_path(first_lsn))
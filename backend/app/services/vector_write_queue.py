@@ -0,0 +1,104 @@
+"""
+向量写入队列
+各 ingestion worker 把添加 / 删除操作推入 Redis 列表，
+由单独的 index_writer 进程按顺序合并提交，避免多个进程并发写同一索引
+"""
+
+import json
+import struct
+from typing import Dict, List
+
+import numpy as np
+import redis
+
+from app.config import settings
+
+
+# 编码格式：头部长度（4 字节）+ JSON 头部 + float32 向量数据
+_HEADER_LENGTH = struct.Struct("<I")
+
+
+class VectorWriteQueue:
+    """基于 Redis 列表的向量写入队列（先进先出）
+
+    - 生产者：enqueue 推入操作，并在没有待执行的写入任务时调度一次 apply_vector_writes
+    - 消费者：index_writer 进程 peek 一批操作，提交成功后 ack 从队列移除
+    """
+
+    QUEUE_KEY = "vector_index:write_ops"
+    FAILED_KEY = "vector_index:write_ops:failed"
+    SCHEDULED_KEY = "vector_index:writer_scheduled"
+    SCHEDULE_TTL = 60  # 调度标记过期时间（秒），写入任务丢失时允许重新调度
+
+    def __init__(self):
+        self._redis_client = None
+
+    @property
+    def redis_client(self) -> redis.Redis:
+        # 队列中包含二进制向量数据，不做字符串解码
+        if self._redis_client is None:
+            self._redis_client = redis.Redis(
+                host=settings.REDIS_HOST,
+                port=settings.REDIS_PORT,
+                password=settings.REDIS_PASSWORD,
+                db=settings.REDIS_DB,
+                decode_responses=False
+            )
+        return self._redis_client
+
+    @staticmethod
+    def encode(op: Dict) -> bytes:
+        """编码操作（向量以 float32 原始字节保存）"""
+        header = {k: v for k, v in op.items() if k != "vectors"}
+        body = b""
+        if "vectors" in op:
+            vectors = np.ascontiguousarray(op["vectors"], dtype=np.float32)
+            header["vector_shape"] = list(vectors.shape)
+            body = vectors.tobytes()
+        header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        return _HEADER_LENGTH.pack(len(header_bytes)) + header_bytes + body
+
+    @staticmethod
+    def decode(data: bytes) -> Dict:
+        """解码操作"""
+        (length,) = _HEADER_LENGTH.unpack_from(data)
+        start = _HEADER_LENGTH.size
+        op = json.loads(data[start:start + length].decode("utf-8"))
+        shape = op.pop("vector_shape", None)
+        if shape is not None:
+            op["vectors"] = np.frombuffer(data[start + length:], dtype=np.float32).reshape(shape)
+        return op
+
+    def enqueue(self, op: Dict):
+        """推入一个写入操作，并确保有写入任务处理队列"""
+        self.redis_client.rpush(self.QUEUE_KEY, self.encode(op))
+        self._schedule_writer()
+
+    def _schedule_writer(self):
+        # 已有待执行的写入任务时不重复调度
+        if self.redis_client.set(self.SCHEDULED_KEY, 1, nx=True, ex=self.SCHEDULE_TTL):
+            from app.tasks.celery_app import celery_app
+            celery_app.send_task("apply_vector_writes", queue=settings.VECTOR_WRITER_QUEUE)
+
+    def begin_drain(self):
+        """写入任务开始处理队列：清除调度标记，之后的新操作会触发下一次调度"""
+        self.redis_client.delete(self.SCHEDULED_KEY)
+
+    def peek(self, count: int) -> List[Dict]:
+        """读取队首的最多 count 个操作（不移除）"""
+        return [self.decode(data) for data in self.redis_client.lrange(self.QUEUE_KEY, 0, count - 1)]
+
+    def ack(self, count: int):
+        """移除已提交的队首 count 个操作"""
+        self.redis_client.ltrim(self.QUEUE_KEY, count, -1)
+
+    def dead_letter(self, op: Dict):
+        """保存无法提交的操作，便于排查"""
+        self.redis_client.rpush(self.FAILED_KEY, self.encode(op))
+
+    def __len__(self) -> int:
+        return self.redis_client.llen(self.QUEUE_KEY)
+
+
+# 全局写入队列实例
+vector_write_queue = VectorWriteQueue()
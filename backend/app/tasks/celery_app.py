@@ -12,7 +12,8 @@ celery_app = Celery(
     include=[
         "app.tasks.document_tasks",
         "app.tasks.refresh_tasks",
-        "app.tasks.scheduled_tasks"
+        "app.tasks.scheduled_tasks",
+        "app.tasks.index_tasks"
     ]
 )
 
@@ -26,8 +27,22 @@ celery_app.conf.update(
     task_track_started=True,
     task_time_limit=3600,  # 1小时超时
     worker_prefetch_multiplier=1,
+    # 向量写入由单并发的 index_writer worker 串行提交
+    task_routes={
+        "apply_vector_writes": {"queue": settings.VECTOR_WRITER_QUEUE},
+    },
 )
 
+# 每个 worker 子进程启动后预加载本地模型（在 fork 之后加载，避免子进程共享推理线程状态）
+from celery.signals import worker_process_init
+
+
+@worker_process_init.connect
+def warm_up_models(**kwargs):
+    from app.services.embedding_service import warm_up_embedding_model
+    warm_up_embedding_model()
+
+
 # Celery Beat 定期任务配置
 from celery.schedules import crontab
 
@@ -46,6 +61,20 @@ celery_app.conf.beat_schedule = {
         'options': {'queue': 'maintenance'}
     },
     
+    # 每10分钟将向量索引日志合并为快照
+    'checkpoint-vector-indexes': {
+        'task': 'checkpoint_vector_indexes',
+        'schedule': crontab(minute='*/10'),
+        'options': {'queue': 'maintenance'}
+    },
+    
+    # 每小时压缩向量索引（回收已删除向量）
+    'compact-vector-indexes-hourly': {
+        'task': 'compact_vector_indexes',
+        'schedule': crontab(minute=30),
+        'options': {'queue': 'maintenance'}
+    },
+    
     # 每天凌晨1点生成统计报告
     'generate-daily-stats': {
         'task': 'generate_daily_stats',
@@ -13,7 +13,7 @@ from app.models.chunk import Chunk
 from app.database.session import SessionLocal
 from app.services.document_parser import DocumentParser
 from app.services.chunking_service import ChunkingService
-from app.services.embedding_service import EmbeddingService
+from app.services.embedding_migration import embedding_router
 from app.services.vector_service import VectorService
 from app.config import settings
 
@@ -96,6 +96,8 @@ def process_document_task(file_id: int):
                 page_number=chunk_data.get("metadata", {}).get("page"),
                 heading=chunk_data.get("metadata", {}).get("heading"),
                 token_count=chunk_data.get("token_count"),
+                start_offset=chunk_data.get("start_offset"),
+                end_offset=chunk_data.get("end_offset"),
                 metadata=chunk_data.get("metadata", {}),
                 is_embedded=0
             )
@@ -111,12 +113,15 @@ def process_document_task(file_id: int):
         db.commit()
         
         # 9. 生成 embeddings
-        embedding_service = EmbeddingService()
+        # 组织已切换 embedding 模型时使用新模型和对应的索引
+        embedding_service, namespace = embedding_router.resolve(file.org_id)
         texts = [chunk.text for chunk in chunk_records]
         
         try:
             import asyncio
-            embeddings = asyncio.run(embedding_service.embed_batch(texts))
+            embeddings = asyncio.run(embedding_service.embed_batch(
+                texts, [chunk.text_hash for chunk in chunk_records]
+            ))
             print(f"Embedding 完成，共 {len(embeddings)} 个向量")
         except Exception as e:
             file.status = FileStatus.FAILED
@@ -130,6 +135,7 @@ def process_document_task(file_id: int):
         metadata = [
             {
                 "file_id": file.id,
+                "org_id": file.org_id,
                 "file_name": file.original_filename,
                 "page": chunk.page_number,
                 "heading": chunk.heading
@@ -138,7 +144,7 @@ def process_document_task(file_id: int):
         ]
         
         try:
-            asyncio.run(vector_service.add_vectors(chunk_ids, embeddings, metadata))
+            asyncio.run(vector_service.add_vectors(chunk_ids, embeddings, metadata, namespace=namespace))
             print(f"向量存储完成")
         except Exception as e:
             file.status = FileStatus.FAILED
@@ -0,0 +1,333 @@
+"""
+向量索引维护任务
+"""
+
+import asyncio
+
+import numpy as np
+
+from app.tasks.celery_app import celery_app
+from app.models.file import File
+from app.database.session import SessionLocal
+from app.services.vector_service import VectorService
+from app.services.vector_index_manager import vector_index_manager, get_index_type
+from app.services.vector_write_queue import vector_write_queue
+from app.config import settings
+
+
+@celery_app.task(name="rebuild_vector_index")
+def rebuild_vector_index_task(index_type: str = None, name: str = "default"):
+    """
+    将向量索引重建为指定类型（如 Flat -> IVF / HNSW）
+    
+    Args:
+        index_type: 目标索引类型，默认使用 VECTOR_INDEX_TYPE
+        name: 索引名称
+    """
+    
+    index_type = index_type or settings.VECTOR_INDEX_TYPE
+    
+    try:
+        entry = vector_index_manager.get(name, force_check=True)
+        
+        with vector_index_manager.write_lock(entry) as entry:
+            old_type = get_index_type(entry.index)
+            vector_index_manager.migrate(entry, index_type)
+            vector_index_manager.save(entry)
+            new_type = get_index_type(entry.index)
+        
+        print(f"向量索引重建完成: {old_type} -> {new_type}，共 {entry.index.ntotal} 个向量")
+        
+        return {"from": old_type, "to": new_type, "ntotal": entry.index.ntotal}
+        
+    except Exception as e:
+        print(f"重建向量索引时发生错误: {str(e)}")
+
+
+@celery_app.task(name="partition_vector_index")
+def partition_vector_index_task():
+    """
+    将分区前写入 default 索引的向量按组织拆分到各自分区
+    
+    已删除文件（数据库中不存在）的向量直接丢弃；写入时跳过组织分区中已存在的 chunk_id，
+    中途失败后重新执行不会产生重复向量。拆分完成前检索会同时搜索组织分区和 default
+    """
+    
+    db = SessionLocal()
+    
+    try:
+        entry = vector_index_manager.get("default", force_check=True)
+        
+        with vector_index_manager.write_lock(entry) as entry:
+            if not entry.metadata_store:
+                print("default 索引为空，无需拆分")
+                return
+            
+            vector_index_manager.ensure_id_map(entry)
+            
+            store = entry.metadata_store
+            rows = store.live_ids()
+            row_file_ids = store.columns["file_id"][rows]
+            file_ids = np.unique(row_file_ids).tolist()
+            file_orgs = dict(
+                db.query(File.id, File.org_id).filter(File.id.in_(file_ids)).all()
+            )
+            
+            # 按组织分组（行号升序，保持原有写入顺序）
+            groups = {}
+            for file_id, org_id in file_orgs.items():
+                groups.setdefault(org_id, []).append(file_id)
+            groups = {
+                org_id: rows[np.isin(row_file_ids, org_file_ids)]
+                for org_id, org_file_ids in groups.items()
+            }
+            
+            # 按 org_id（及分片时的 file_id）写入对应分区
+            vector_service = VectorService()
+            for org_id, org_rows in groups.items():
+                metadata = [store[row] for row in org_rows.tolist()]
+                asyncio.run(vector_service._add_faiss(
+                    [meta["chunk_id"] for meta in metadata],
+                    entry.raw_vectors.get(org_rows),
+                    [{**meta, "org_id": org_id} for meta in metadata],
+                    skip_existing=True
+                ))
+            
+            # 清空 default 索引
+            vector_index_manager.clear(entry)
+            vector_index_manager.save(entry)
+            
+            docs_partition = VectorService.docs_partition_name("default")
+            if vector_index_manager.exists(docs_partition):
+                docs_entry = vector_index_manager.get(docs_partition, force_check=True)
+                vector_index_manager.clear(docs_entry)
+                vector_index_manager.save(docs_entry)
+        
+        moved = sum(len(rows) for rows in groups.values())
+        print(f"向量索引拆分完成: {moved} 个向量写入 {len(groups)} 个组织分区")
+        
+        return {"moved": moved, "partitions": len(groups)}
+        
+    except Exception as e:
+        print(f"拆分向量索引时发生错误: {str(e)}")
+    
+    finally:
+        db.close()
+
+
+@celery_app.task(name="build_document_vectors")
+def build_document_vectors_task():
+    """
+    为所有分区重建文档级向量（开启 VECTOR_HIERARCHICAL_SEARCH 后回填已有数据）
+    """
+    
+    vector_service = VectorService()
+    built = {}
+    
+    for partition in vector_index_manager.list_partitions():
+        if VectorService.is_docs_partition(partition) or not vector_index_manager.exists(partition):
+            continue
+        try:
+            built[partition] = vector_service.rebuild_document_index(partition)
+            print(f"分区 {partition} 文档级向量构建完成: {built[partition]} 个文件")
+        except Exception as e:
+            print(f"构建分区 {partition} 文档级向量时发生错误: {str(e)}")
+    
+    return {"built": built}
+
+
+@celery_app.task(name="fit_embedding_pca")
+def fit_embedding_pca_task(dimension: int = None, sample_size: int = None):
+    """
+    用 embedding 缓存中的语料向量训练 PCA 投影（EMBEDDING_REDUCTION=pca 时使用）
+    
+    新投影生效后需要重新 embedding 并重建索引，否则新旧向量不在同一空间
+    """
+    
+    from app.services.dimension_reducer import DimensionReducer
+    from app.services.embedding_cache import embedding_cache
+    from app.services.embedding_service import EmbeddingService
+    
+    dimension = dimension or settings.EMBEDDING_REDUCED_DIMENSION
+    sample_size = sample_size or settings.EMBEDDING_PCA_SAMPLE_SIZE
+    model = EmbeddingService().cache_model
+    
+    try:
+        vectors = embedding_cache.sample(model, sample_size)
+        if len(vectors) <= dimension:
+            return {"status": "skipped", "reason": f"样本数不足: {len(vectors)}"}
+        
+        reducer, explained = DimensionReducer.fit_pca(vectors, dimension)
+        reducer.save(settings.EMBEDDING_PCA_PATH)
+        print(f"PCA 投影训练完成: {vectors.shape[1]} -> {dimension} 维，保留方差 {explained:.2%}，样本 {len(vectors)}")
+        return {
+            "status": "success",
+            "samples": len(vectors),
+            "dimension": dimension,
+            "explained_variance": explained
+        }
+    except Exception as e:
+        print(f"训练 PCA 投影时发生错误: {str(e)}")
+
+
+@celery_app.task(name="reembed_organization")
+def reembed_organization_task(migration_id: int):
+    """
+    用新 embedding 模型回填组织的影子索引
+    
+    每次处理 EMBEDDING_MIGRATION_BATCHES_PER_TASK 批后重新入队，worker 中断后再次触发即从游标继续
+    """
+    
+    from app.services.embedding_migration import embedding_migration_service
+    
+    try:
+        result = embedding_migration_service.run_batches(migration_id)
+        print(f"模型切换 {migration_id} 回填进度: {result}")
+        
+        if result["status"] == "building":
+            reembed_organization_task.delay(migration_id)
+        return result
+        
+    except Exception as e:
+        print(f"回填影子索引时发生错误: {str(e)}")
+
+
+@celery_app.task(name="cutover_embedding_migration")
+def cutover_embedding_migration_task(migration_id: int):
+    """
+    把组织切换到新 embedding 模型
+    
+    切换后等各进程的路由缓存过期，再补写切换瞬间仍按旧模型写入的分块
+    """
+    
+    from app.services.embedding_migration import embedding_migration_service
+    
+    try:
+        migration = embedding_migration_service.cutover(migration_id)
+        reconcile_embedding_migration_task.apply_async(
+            (migration_id,), countdown=settings.EMBEDDING_ROUTE_CACHE_TTL * 2
+        )
+        return {"status": migration.status, "org_id": migration.org_id}
+        
+    except Exception as e:
+        print(f"切换 embedding 模型时发生错误: {str(e)}")
+
+
+@celery_app.task(name="reconcile_embedding_migration")
+def reconcile_embedding_migration_task(migration_id: int):
+    """
+    补齐影子索引中缺失的分块
+    """
+    
+    from app.services.embedding_migration import embedding_migration_service
+    
+    try:
+        return {"written": embedding_migration_service.reconcile(migration_id)}
+        
+    except Exception as e:
+        print(f"补齐影子索引时发生错误: {str(e)}")
+
+
+@celery_app.task(name="compact_vector_indexes")
+def compact_vector_indexes_task(force: bool = False):
+    """
+    压缩向量索引（定期任务）
+    
+    已删除向量比例超过 VECTOR_COMPACTION_THRESHOLD 的分区会用存活向量重建索引，
+    并回收原始向量文件中的空间
+    
+    Args:
+        force: 是否忽略阈值强制压缩所有分区
+    """
+    
+    compacted = []
+    
+    for partition in vector_index_manager.list_partitions():
+        try:
+            entry = vector_index_manager.get(partition, force_check=True)
+            
+            with vector_index_manager.write_lock(entry) as entry:
+                if not force and not vector_index_manager.needs_compaction(entry):
+                    continue
+                
+                ratio = entry.garbage_ratio()
+                vector_index_manager.compact(entry)
+                vector_index_manager.save(entry)
+            
+            print(f"分区 {partition} 压缩完成，回收比例 {ratio:.2%}，剩余 {entry.index.ntotal} 个向量")
+            compacted.append(partition)
+            
+        except Exception as e:
+            print(f"压缩分区 {partition} 时发生错误: {str(e)}")
+    
+    return {"compacted": compacted}
+
+
+@celery_app.task(name="checkpoint_vector_indexes")
+def checkpoint_vector_indexes_task():
+    """
+    将向量索引的预写日志合并为新快照（定期任务）
+    
+    缩短进程启动时的日志重放时间，并清理已合并的日志段
+    """
+    
+    checkpointed = []
+    
+    for partition in vector_index_manager.list_partitions():
+        try:
+            entry = vector_index_manager.get(partition, force_check=True)
+            
+            with vector_index_manager.write_lock(entry) as entry:
+                if entry.applied_lsn <= entry.checkpoint_lsn:
+                    continue
+                vector_index_manager.save(entry)
+            
+            checkpointed.append(partition)
+            
+        except Exception as e:
+            print(f"分区 {partition} 检查点失败: {str(e)}")
+    
+    if checkpointed:
+        print(f"向量索引检查点完成: {', '.join(checkpointed)}")
+    
+    return {"checkpointed": checkpointed}
+
+
+@celery_app.task(name="apply_vector_writes")
+def apply_vector_writes_task():
+    """
+    提交写入队列中的向量添加 / 删除操作（仅在 index_writer 队列上以单并发运行）
+    
+    每批最多 VECTOR_WRITE_BATCH_SIZE 个操作合并提交，成功后才从队列移除；
+    整批失败时逐个重试，仍失败的操作转入失败队列，避免阻塞后续写入
+    """
+    
+    vector_write_queue.begin_drain()
+    vector_service = VectorService()
+    applied = failed = 0
+    
+    while True:
+        ops = vector_write_queue.peek(settings.VECTOR_WRITE_BATCH_SIZE)
+        if not ops:
+            break
+        
+        try:
+            asyncio.run(vector_service.apply_write_ops(ops))
+            applied += len(ops)
+        except Exception as e:
+            print(f"批量提交向量写入失败，逐个重试: {str(e)}")
+            for op in ops:
+                try:
+                    asyncio.run(vector_service.apply_write_ops([op]))
+                    applied += 1
+                except Exception as op_error:
+                    print(f"向量写入操作 {op['op']} 提交失败: {str(op_error)}")
+                    vector_write_queue.dead_letter(op)
+                    failed += 1
+        
+        vector_write_queue.ack(len(ops))
+    
+    if applied or failed:
+        print(f"向量写入提交完成: 成功 {applied} 个，失败 {failed} 个")
+    
+    return {"applied": applied, "failed": failed}
@@ -157,7 +157,9 @@ def incremental_update_chunks(
             # 已存在的chunk（可能需要更新元数据）
             old_chunk = old_chunks_dict[text_hash]
             if (old_chunk.page_number != chunk_data.get("metadata", {}).get("page") or
-                old_chunk.heading != chunk_data.get("metadata", {}).get("heading")):
+                old_chunk.heading != chunk_data.get("metadata", {}).get("heading") or
+                old_chunk.start_offset != chunk_data.get("start_offset") or
+                old_chunk.end_offset != chunk_data.get("end_offset")):
                 chunks_to_update.append((old_chunk, chunk_data))
     
     # 找出需要删除的chunks
@@ -180,7 +182,7 @@ def incremental_update_chunks(
         old_chunk_ids = [chunk.chunk_id for chunk in old_chunks]
         if old_chunk_ids:
             import asyncio
-            asyncio.run(vector_service.delete_vectors(old_chunk_ids))
+            asyncio.run(vector_service.delete_vectors(old_chunk_ids, org_id=file.org_id))
         
         # 添加所有新chunks
         add_new_chunks(db, file, new_chunks)
@@ -193,7 +195,7 @@ def incremental_update_chunks(
         if chunks_to_delete:
             delete_chunk_ids = [chunk.chunk_id for chunk in chunks_to_delete]
             import asyncio
-            asyncio.run(vector_service.delete_vectors(delete_chunk_ids))
+            asyncio.run(vector_service.delete_vectors(delete_chunk_ids, org_id=file.org_id))
             
             for chunk in chunks_to_delete:
                 db.delete(chunk)
@@ -202,6 +204,8 @@ def incremental_update_chunks(
         for old_chunk, new_data in chunks_to_update:
             old_chunk.page_number = new_data.get("metadata", {}).get("page")
             old_chunk.heading = new_data.get("metadata", {}).get("heading")
+            old_chunk.start_offset = new_data.get("start_offset")
+            old_chunk.end_offset = new_data.get("end_offset")
             old_chunk.metadata = new_data.get("metadata", {})
         
         # 3. 添加新chunks
@@ -217,7 +221,7 @@ def add_new_chunks(db: Session, file: File, chunk_data_list: list):
     
     import uuid
     import asyncio
-    from app.services.embedding_service import EmbeddingService
+    from app.services.embedding_migration import embedding_router
     from app.services.vector_service import VectorService
     
     # 创建chunk记录
@@ -234,6 +238,8 @@ def add_new_chunks(db: Session, file: File, chunk_data_list: list):
             page_number=chunk_data.get("metadata", {}).get("page"),
             heading=chunk_data.get("metadata", {}).get("heading"),
             token_count=chunk_data.get("token_count"),
+            start_offset=chunk_data.get("start_offset"),
+            end_offset=chunk_data.get("end_offset"),
             metadata=chunk_data.get("metadata", {}),
             is_embedded=0
         )
@@ -244,9 +250,12 @@ def add_new_chunks(db: Session, file: File, chunk_data_list: list):
     db.flush()  # 获取ID
     
     # 生成embeddings
-    embedding_service = EmbeddingService()
+    # 组织已切换 embedding 模型时使用新模型和对应的索引
+    embedding_service, namespace = embedding_router.resolve(file.org_id)
     texts = [chunk.text for chunk in chunk_records]
-    embeddings = asyncio.run(embedding_service.embed_batch(texts))
+    embeddings = asyncio.run(embedding_service.embed_batch(
+        texts, [chunk.text_hash for chunk in chunk_records]
+    ))
     
     # 存储到向量数据库
     vector_service = VectorService()
@@ -254,6 +263,7 @@ def add_new_chunks(db: Session, file: File, chunk_data_list: list):
     metadata = [
         {
             "file_id": file.id,
+            "org_id": file.org_id,
             "file_name": file.original_filename,
             "page": chunk.page_number,
             "heading": chunk.heading
@@ -261,7 +271,7 @@ def add_new_chunks(db: Session, file: File, chunk_data_list: list):
         for chunk in chunk_records
     ]
     
-    asyncio.run(vector_service.add_vectors(chunk_ids, embeddings, metadata))
+    asyncio.run(vector_service.add_vectors(chunk_ids, embeddings, metadata, namespace=namespace))
     
     # 更新chunk状态
     for chunk in chunk_records:
@@ -0,0 +1,15 @@
+-- 004_add_embedding_cache.sql
+-- 添加按内容寻址的 embedding 缓存表
+
+CREATE TABLE IF NOT EXISTS embedding_cache (
+    model VARCHAR(200) NOT NULL,          -- 提供商:模型名:维度
+    text_hash VARCHAR(64) NOT NULL,       -- 分块文本的 sha256，与 chunks.text_hash 一致
+    dimension INTEGER NOT NULL,
+    embedding BYTEA NOT NULL,             -- float32 原始字节
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    PRIMARY KEY (model, text_hash)
+);
+
+CREATE INDEX IF NOT EXISTS idx_embedding_cache_created ON embedding_cache(created_at);
+
+COMMENT ON TABLE embedding_cache IS '按 (模型, 文本哈希) 缓存的 embedding，重新上传或新版本文档中未变化的分块直接复用';
@@ -0,0 +1,28 @@
+-- 005_add_embedding_migrations.sql
+-- 添加 embedding 模型切换（影子索引）进度表
+
+CREATE TABLE IF NOT EXISTS embedding_migrations (
+    id SERIAL PRIMARY KEY,
+    org_id INTEGER NOT NULL REFERENCES organizations(id) ON DELETE CASCADE,
+    
+    -- 目标模型
+    provider VARCHAR(50) NOT NULL,
+    model VARCHAR(200) NOT NULL,
+    dimension INTEGER NOT NULL,           -- 模型输出维度
+    
+    -- 进度
+    status VARCHAR(20) NOT NULL DEFAULT 'building',  -- building, ready, active, retired, cancelled
+    last_chunk_id INTEGER NOT NULL DEFAULT 0,        -- 回填游标（chunks.id）
+    processed_chunks INTEGER NOT NULL DEFAULT 0,
+    total_chunks INTEGER NOT NULL DEFAULT 0,
+    error_message TEXT,
+    
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE,
+    activated_at TIMESTAMP WITH TIME ZONE
+);
+
+CREATE INDEX IF NOT EXISTS idx_embedding_migrations_org ON embedding_migrations(org_id);
+CREATE INDEX IF NOT EXISTS idx_embedding_migrations_status ON embedding_migrations(status);
+
+COMMENT ON TABLE embedding_migrations IS '按组织切换 embedding 模型：后台回填影子索引，切换前查询继续使用旧索引';
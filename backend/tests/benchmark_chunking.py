@@ -0,0 +1,71 @@
+"""
+按句切片 CPU 基准
+对比逐句编码（旧实现）与整篇编码一次的切片耗时
+
+用法：
+    python -m tests.benchmark_chunking --sentences 5000 --repeat 5
+"""
+
+import argparse
+import re
+import time
+
+from tests.benchmark_embedding import make_texts
+
+
+def legacy_chunk_by_sentences(service, text: str) -> list:
+    """旧实现：每句单独计算 token 数，每次换块时重新编码末尾的句子计算重叠"""
+    sentences = re.split(r'([。！？\.!?])', text)
+    sentences = [''.join(i) for i in zip(sentences[0::2], sentences[1::2])]
+
+    chunks, current_chunk, current_tokens = [], [], 0
+    for sentence in sentences:
+        sentence_tokens = service.count_tokens(sentence)
+        if current_tokens + sentence_tokens > service.chunk_size and current_chunk:
+            chunks.append(''.join(current_chunk))
+            overlap_sentences, overlap_tokens = [], 0
+            for s in reversed(current_chunk):
+                s_tokens = service.count_tokens(s)
+                if overlap_tokens + s_tokens <= service.chunk_overlap:
+                    overlap_sentences.insert(0, s)
+                    overlap_tokens += s_tokens
+                else:
+                    break
+            current_chunk, current_tokens = overlap_sentences, overlap_tokens
+        current_chunk.append(sentence)
+        current_tokens += sentence_tokens
+    if current_chunk:
+        chunks.append(''.join(current_chunk))
+    return chunks
+
+
+def timed(fn, repeat: int) -> float:
+    """重复执行取最短 CPU 时间"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.process_time()
+        fn()
+        best = min(best, time.process_time() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按句切片 CPU 基准")
+    parser.add_argument("--sentences", type=int, default=5000, help="文档中的段落数")
+    parser.add_argument("--repeat", type=int, default=5)
+    options = parser.parse_args()
+
+    from app.services.chunking_service import ChunkingService
+
+    service = ChunkingService()
+    text = "".join(make_texts(options.sentences))
+
+    legacy = timed(lambda: legacy_chunk_by_sentences(service, text), options.repeat)
+    current = timed(lambda: service.chunk_by_sentences(text), options.repeat)
+    print(f"文档 {len(text)} 字符，chunk_size={service.chunk_size}，chunk_overlap={service.chunk_overlap}")
+    print(f"逐句编码   {legacy * 1000:>9.1f} ms")
+    print(f"单次编码   {current * 1000:>9.1f} ms  ({legacy / current:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+向量降维召回率基准
+以完整维度的精确检索结果为基准，比较截断 / PCA 降到不同维度后的 recall@k 和每个向量的存储大小
+
+用法：
+    python -m tests.benchmark_dimension --partition default --dims 128,256,384,768
+    python -m tests.benchmark_dimension --vectors corpus.npy --method pca
+    python -m tests.benchmark_dimension            # 无数据时使用合成的低秩向量
+"""
+
+import argparse
+
+import numpy as np
+
+
+def load_vectors(options) -> np.ndarray:
+    """读取语料向量：.npy 文件、已有索引分区的原始向量，或合成数据"""
+    if options.vectors:
+        return np.load(options.vectors).astype(np.float32)
+    if options.partition:
+        from app.services.vector_index_manager import vector_index_manager
+        return np.asarray(vector_index_manager.get(options.partition).raw_vectors.all(), dtype=np.float32)
+
+    # 合成数据：方差集中在少数方向上，接近真实 embedding 的谱分布
+    rng = np.random.default_rng(0)
+    scales = 1.0 / np.arange(1, options.full_dim + 1) ** 0.7
+    basis = np.linalg.qr(rng.normal(size=(options.full_dim, options.full_dim)))[0]
+    return ((rng.normal(size=(options.n, options.full_dim)) * scales) @ basis).astype(np.float32)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+
+
+def top_k(corpus: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """余弦相似度精确检索"""
+    scores = normalize(queries) @ normalize(corpus).T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def recall(truth: np.ndarray, found: np.ndarray) -> float:
+    k = truth.shape[1]
+    return float(np.mean([len(set(t) & set(f)) / k for t, f in zip(truth, found)]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="向量降维召回率基准")
+    parser.add_argument("--vectors", default=None, help="语料向量 .npy 文件")
+    parser.add_argument("--partition", default=None, help="读取已有 FAISS 分区的原始向量")
+    parser.add_argument("--n", type=int, default=20000, help="合成数据的向量数")
+    parser.add_argument("--full-dim", type=int, default=1536, help="合成数据的维度")
+    parser.add_argument("--dims", default="64,128,256,384,512,768")
+    parser.add_argument("--method", default="pca,truncate")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=10)
+    options = parser.parse_args()
+
+    from app.services.dimension_reducer import DimensionReducer
+
+    vectors = load_vectors(options)
+    rng = np.random.default_rng(1)
+    order = rng.permutation(len(vectors))
+    queries, corpus = vectors[order[:options.queries]], vectors[order[options.queries:]]
+    truth = top_k(corpus, queries, options.k)
+    full_dim = vectors.shape[1]
+    print(f"语料 {len(corpus)} 条，查询 {len(queries)} 条，完整维度 {full_dim}，recall@{options.k}")
+
+    for method in options.method.split(","):
+        for dim in sorted(int(d) for d in options.dims.split(",")):
+            if dim >= full_dim:
+                continue
+            if method == "pca":
+                # 只用语料训练，查询不参与
+                reducer, explained = DimensionReducer.fit_pca(corpus, dim)
+                note = f"  保留方差 {explained:.2%}"
+            else:
+                reducer, note = DimensionReducer("truncate", dim), ""
+            found = top_k(reducer.transform(corpus), reducer.transform(queries), options.k)
+            print(
+                f"{method:<9} {dim:>5} 维  recall={recall(truth, found):.4f}  "
+                f"{dim * 4:>5} 字节/向量 ({dim / full_dim:.0%}){note}"
+            )
+
+
+if __name__ == "__main__":
+    main()
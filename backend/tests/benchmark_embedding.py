@@ -0,0 +1,73 @@
+"""
+本地 embedding 吞吐基准
+对比 PyTorch、ONNX fp32 与 ONNX int8 的每秒处理文本数，以及与 PyTorch 输出的余弦相似度
+
+用法：
+    python -m tests.benchmark_embedding --model all-MiniLM-L6-v2 --texts 1024
+"""
+
+import argparse
+import random
+import tempfile
+import time
+
+import numpy as np
+
+
+SAMPLE_SENTENCES = [
+    "员工请假需提前三个工作日在系统中提交申请，并由直属主管审批。",
+    "差旅费用报销需在出差结束后十五日内提交，附上发票和行程单。",
+    "The quarterly report summarizes revenue, operating costs and headcount changes.",
+    "年休假天数根据累计工作年限确定，满一年不满十年的为五天。",
+    "All production deployments must be approved in the change management system.",
+    "新员工入职第一周需要完成信息安全培训和岗位培训。",
+]
+
+
+def make_texts(n: int, seed: int = 0) -> list:
+    """生成长度不一的测试文本"""
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(SAMPLE_SENTENCES, k=rng.randint(1, 6))) for _ in range(n)]
+
+
+def run(name: str, encode, texts: list, batch_size: int, reference: np.ndarray = None) -> np.ndarray:
+    """预热一次后计时，打印吞吐和与参考输出的余弦相似度"""
+    encode(texts[:batch_size], batch_size=batch_size)
+    start = time.perf_counter()
+    embeddings = np.asarray(encode(texts, batch_size=batch_size), dtype=np.float32)
+    elapsed = time.perf_counter() - start
+
+    line = f"{name:<12} {len(texts) / elapsed:>10.1f} texts/s  ({elapsed:.2f}s)"
+    if reference is not None:
+        a = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        b = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+        cosine = (a * b).sum(axis=1)
+        line += f"  cosine vs pytorch: mean={cosine.mean():.5f} min={cosine.min():.5f}"
+    print(line)
+    return embeddings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 embedding 吞吐基准")
+    parser.add_argument("--model", default="all-MiniLM-L6-v2")
+    parser.add_argument("--texts", type=int, default=1024)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--cache-dir", default=None, help="ONNX 导出目录，默认使用临时目录")
+    options = parser.parse_args()
+
+    from sentence_transformers import SentenceTransformer
+    from app.services.onnx_embedding import OnnxEmbeddingModel
+
+    texts = make_texts(options.texts)
+    cache_dir = options.cache_dir or tempfile.mkdtemp(prefix="onnx_bench_")
+
+    pytorch = SentenceTransformer(options.model, device="cpu")
+    reference = run("pytorch", pytorch.encode, texts, options.batch_size)
+
+    for name, quantize in [("onnx-fp32", False), ("onnx-int8", True)]:
+        model = OnnxEmbeddingModel(options.model, cache_dir=cache_dir, quantize=quantize)
+        run(name, model.encode, texts, options.batch_size, reference)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+切片服务 - 单元测试
+使用离线构造的字节级 BPE 编码（一个中文字符拆为多个 token），不下载 cl100k_base
+"""
+
+import pytest
+import tiktoken
+
+from app.config import settings
+
+
+def _offline_encoding():
+    """字节级编码，另加几个合并规则"""
+    ranks = {bytes([i]): i for i in range(256)}
+    for merged in [b"th", b"he", b"the", b"in", b"ing"]:
+        ranks[merged] = len(ranks)
+    return tiktoken.Encoding(
+        name="offline_test",
+        pat_str=r"""\s?\w+|\s?[^\w\s]+|\s+""",
+        mergeable_ranks=ranks,
+        special_tokens={}
+    )
+
+
+@pytest.fixture
+def chunker(monkeypatch):
+    from app.services import chunking_service
+
+    encoding = _offline_encoding()
+    monkeypatch.setattr(chunking_service.tiktoken, "get_encoding", lambda name: encoding)
+    monkeypatch.setattr(settings, "CHUNK_SIZE", 40)
+    monkeypatch.setattr(settings, "CHUNK_OVERLAP", 12)
+    return chunking_service.ChunkingService()
+
+
+TEXT = (
+    "员工请假需提前三个工作日提交申请。The thing is being tested! "
+    "年休假天数根据累计工作年限确定。Short one. 差旅费用报销需在十五日内提交？最后一句没有句号"
+)
+
+
+class TestSentenceChunking:
+    """测试单次编码的按句切片"""
+
+    def test_offsets_match_source(self, chunker):
+        """切片文本即原文的字符区间，token 数与区间内的编码一致"""
+        chunks = chunker.chunk_by_sentences(TEXT, {"page": 1})
+        assert len(chunks) > 2
+
+        for chunk in chunks:
+            assert chunk["text"] == TEXT[chunk["start_offset"]:chunk["end_offset"]]
+            assert chunk["token_count"] == chunk["token_end"] - chunk["token_start"]
+            assert chunk["token_count"] == chunker.count_tokens(chunk["text"])
+            assert chunk["metadata"] == {"page": 1}
+
+        # 覆盖全文，句号之后的剩余文本也保留
+        assert chunks[0]["start_offset"] == 0
+        assert chunks[-1]["end_offset"] == len(TEXT)
+        assert chunks[-1]["text"].endswith("最后一句没有句号")
+
+    def test_sentence_boundaries_and_overlap(self, chunker):
+        """切片在句子边界处断开，相邻切片的重叠不超过 chunk_overlap 且不回退"""
+        text = TEXT + "".join(f" No. {i}." for i in range(10))
+        chunks = chunker.chunk_by_sentences(text)
+        sentence_ends = {0, len(text)} | {i + 1 for i, c in enumerate(text) if c in "。！？.!?"}
+
+        overlaps = []
+        for prev, chunk in zip(chunks, chunks[1:]):
+            assert chunk["start_offset"] in sentence_ends
+            assert prev["end_offset"] in sentence_ends
+            assert prev["start_offset"] < chunk["start_offset"] <= prev["end_offset"]
+            overlaps.append(prev["token_end"] - chunk["token_start"])
+        assert 0 < max(overlaps) <= settings.CHUNK_OVERLAP
+
+        # 只有单句超长时切片才会超过 chunk_size
+        for chunk in chunks:
+            if chunk["token_count"] > settings.CHUNK_SIZE:
+                assert not any(chunk["start_offset"] < end < chunk["end_offset"] for end in sentence_ends)
+
+    def test_encodes_once(self, chunker):
+        """整篇文本只编码一次"""
+        class SpyEncoding:
+            def __init__(self, inner):
+                self.inner = inner
+                self.calls = []
+
+            def encode_ordinary(self, text):
+                self.calls.append(text)
+                return self.inner.encode_ordinary(text)
+
+            def __getattr__(self, name):
+                return getattr(self.inner, name)
+
+        chunker.encoding = SpyEncoding(chunker.encoding)
+        chunker.chunk_by_sentences(TEXT * 5)
+        assert chunker.encoding.calls == [TEXT * 5]
+
+    def test_empty_text(self, chunker):
+        assert chunker.chunk_by_sentences("") == []
+        assert chunker.chunk_by_tokens("") == []
+
+    def test_token_chunks(self, chunker):
+        """按 token 切分时同样输出字符偏移，多字节字符不会被截断"""
+        chunks = chunker.chunk_by_tokens(TEXT)
+
+        assert chunks[-1]["token_end"] == chunker.count_tokens(TEXT)
+        for prev, chunk in zip(chunks, chunks[1:]):
+            assert chunk["token_start"] == prev["token_end"] - settings.CHUNK_OVERLAP
+        for chunk in chunks:
+            assert chunk["text"] == TEXT[chunk["start_offset"]:chunk["end_offset"]]
+            assert "�" not in chunk["text"]
@@ -0,0 +1,579 @@
+"""
+Embedding 服务 - 单元测试
+本地模型使用假模型替代，不加载真实权重
+"""
+
+import threading
+
+import numpy as np
+import pytest
+
+from app.config import settings
+
+
+class FakeModel:
+    """记录调用次数的假 sentence-transformers 模型"""
+
+    def __init__(self, dimension=4):
+        self.dimension = dimension
+        self.calls = []
+
+    def encode(self, texts, convert_to_numpy=True):
+        self.calls.append(list(texts))
+        return np.ones((len(texts), self.dimension), dtype=np.float32)
+
+
+@pytest.fixture
+def local_embedding(monkeypatch):
+    """本地 embedding 模式，模型加载替换为计数的假模型"""
+    from app.services.model_registry import model_registry
+
+    monkeypatch.setattr(settings, "EMBEDDING_PROVIDER", "local")
+    monkeypatch.setattr(settings, "EMBEDDING_MODEL", "fake-model")
+    monkeypatch.setattr(settings, "QUERY_EMBEDDING_CACHE_ENABLED", False)
+    loads = []
+
+    def fake_sentence_transformer(model_name):
+        def load():
+            loads.append(model_name)
+            return FakeModel()
+        return model_registry.get(f"sentence_transformer:{model_name}", load)
+
+    model_registry.clear()
+    monkeypatch.setattr(model_registry, "sentence_transformer", fake_sentence_transformer)
+    yield loads
+    model_registry.clear()
+
+
+class TestModelRegistry:
+    """测试进程级模型注册表"""
+
+    def test_concurrent_get_loads_once(self):
+        """并发获取同一模型时只加载一次"""
+        from app.services.model_registry import ModelRegistry
+
+        registry = ModelRegistry()
+        loads = []
+        barrier = threading.Barrier(8)
+
+        def loader():
+            loads.append(1)
+            return object()
+
+        def worker(results):
+            barrier.wait()
+            results.append(registry.get("model", loader))
+
+        results = []
+        threads = [threading.Thread(target=worker, args=(results,)) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert len(loads) == 1
+        assert len({id(model) for model in results}) == 1
+
+    async def test_local_embedding_reuses_model(self, local_embedding):
+        """多个 EmbeddingService 实例、多次调用共享同一个已加载模型"""
+        from app.services.embedding_service import EmbeddingService
+
+        await EmbeddingService().embed_text("问题一")
+        await EmbeddingService().embed_batch(["问题二", "问题三"])
+
+        assert local_embedding == ["fake-model"]
+
+    def test_warm_up_loads_model(self, local_embedding, monkeypatch):
+        """预热时加载模型；关闭预热时不加载"""
+        from app.services.embedding_service import warm_up_embedding_model
+
+        monkeypatch.setattr(settings, "EMBEDDING_WARMUP", False)
+        warm_up_embedding_model()
+        assert local_embedding == []
+
+        monkeypatch.setattr(settings, "EMBEDDING_WARMUP", True)
+        warm_up_embedding_model()
+        assert local_embedding == ["fake-model"]
+
+
+@pytest.fixture
+def sqlite_cache(tmp_path, monkeypatch):
+    """使用临时 SQLite 数据库的 embedding 缓存"""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from app.models.embedding_cache import EmbeddingCacheEntry
+    from app.services.embedding_cache import embedding_cache
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'cache.db'}")
+    EmbeddingCacheEntry.__table__.create(engine)
+    monkeypatch.setattr(embedding_cache, "_session_factory", sessionmaker(bind=engine))
+    monkeypatch.setattr(settings, "EMBEDDING_CACHE_ENABLED", True)
+    yield embedding_cache
+    engine.dispose()
+
+
+class TestEmbeddingCache:
+    """测试按内容寻址的 embedding 缓存"""
+
+    @staticmethod
+    def _hashes(texts):
+        import hashlib
+        return [hashlib.sha256(t.encode()).hexdigest() for t in texts]
+
+    async def test_only_changed_chunks_embedded(self, local_embedding, sqlite_cache):
+        """再次写入时只为新内容调用模型，同一批内的重复内容只计算一次"""
+        from app.services.embedding_service import EmbeddingService
+        from app.services.model_registry import model_registry
+
+        service = EmbeddingService()
+        model = model_registry.sentence_transformer(service.model)
+
+        first = ["第一段", "页眉", "第二段", "页眉"]
+        await service.embed_batch(first, self._hashes(first))
+        assert model.calls == [["第一段", "页眉", "第二段"]]
+
+        second = ["第一段", "页眉", "修改后的第二段"]
+        embeddings = await service.embed_batch(second, self._hashes(second))
+        assert model.calls[-1] == ["修改后的第二段"]
+        assert len(embeddings) == 3 and all(len(e) == model.dimension for e in embeddings)
+
+    def test_cache_keyed_by_model(self, sqlite_cache):
+        """不同模型的缓存互不影响，重复写入不报错"""
+        sqlite_cache.put_many("local:a:4", {"h1": [1.0, 2.0, 3.0, 4.0]})
+        sqlite_cache.put_many("local:a:4", {"h1": [9.0, 9.0, 9.0, 9.0]})
+
+        assert sqlite_cache.get_many("local:a:4", ["h1", "h2"]) == {"h1": [1.0, 2.0, 3.0, 4.0]}
+        assert sqlite_cache.get_many("local:b:4", ["h1"]) == {}
+
+    def test_unsupported_dialect_skips_write(self):
+        """不支持冲突忽略写入的数据库跳过缓存写入，不报错也不按 SQLite 语法写入"""
+        from types import SimpleNamespace
+        from app.services.embedding_cache import EmbeddingCache
+
+        class FakeSession:
+            executed = []
+
+            def get_bind(self):
+                return SimpleNamespace(dialect=SimpleNamespace(name="mysql"))
+
+            def execute(self, statement):
+                self.executed.append(statement)
+
+            def close(self):
+                pass
+
+        EmbeddingCache(FakeSession).put_many("local:a:4", {"h1": [1.0]})
+        assert FakeSession.executed == []
+
+
+class FakeAPIError(Exception):
+    """带 HTTP 状态码的假 API 错误"""
+
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class TestOpenAIBatching:
+    """测试 OpenAI embedding 的分批、并发与重试"""
+
+    @pytest.fixture
+    def fake_openai(self, monkeypatch):
+        """记录请求的假 OpenAI 接口，token 数按字符数计算"""
+        import asyncio
+        import openai
+        from app.services.embedding_service import EmbeddingService
+
+        monkeypatch.setattr(settings, "EMBEDDING_PROVIDER", "openai")
+        monkeypatch.setattr(settings, "OPENAI_API_KEY", "test-key")
+        monkeypatch.setattr(settings, "EMBEDDING_RETRY_BACKOFF", 0.0)
+        monkeypatch.setattr(EmbeddingService, "count_tokens", lambda self, text: len(text))
+
+        class FakeEmbedding:
+            error_status = 429
+            requests = []
+            failures = {}
+            in_flight = 0
+            max_in_flight = 0
+
+            @classmethod
+            async def acreate(cls, model, input):
+                cls.requests.append(list(input))
+                cls.in_flight += 1
+                cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+                try:
+                    await asyncio.sleep(0.01)
+                    if cls.failures.get(input[0], 0) > 0:
+                        cls.failures[input[0]] -= 1
+                        raise FakeAPIError(cls.error_status)
+                    # 返回顺序与输入相反，客户端需按 index 还原
+                    data = [{"index": i, "embedding": [float(len(t))]} for i, t in enumerate(input)]
+                    return {"data": data[::-1]}
+                finally:
+                    cls.in_flight -= 1
+
+        monkeypatch.setattr(openai, "Embedding", FakeEmbedding, raising=False)
+        return FakeEmbedding
+
+    async def test_batches_packed_by_tokens(self, fake_openai, monkeypatch):
+        """按 token 预算打包，结果顺序与输入一致，请求并发执行"""
+        from app.services.embedding_service import EmbeddingService
+
+        monkeypatch.setattr(settings, "EMBEDDING_BATCH_MAX_TOKENS", 10)
+        monkeypatch.setattr(settings, "EMBEDDING_MAX_CONCURRENCY", 2)
+        texts = ["a" * n for n in [4, 4, 4, 9, 12, 1, 1]]
+
+        embeddings = await EmbeddingService().embed_batch(texts)
+
+        assert embeddings == [[float(len(t))] for t in texts]
+        assert sorted(map(len, fake_openai.requests)) == [1, 1, 1, 2, 2]
+        assert fake_openai.max_in_flight == 2
+
+    async def test_failed_batch_retried_alone(self, fake_openai, monkeypatch):
+        """只重试失败的批次，超过重试次数后抛出异常"""
+        from app.services.embedding_service import EmbeddingService
+
+        monkeypatch.setattr(settings, "EMBEDDING_BATCH_MAX_TOKENS", 2)
+        monkeypatch.setattr(settings, "EMBEDDING_MAX_RETRIES", 2)
+        fake_openai.failures["bb"] = 2
+
+        embeddings = await EmbeddingService().embed_batch(["aa", "bb", "cc"])
+        assert embeddings == [[2.0], [2.0], [2.0]]
+        assert [r[0] for r in fake_openai.requests].count("bb") == 3
+        assert [r[0] for r in fake_openai.requests].count("aa") == 1
+
+        fake_openai.failures["cc"] = 3
+        with pytest.raises(FakeAPIError):
+            await EmbeddingService().embed_batch(["cc"])
+
+    async def test_permanent_errors_not_retried(self, fake_openai, monkeypatch):
+        """参数错误、认证失败等永久错误不重试"""
+        from app.services.embedding_service import EmbeddingService
+
+        monkeypatch.setattr(settings, "EMBEDDING_MAX_RETRIES", 3)
+        fake_openai.error_status = 400
+        fake_openai.failures["dd"] = 1
+
+        with pytest.raises(FakeAPIError):
+            await EmbeddingService().embed_batch(["dd"])
+        assert [r[0] for r in fake_openai.requests].count("dd") == 1
+
+
+class TestInferenceExecutor:
+    """测试本地推理执行器"""
+
+    async def test_event_loop_not_blocked(self, local_embedding, monkeypatch):
+        """本地推理在线程池中执行，推理期间事件循环仍可调度其他协程"""
+        import asyncio
+        import time
+        from app.services.embedding_service import EmbeddingService
+        from app.services.model_registry import model_registry
+
+        service = EmbeddingService()
+        model = model_registry.sentence_transformer(service.model)
+        original_encode = model.encode
+
+        def slow_encode(texts, convert_to_numpy=True):
+            time.sleep(0.2)
+            return original_encode(texts, convert_to_numpy=convert_to_numpy)
+
+        monkeypatch.setattr(model, "encode", slow_encode)
+
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        await service.embed_text("问题")
+        task.cancel()
+
+        assert ticks >= 5
+
+    async def test_queue_bounded_and_stats(self):
+        """超过队列上限的任务被拒绝，统计信息反映执行情况"""
+        import asyncio
+        import threading
+        from app.services.inference_executor import InferenceExecutor, InferenceQueueFullError
+
+        executor = InferenceExecutor("test", max_workers=1, max_queue=1)
+        release = threading.Event()
+
+        first = asyncio.create_task(executor.run(release.wait))
+        second = asyncio.create_task(executor.run(lambda: 2))
+        await asyncio.sleep(0.05)
+
+        with pytest.raises(InferenceQueueFullError):
+            await executor.run(lambda: 3)
+
+        release.set()
+        assert await first is True
+        assert await second == 2
+
+        stats = executor.get_stats()
+        assert stats["completed"] == 2 and stats["rejected"] == 1
+        assert stats["running"] == 0 and stats["queued"] == 0
+
+
+class TestQueryMicroBatching:
+    """测试查询向量的微批处理"""
+
+    async def test_concurrent_queries_batched(self, local_embedding, monkeypatch):
+        """并发查询合并为批量推理，凑满上限时立即发起，相同问题只计算一次"""
+        import asyncio
+        from app.services.embedding_service import EmbeddingService
+        from app.services.model_registry import model_registry
+
+        monkeypatch.setattr(settings, "EMBEDDING_MICRO_BATCH_ENABLED", True)
+        monkeypatch.setattr(settings, "EMBEDDING_MICRO_BATCH_WAIT_MS", 20.0)
+        monkeypatch.setattr(settings, "EMBEDDING_MICRO_BATCH_MAX_SIZE", 4)
+
+        questions = ["问题0", "问题1", "问题0", "问题2", "问题3", "问题4"]
+        results = await asyncio.gather(*(EmbeddingService().embed_text(q) for q in questions))
+
+        model = model_registry.sentence_transformer(EmbeddingService().model)
+        assert model.calls == [["问题0", "问题1", "问题2"], ["问题3", "问题4"]]
+        assert len(results) == 6 and all(len(r) == model.dimension for r in results)
+
+    async def test_errors_reach_every_caller(self, local_embedding, monkeypatch):
+        """批量调用失败时每个调用方都收到异常"""
+        import asyncio
+        from app.services.embedding_service import EmbeddingService
+        from app.services.model_registry import model_registry
+
+        monkeypatch.setattr(settings, "EMBEDDING_MICRO_BATCH_ENABLED", True)
+        model = model_registry.sentence_transformer(EmbeddingService().model)
+
+        def broken_encode(texts, convert_to_numpy=True):
+            raise RuntimeError("模型不可用")
+
+        monkeypatch.setattr(model, "encode", broken_encode)
+        results = await asyncio.gather(
+            *(EmbeddingService().embed_text(q) for q in ["a", "b", "c"]),
+            return_exceptions=True
+        )
+        assert all(isinstance(r, RuntimeError) for r in results)
+
+    async def test_batch_tasks_are_referenced(self, monkeypatch):
+        """进行中的批量任务由批处理器持有引用，完成后释放"""
+        import asyncio
+        from app.services.embedding_service import QueryEmbeddingBatcher
+
+        monkeypatch.setattr(settings, "EMBEDDING_MICRO_BATCH_MAX_SIZE", 2)
+        release = asyncio.Event()
+
+        async def embed_fn(texts):
+            await release.wait()
+            return [[float(len(t))] for t in texts]
+
+        batcher = QueryEmbeddingBatcher(embed_fn)
+        pending = asyncio.gather(batcher.embed("a"), batcher.embed("bb"))
+        await asyncio.sleep(0)
+        assert len(batcher._tasks) == 1
+
+        release.set()
+        assert await pending == [[1.0], [2.0]]
+        await asyncio.sleep(0)
+        assert not batcher._tasks
+
+
+class FakeRedis:
+    """只支持 get / setex 的内存 Redis"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def setex(self, key, ttl, value):
+        self.data[key] = value
+
+
+class TestQueryEmbeddingCache:
+    """测试查询向量两级缓存"""
+
+    @pytest.fixture
+    def query_cache(self, monkeypatch):
+        from app.services.query_embedding_cache import query_embedding_cache
+
+        monkeypatch.setattr(settings, "QUERY_EMBEDDING_CACHE_ENABLED", True)
+        monkeypatch.setattr(query_embedding_cache, "_redis_client", FakeRedis())
+        query_embedding_cache.clear_local()
+        yield query_embedding_cache
+        query_embedding_cache.clear_local()
+
+    async def test_repeat_question_skips_embedding(self, local_embedding, query_cache):
+        """规范化后相同的问题直接命中缓存，清空进程内缓存后从 Redis 读取"""
+        from app.services.embedding_service import EmbeddingService
+        from app.services.model_registry import model_registry
+
+        service = EmbeddingService()
+        model = model_registry.sentence_transformer(service.model)
+
+        first = await service.embed_text("如何请假？")
+        assert await service.embed_text("  如何请假? ") == first
+        assert len(model.calls) == 1
+
+        query_cache.clear_local()
+        assert await service.embed_text("如何请假？") == first
+        assert len(model.calls) == 1
+
+        stored = next(iter(query_cache.redis_client.data.values()))
+        assert len(stored) == model.dimension * 2  # float16
+
+    def test_lru_bounded(self, query_cache, monkeypatch):
+        """进程内缓存超过上限时淘汰最久未使用的问题"""
+        monkeypatch.setattr(settings, "QUERY_EMBEDDING_CACHE_SIZE", 2)
+        monkeypatch.setattr(type(query_cache), "redis_client", property(lambda self: None))
+
+        for question in ["a", "b", "c"]:
+            query_cache.set("m", question, [1.0, 2.0])
+
+        assert query_cache.get("m", "a") is None
+        assert query_cache.get("m", "c") == [1.0, 2.0]
+
+
+class TestDimensionReduction:
+    """测试向量降维（截断 / PCA）"""
+
+    def test_truncate_renormalizes(self, monkeypatch):
+        """截断保留前 k 维并重新归一化，索引维度随之变化"""
+        from app.services.dimension_reducer import get_dimension_reducer
+
+        monkeypatch.setattr(settings, "EMBEDDING_REDUCTION", "truncate")
+        monkeypatch.setattr(settings, "EMBEDDING_REDUCED_DIMENSION", 2)
+
+        reduced = get_dimension_reducer().transform([[3.0, 4.0, 5.0, 6.0]])
+        assert reduced.shape == (1, 2)
+        assert np.allclose(reduced, [[0.6, 0.8]])
+        assert settings.VECTOR_DIMENSION == 2
+
+    def test_pca_fit_and_reload(self, tmp_path, monkeypatch):
+        """低秩语料上 PCA 保留全部方差，保存后重新加载的投影结果一致"""
+        from app.services.dimension_reducer import DimensionReducer, get_dimension_reducer
+
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(200, 3)) @ rng.normal(size=(3, 16))
+        reducer, explained = DimensionReducer.fit_pca(vectors, 3)
+        assert explained > 0.999
+
+        path = str(tmp_path / "pca.npz")
+        reducer.save(path)
+        monkeypatch.setattr(settings, "EMBEDDING_REDUCTION", "pca")
+        monkeypatch.setattr(settings, "EMBEDDING_REDUCED_DIMENSION", 3)
+        monkeypatch.setattr(settings, "EMBEDDING_PCA_PATH", path)
+
+        loaded = get_dimension_reducer()
+        assert np.allclose(loaded.transform(vectors), reducer.transform(vectors), atol=1e-4)
+        assert loaded.signature == reducer.signature
+
+        # 投影后两两距离保持不变
+        projected = loaded.transform(vectors)
+        assert np.allclose(
+            np.linalg.norm(projected[0] - projected[1]),
+            np.linalg.norm(vectors[0] - vectors[1]),
+            rtol=1e-3
+        )
+
+    async def test_applied_end_to_end(self, local_embedding, sqlite_cache, monkeypatch):
+        """分块与问题向量都降维，embedding 缓存仍保存完整向量，查询缓存按降维配置区分"""
+        import hashlib
+        from app.services.embedding_service import EmbeddingService
+        from app.services.model_registry import model_registry
+        from app.services.query_embedding_cache import query_embedding_cache
+
+        monkeypatch.setattr(settings, "QUERY_EMBEDDING_CACHE_ENABLED", True)
+        monkeypatch.setattr(query_embedding_cache, "_redis_client", FakeRedis())
+        query_embedding_cache.clear_local()
+        service = EmbeddingService()
+        model = model_registry.sentence_transformer(service.model)
+
+        full = await service.embed_text("如何请假？")
+        assert len(full) == model.dimension
+
+        monkeypatch.setattr(settings, "EMBEDDING_REDUCTION", "truncate")
+        monkeypatch.setattr(settings, "EMBEDDING_REDUCED_DIMENSION", 2)
+
+        reduced = await service.embed_text("如何请假？")
+        assert len(reduced) == 2
+        assert len(model.calls) == 2
+
+        texts = ["第一段"]
+        hashes = [hashlib.sha256(t.encode()).hexdigest() for t in texts]
+        assert [len(e) for e in await service.embed_batch(texts, hashes)] == [2]
+        cached = sqlite_cache.get_many(service.cache_model, hashes)
+        assert len(cached[hashes[0]]) == model.dimension
+        query_embedding_cache.clear_local()
+
+
+@pytest.fixture(scope="module")
+def tiny_sentence_model(tmp_path_factory):
+    """本地构造的小型 BERT sentence-transformers 模型（不下载权重）"""
+    torch = pytest.importorskip("torch")
+    pytest.importorskip("onnxruntime")
+    pytest.importorskip("onnx")
+    from transformers import BertConfig, BertModel, BertTokenizerFast
+    from sentence_transformers import SentenceTransformer, models
+
+    torch.manual_seed(0)
+    base_dir = tmp_path_factory.mktemp("tiny_bert")
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+    vocab += [chr(c) for c in range(ord("a"), ord("z") + 1)] + list("如何请假报销流程年休")
+    (base_dir / "vocab.txt").write_text("\n".join(vocab), encoding="utf-8")
+    BertTokenizerFast(vocab_file=str(base_dir / "vocab.txt")).save_pretrained(str(base_dir))
+    BertModel(BertConfig(
+        vocab_size=len(vocab), hidden_size=32, num_hidden_layers=2,
+        num_attention_heads=2, intermediate_size=64, max_position_embeddings=64
+    )).save_pretrained(str(base_dir))
+
+    transformer = models.Transformer(str(base_dir), max_seq_length=32)
+    pooling = models.Pooling(transformer.get_word_embedding_dimension(), pooling_mode="mean")
+    model_dir = tmp_path_factory.mktemp("tiny_sentence_model")
+    SentenceTransformer(modules=[transformer, pooling, models.Normalize()]).save(str(model_dir))
+    return str(model_dir)
+
+
+class TestOnnxBackend:
+    """测试 ONNX Runtime 后端与 PyTorch 输出一致"""
+
+    TEXTS = ["如何请假", "报销流程", "hello world", "年休假如何请", "a", "abc def ghi jkl"]
+
+    @pytest.mark.parametrize("quantize,min_cosine", [(False, 0.9999), (True, 0.99)])
+    def test_parity_with_pytorch(self, tiny_sentence_model, tmp_path, quantize, min_cosine):
+        """fp32 与 PyTorch 几乎一致，int8 量化后余弦相似度仍接近 1"""
+        from sentence_transformers import SentenceTransformer
+        from app.services.onnx_embedding import OnnxEmbeddingModel
+
+        expected = SentenceTransformer(tiny_sentence_model, device="cpu").encode(self.TEXTS, convert_to_numpy=True)
+        actual = OnnxEmbeddingModel(tiny_sentence_model, cache_dir=str(tmp_path), quantize=quantize).encode(
+            self.TEXTS, batch_size=4
+        )
+
+        assert actual.shape == expected.shape
+        cosine = (actual * expected).sum(axis=1)
+        assert cosine.min() >= min_cosine
+
+    async def test_selected_by_provider(self, tiny_sentence_model, tmp_path, monkeypatch):
+        """EMBEDDING_PROVIDER=onnx 时本地推理使用 ONNX 模型"""
+        from app.services.embedding_service import EmbeddingService
+        from app.services.model_registry import model_registry
+        from app.services.onnx_embedding import OnnxEmbeddingModel
+
+        monkeypatch.setattr(settings, "EMBEDDING_PROVIDER", "onnx")
+        monkeypatch.setattr(settings, "EMBEDDING_MODEL", tiny_sentence_model)
+        monkeypatch.setattr(settings, "EMBEDDING_ONNX_CACHE_DIR", str(tmp_path))
+        monkeypatch.setattr(settings, "EMBEDDING_MICRO_BATCH_ENABLED", False)
+        monkeypatch.setattr(settings, "QUERY_EMBEDDING_CACHE_ENABLED", False)
+        model_registry.clear()
+
+        try:
+            embeddings = await EmbeddingService().embed_batch(self.TEXTS)
+            assert len(embeddings) == len(self.TEXTS)
+            assert any(isinstance(model_registry.get(key, lambda: None), OnnxEmbeddingModel)
+                       for key in model_registry.loaded())
+        finally:
+            model_registry.clear()
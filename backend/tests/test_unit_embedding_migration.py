@@ -0,0 +1,228 @@
+"""
+Embedding 模型切换 - 单元测试
+临时 SQLite 数据库 + 临时目录中的真实 FAISS 索引，模型使用假模型
+"""
+
+import asyncio
+import hashlib
+
+import numpy as np
+import pytest
+
+from app.config import settings
+
+
+MODEL_DIMENSIONS = {"old-model": 8, "new-model": 4}
+
+
+class HashModel:
+    """按文本哈希生成确定向量的假模型，记录处理过的文本"""
+
+    def __init__(self, dimension):
+        self.dimension = dimension
+        self.texts = []
+
+    def encode(self, texts, convert_to_numpy=True):
+        self.texts.extend(texts)
+        vectors = []
+        for text in texts:
+            seed = int(hashlib.sha256(text.encode()).hexdigest()[:8], 16)
+            vectors.append(np.random.default_rng(seed).random(self.dimension, dtype=np.float32))
+        return np.array(vectors)
+
+
+@pytest.fixture
+def migration_env(tmp_path, monkeypatch):
+    """隔离的数据库、索引目录和假模型"""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from app.database.session import Base
+    from app.models import Chunk, EmbeddingMigration, File
+    from app.services.embedding_migration import EmbeddingMigrationService, EmbeddingRouter
+    from app.services.model_registry import model_registry
+    from app.services.vector_index_manager import vector_index_manager
+
+    monkeypatch.setattr(settings, "VECTOR_DB_TYPE", "faiss")
+    monkeypatch.setattr(settings, "VECTOR_DB_PATH", str(tmp_path / "vectors"))
+    monkeypatch.setattr(settings, "EMBEDDING_PROVIDER", "local")
+    monkeypatch.setattr(settings, "EMBEDDING_MODEL", "old-model")
+    monkeypatch.setattr(settings, "EMBEDDING_DIMENSION", MODEL_DIMENSIONS["old-model"])
+    monkeypatch.setattr(settings, "VECTOR_INDEX_RELOAD_INTERVAL", 0.0)
+    monkeypatch.setattr(settings, "VECTOR_INDEX_BACKGROUND_RELOAD", False)
+    monkeypatch.setattr(settings, "VECTOR_SINGLE_WRITER", False)
+    monkeypatch.setattr(settings, "EMBEDDING_CACHE_ENABLED", False)
+    monkeypatch.setattr(settings, "QUERY_EMBEDDING_CACHE_ENABLED", False)
+    monkeypatch.setattr(settings, "EMBEDDING_MICRO_BATCH_ENABLED", False)
+    monkeypatch.setattr(settings, "EMBEDDING_MIGRATION_BATCH_SIZE", 2)
+    monkeypatch.setattr(settings, "EMBEDDING_MIGRATION_BATCH_INTERVAL", 0.0)
+
+    models = {name: HashModel(dim) for name, dim in MODEL_DIMENSIONS.items()}
+    monkeypatch.setattr(model_registry, "sentence_transformer", lambda name: models[name])
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'app.db'}")
+    Base.metadata.create_all(engine, tables=[File.__table__, Chunk.__table__, EmbeddingMigration.__table__])
+    session_factory = sessionmaker(bind=engine)
+    router = EmbeddingRouter(session_factory)
+
+    vector_index_manager.reset()
+    yield {
+        "session_factory": session_factory,
+        "router": router,
+        "service": EmbeddingMigrationService(session_factory, router),
+        "models": models
+    }
+    vector_index_manager.reset()
+    engine.dispose()
+
+
+def _add_chunks(env, texts, org_id=1, file_id=1):
+    """写入已嵌入的分块：数据库记录 + 按组织当前路由写入向量"""
+    from app.models import Chunk, File
+    from app.services.vector_service import VectorService
+
+    db = env["session_factory"]()
+    try:
+        if db.get(File, file_id) is None:
+            db.add(File(
+                id=file_id, org_id=org_id, uploaded_by=1, filename=f"{file_id}.txt",
+                original_filename=f"{file_id}.txt", file_type="txt", object_key=f"key-{file_id}", size=1
+            ))
+        chunks = [
+            Chunk(chunk_id=f"{file_id}_{text}", file_id=file_id, text=text,
+                  text_hash=hashlib.sha256(text.encode()).hexdigest(), is_embedded=1)
+            for text in texts
+        ]
+        db.add_all(chunks)
+        db.commit()
+        chunk_ids = [chunk.chunk_id for chunk in chunks]
+    finally:
+        db.close()
+
+    embedding_service, namespace = env["router"].resolve(org_id)
+    embeddings = asyncio.run(embedding_service.embed_batch(texts))
+    asyncio.run(VectorService().add_vectors(
+        chunk_ids, embeddings, [{"file_id": file_id, "org_id": org_id} for _ in texts], namespace=namespace
+    ))
+
+
+def _search(env, text, org_id=1):
+    """按组织当前路由检索，返回命中的 chunk_id"""
+    from app.services.vector_service import VectorService
+
+    embedding_service, namespace = env["router"].resolve(org_id)
+    query = asyncio.run(embedding_service.embed_text(text))
+    results = asyncio.run(VectorService().search(query, top_k=10, filters={"org_id": org_id}, namespace=namespace))
+    return [r["chunk_id"] for r in results]
+
+
+class TestEmbeddingMigration:
+    """测试影子索引回填与按组织切换"""
+
+    def test_backfill_resume_and_cutover(self, migration_env):
+        """分批回填可从游标继续且每个分块只计算一次，切换前后查询分别使用旧 / 新模型"""
+        env, service = migration_env, migration_env["service"]
+        new_model = env["models"]["new-model"]
+        _add_chunks(env, ["a", "b", "c"])
+
+        migration = service.start(1, "local", "new-model", MODEL_DIMENSIONS["new-model"])
+        assert migration.total_chunks == 3
+        new_model.texts.clear()  # 不计入 start 时的探测调用
+
+        # 每次只处理一批，模拟任务中断后重新触发
+        assert service.run_batches(migration.id, max_batches=1)["processed"] == 2
+        assert service.run_batches(migration.id, max_batches=1)["processed"] == 3
+        assert service.run_batches(migration.id, max_batches=1)["status"] == "ready"
+        assert sorted(new_model.texts) == ["a", "b", "c"]
+
+        # 切换前：查询仍使用旧模型和旧索引
+        assert env["router"].resolve(1)[1] == ""
+        assert _search(env, "a")[0] == "1_a"
+
+        # 回填完成后新增的分块在切换时补写
+        _add_chunks(env, ["d"])
+        service.cutover(migration.id)
+        assert sorted(new_model.texts) == ["a", "b", "c", "d"]
+
+        embedding_service, namespace = env["router"].resolve(1)
+        assert (embedding_service.model, namespace) == ("new-model", migration.namespace)
+        assert _search(env, "d")[0] == "1_d"
+
+        # 切换后新文档写入新索引，已有的分块不会重复计算
+        _add_chunks(env, ["e"], file_id=2)
+        assert service.reconcile(migration.id) == 0
+        assert _search(env, "e")[0] == "2_e"
+
+    def test_async_resolve_queries_off_event_loop(self, migration_env):
+        """异步解析路由时数据库查询在线程中执行，缓存命中时不再查询"""
+        import threading
+        from app.services.embedding_migration import EmbeddingRouter
+
+        session_factory = migration_env["session_factory"]
+        threads = []
+
+        def recording_factory():
+            threads.append(threading.current_thread())
+            return session_factory()
+
+        router = EmbeddingRouter(recording_factory)
+
+        async def resolve_twice():
+            return [(await router.aresolve(1))[1] for _ in range(2)]
+
+        assert asyncio.run(resolve_twice()) == ["", ""]
+        assert len(threads) == 1
+        assert threads[0] is not threading.main_thread()
+
+    def test_delete_reaches_shadow_index(self, migration_env):
+        """回填期间删除文件时影子索引中的向量一并删除"""
+        from app.services.vector_service import VectorService
+
+        env, service = migration_env, migration_env["service"]
+        _add_chunks(env, ["a", "b"])
+        migration = service.start(1, "local", "new-model", MODEL_DIMENSIONS["new-model"])
+        service.run_batches(migration.id)
+
+        asyncio.run(VectorService().delete_file_vectors(1, org_id=1))
+
+        assert VectorService().missing_chunk_ids(["1_a", "1_b"], 1, migration.namespace) == ["1_a", "1_b"]
+        assert VectorService().missing_chunk_ids(["1_a", "1_b"], 1) == ["1_a", "1_b"]
+
+    def test_cutover_with_single_writer(self, migration_env, monkeypatch):
+        """开启写入队列时回填和补写直接提交到影子索引，切换时影子索引已完整"""
+        from app.services import vector_service
+
+        env, service = migration_env, migration_env["service"]
+        _add_chunks(env, ["a", "b", "c"])
+
+        monkeypatch.setattr(settings, "VECTOR_SINGLE_WRITER", True)
+        monkeypatch.setattr(vector_service.vector_write_queue, "enqueue", lambda op: pytest.fail("不应进入写入队列"))
+        migration = service.start(1, "local", "new-model", MODEL_DIMENSIONS["new-model"])
+        service.run_batches(migration.id)
+        service.cutover(migration.id)
+
+        from app.services.vector_service import VectorService
+        assert VectorService().missing_chunk_ids(["1_a", "1_b", "1_c"], 1, migration.namespace) == []
+
+    def test_start_validates_model(self, migration_env, monkeypatch):
+        """声明的维度与模型输出不一致或开启 PCA 降维时拒绝切换"""
+        service = migration_env["service"]
+
+        with pytest.raises(ValueError):
+            service.start(1, "local", "new-model", 16)
+
+        monkeypatch.setattr(settings, "EMBEDDING_REDUCTION", "pca")
+        monkeypatch.setattr(settings, "EMBEDDING_REDUCED_DIMENSION", 2)
+        with pytest.raises(ValueError):
+            service.start(1, "local", "new-model", MODEL_DIMENSIONS["new-model"])
+
+    def test_one_pending_migration_per_org(self, migration_env):
+        """同一组织同时只能有一个未完成的切换，取消后可重新开始"""
+        service = migration_env["service"]
+
+        migration = service.start(1, "local", "new-model", 4)
+        with pytest.raises(ValueError):
+            service.start(1, "local", "new-model", 4)
+
+        assert service.cancel(migration.id)
+        assert service.run_batches(migration.id)["status"] == "cancelled"
+        assert service.start(1, "local", "new-model", 4).id != migration.id
@@ -0,0 +1,1045 @@
+"""
+向量服务 - 单元测试
+使用临时目录中的真实 FAISS 索引
+"""
+
+import pytest
+import numpy as np
+
+from app.config import settings
+
+
+DIM = 8
+
+
+@pytest.fixture
+def vector_env(tmp_path, monkeypatch):
+    """隔离的向量索引目录"""
+    from app.services.vector_index_manager import vector_index_manager
+
+    monkeypatch.setattr(settings, "VECTOR_DB_TYPE", "faiss")
+    monkeypatch.setattr(settings, "VECTOR_DB_PATH", str(tmp_path))
+    monkeypatch.setattr(settings, "EMBEDDING_DIMENSION", DIM)
+    monkeypatch.setattr(settings, "VECTOR_INDEX_RELOAD_INTERVAL", 0.0)
+    monkeypatch.setattr(settings, "VECTOR_INDEX_BACKGROUND_RELOAD", False)
+    monkeypatch.setattr(settings, "VECTOR_SINGLE_WRITER", False)
+    vector_index_manager.reset()
+    yield tmp_path
+    vector_index_manager.reset()
+
+
+def _random_vectors(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.random((n, DIM), dtype=np.float32).tolist()
+
+
+class TestSharedIndex:
+    """测试进程级共享索引"""
+
+    async def test_instances_share_loaded_index(self, vector_env):
+        """多个 VectorService 实例共享同一个内存索引"""
+        from app.services.vector_service import VectorService
+
+        writer = VectorService()
+        await writer.add_vectors(
+            ["1_a", "1_b"],
+            _random_vectors(2),
+            [{"file_id": 1}, {"file_id": 1}]
+        )
+
+        reader = VectorService()
+        assert reader._get_faiss_entry() is writer._get_faiss_entry()
+        assert reader._get_faiss_entry().index.ntotal == 2
+
+    async def test_reload_on_new_generation(self, vector_env):
+        """磁盘上出现新版本时重新加载"""
+        from app.services.vector_service import VectorService
+        from app.services.vector_index_manager import FaissIndexManager
+
+        service = VectorService()
+        before = service._get_faiss_entry()
+        assert before.index.ntotal == 0
+
+        # 模拟另一个进程写入了新版本
+        other_process = FaissIndexManager()
+        entry = other_process.get()
+        entry.index.add_with_ids(
+            np.array(_random_vectors(3), dtype=np.float32),
+            np.arange(3, dtype=np.int64)
+        )
+        other_process.save(entry)
+
+        after = service._get_faiss_entry()
+        assert after is not before
+        assert after.index.ntotal == 3
+
+    async def test_search_returns_nearest(self, vector_env):
+        """搜索返回最近的向量"""
+        from app.services.vector_service import VectorService
+
+        vectors = _random_vectors(5)
+        service = VectorService()
+        await service.add_vectors(
+            [f"1_{i}" for i in range(5)],
+            vectors,
+            [{"file_id": 1} for _ in range(5)]
+        )
+
+        results = await service.search(vectors[3], top_k=1)
+        assert results[0]["chunk_id"] == "1_3"
+
+
+class TestIndexTypes:
+    """测试 IVF / HNSW 索引类型"""
+
+    async def test_hnsw_index_created(self, vector_env, monkeypatch):
+        """配置 HNSW 时直接创建 HNSW 索引"""
+        from app.services.vector_service import VectorService
+        from app.services.vector_index_manager import get_index_type
+
+        monkeypatch.setattr(settings, "VECTOR_INDEX_TYPE", "hnsw")
+        vectors = _random_vectors(20)
+        service = VectorService()
+        await service.add_vectors(
+            [f"1_{i}" for i in range(20)],
+            vectors,
+            [{"file_id": 1} for _ in range(20)]
+        )
+
+        assert get_index_type(service._get_faiss_entry().index) == "hnsw"
+        results = await service.search(vectors[7], top_k=1, search_params={"ef_search": 16})
+        assert results[0]["chunk_id"] == "1_7"
+
+    async def test_flat_migrates_to_ivf(self, vector_env, monkeypatch):
+        """Flat 索引积累足够向量后自动迁移为 IVF，行号映射保持不变"""
+        from app.services.vector_service import VectorService
+        from app.services.vector_index_manager import get_index_type
+
+        monkeypatch.setattr(settings, "VECTOR_INDEX_MIN_TRAIN_SIZE", 100)
+        service = VectorService()
+        vectors = _random_vectors(200)
+        await service.add_vectors(
+            [f"1_{i}" for i in range(50)],
+            vectors[:50],
+            [{"file_id": 1} for _ in range(50)]
+        )
+        assert get_index_type(service._get_faiss_entry().index) == "flat"
+
+        monkeypatch.setattr(settings, "VECTOR_INDEX_TYPE", "ivf_flat")
+        await service.add_vectors(
+            [f"1_{i}" for i in range(50, 200)],
+            vectors[50:],
+            [{"file_id": 1} for _ in range(150)]
+        )
+
+        entry = service._get_faiss_entry()
+        assert get_index_type(entry.index) == "ivf_flat"
+        assert entry.index.ntotal == 200
+
+        # nprobe 覆盖全部聚类中心时结果与暴力搜索一致
+        results = await service.search(vectors[123], top_k=1, search_params={"nprobe": 1000})
+        assert results[0]["chunk_id"] == "1_123"
+
+    async def test_sq8_rerank_with_raw_vectors(self, vector_env, monkeypatch):
+        """SQ8 压缩索引使用原始向量精确重排，距离与暴力搜索一致"""
+        from app.services.vector_service import VectorService
+        from app.services.vector_index_manager import get_index_type
+
+        monkeypatch.setattr(settings, "VECTOR_INDEX_MIN_TRAIN_SIZE", 100)
+        monkeypatch.setattr(settings, "VECTOR_INDEX_TYPE", "sq8")
+        monkeypatch.setattr(settings, "VECTOR_RERANK_CANDIDATES", 20)
+
+        vectors = _random_vectors(300)
+        service = VectorService()
+        await service.add_vectors(
+            [f"1_{i}" for i in range(300)],
+            vectors,
+            [{"file_id": 1} for _ in range(300)]
+        )
+
+        entry = service._get_faiss_entry()
+        assert get_index_type(entry.index) == "sq8"
+        assert len(entry.raw_vectors) == 300
+
+        query = np.array(vectors[42], dtype=np.float32)
+        results = await service.search(query.tolist(), top_k=3)
+        assert results[0]["chunk_id"] == "1_42"
+        assert results[0]["distance"] == pytest.approx(0.0, abs=1e-6)
+
+        exact = ((np.array(vectors, dtype=np.float32) - query) ** 2).sum(axis=1)
+        expected = [f"1_{i}" for i in np.argsort(exact)[:3]]
+        assert [r["chunk_id"] for r in results] == expected
+
+    @pytest.mark.parametrize("index_type", ["flat", "sq8"])
+    async def test_search_batch_matches_single(self, vector_env, monkeypatch, index_type):
+        """批量搜索与逐个搜索结果一致（含压缩索引的精确重排）"""
+        from app.services.vector_service import VectorService
+
+        monkeypatch.setattr(settings, "VECTOR_INDEX_MIN_TRAIN_SIZE", 100)
+        monkeypatch.setattr(settings, "VECTOR_INDEX_TYPE", index_type)
+        monkeypatch.setattr(settings, "VECTOR_RERANK_CANDIDATES", 20)
+
+        vectors = _random_vectors(300)
+        service = VectorService()
+        await service.add_vectors(
+            [f"1_{i}" for i in range(300)],
+            vectors,
+            [{"file_id": 1} for _ in range(300)]
+        )
+
+        queries = _random_vectors(5, seed=1)
+        batch = await service.search_batch(queries, top_k=3)
+        assert len(batch) == 5
+        for query, results in zip(queries, batch):
+            single = await service.search(query, top_k=3)
+            assert [r["chunk_id"] for r in results] == [r["chunk_id"] for r in single]
+            assert [r["distance"] for r in results] == pytest.approx([r["distance"] for r in single])
+
+        assert await service.search_batch([], top_k=3) == []
+
+
+class TestCosineMetric:
+    """测试 cosine（归一化内积）度量"""
+
+    @pytest.mark.parametrize("index_type", ["flat", "hnsw", "sq8"])
+    async def test_cosine_scores(self, vector_env, monkeypatch, index_type):
+        """写入和查询时归一化，相似度为 0~1 的余弦值，排序与精确计算一致"""
+        from app.services.vector_service import VectorService
+        from app.services.vector_index_manager import get_metric
+
+        monkeypatch.setattr(settings, "VECTOR_METRIC", "cosine")
+        monkeypatch.setattr(settings, "VECTOR_INDEX_TYPE", index_type)
+        monkeypatch.setattr(settings, "VECTOR_INDEX_MIN_TRAIN_SIZE", 100)
+        monkeypatch.setattr(settings, "VECTOR_RERANK_CANDIDATES", 50)
+
+        vectors = np.array(_random_vectors(300), dtype=np.float32) - 0.5
+        service = VectorService()
+        await service.add_vectors(
+            [f"1_{i}" for i in range(300)],
+            vectors.tolist(),
+            [{"file_id": 1} for _ in range(300)]
+        )
+        entry = service._get_faiss_entry()
+        assert get_metric(entry.index) == "cosine"
+        assert np.linalg.norm(entry.raw_vectors.get(np.array([0])), axis=1) == pytest.approx(1.0, abs=1e-5)
+
+        # 查询向量的长度不影响结果
+        query = vectors[17] * 3
+        results = await service.search(query.tolist(), top_k=5, search_params={"ef_search": 300})
+        assert results[0]["chunk_id"] == "1_17"
+        assert results[0]["similarity"] == pytest.approx(1.0, abs=1e-3)
+
+        normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        cosine = normalized @ (query / np.linalg.norm(query))
+        expected = [f"1_{i}" for i in np.argsort(-cosine)[:5]]
+        assert [r["chunk_id"] for r in results] == expected
+        assert [r["similarity"] for r in results] == pytest.approx(
+            [max(float(c), 0.0) for c in np.sort(cosine)[::-1][:5]], abs=1e-3
+        )
+
+    async def test_min_similarity_cuts_results(self, vector_env, monkeypatch):
+        """相似度阈值在检索时过滤"""
+        from app.services.vector_service import VectorService
+
+        monkeypatch.setattr(settings, "VECTOR_METRIC", "cosine")
+        service = VectorService()
+        await service.add_vectors(
+            ["1_a", "1_b"],
+            [[1.0] + [0.0] * (DIM - 1), [0.0, 1.0] + [0.0] * (DIM - 2)],
+            [{"file_id": 1}, {"file_id": 1}]
+        )
+
+        results = await service.search([1.0, 0.1] + [0.0] * (DIM - 2), top_k=2, min_similarity=0.75)
+        assert [r["chunk_id"] for r in results] == ["1_a"]
+
+    async def test_migrate_l2_to_cosine(self, vector_env, monkeypatch):
+        """配置改为 cosine 后，下次写入时迁移索引并归一化原始向量"""
+        from app.services.vector_service import VectorService
+        from app.services.vector_index_manager import get_metric
+
+        vectors = np.array(_random_vectors(20), dtype=np.float32) * 5
+        service = VectorService()
+        await service.add_vectors(
+            [f"1_{i}" for i in range(10)], vectors[:10].tolist(), [{"file_id": 1}] * 10
+        )
+        assert get_metric(service._get_faiss_entry().index) == "l2"
+
+        monkeypatch.setattr(settings, "VECTOR_METRIC", "cosine")
+        await service.add_vectors(
+            [f"1_{i}" for i in range(10, 20)], vectors[10:].tolist(), [{"file_id": 1}] * 10
+        )
+
+        entry = service._get_faiss_entry()
+        assert get_metric(entry.index) == "cosine"
+        assert entry.index.ntotal == 20
+        norms = np.linalg.norm(entry.raw_vectors.all(), axis=1)
+        assert norms == pytest.approx(np.ones(20), abs=1e-5)
+
+        results = await service.search(vectors[3].tolist(), top_k=1)
+        assert results[0]["chunk_id"] == "1_3"
+        assert results[0]["similarity"] == pytest.approx(1.0, abs=1e-4)
+
+
+class TestPartitions:
+    """测试按组织分区"""
+
+    async def test_vectors_routed_by_org(self, vector_env):
+        """向量写入各自组织的分区，搜索只扫描本组织分区"""
+        from app.services.vector_service import VectorService
+
+        vectors = _random_vectors(4)
+        service = VectorService()
+        await service.add_vectors(
+            ["1_a", "1_b", "2_a", "2_b"],
+            vectors,
+            [
+                {"file_id": 1, "org_id": 10},
+                {"file_id": 1, "org_id": 10},
+                {"file_id": 2, "org_id": 20},
+                {"file_id": 2, "org_id": 20},
+            ]
+        )
+
+        assert service._get_faiss_entry(partition="org_10").index.ntotal == 2
+        assert service._get_faiss_entry(partition="org_20").index.ntotal == 2
+
+        # 查询 org 20 的向量，但限定在 org 10 内搜索
+        results = await service.search(vectors[2], top_k=10, filters={"org_id": 10})
+        assert {r["chunk_id"] for r in results} == {"1_a", "1_b"}
+
+    async def test_legacy_default_vectors_stay_searchable(self, vector_env):
+        """组织建立分区后，default 中尚未拆分的旧向量仍参与检索；default 清空后只搜索组织分区"""
+        from app.services.vector_index_manager import vector_index_manager
+        from app.services.vector_service import VectorService
+
+        vectors = _random_vectors(2)
+        service = VectorService()
+        await service.add_vectors(["1_old"], vectors[:1], [{"file_id": 1}])
+        await service.add_vectors(["2_new"], vectors[1:], [{"file_id": 2, "org_id": 10}])
+
+        assert service._resolve_partitions({"org_id": 10}) == ["org_10", "default"]
+        results = await service.search(vectors[0], top_k=10, filters={"org_id": 10})
+        assert [r["chunk_id"] for r in results] == ["1_old", "2_new"]
+
+        entry = vector_index_manager.get("default")
+        vector_index_manager.clear(entry)
+        vector_index_manager.save(entry)
+        assert service._resolve_partitions({"org_id": 10}) == ["org_10"]
+        assert service._resolve_partitions({"org_id": 20}) == ["default"]
+
+    def test_chroma_where_ignores_org_id(self):
+        """Chroma 不按 org_id 过滤，没有 org_id 元数据的旧向量仍可检索"""
+        from app.services.vector_service import VectorService
+
+        service = VectorService.__new__(VectorService)
+        assert service._chroma_where({"org_id": 10}) is None
+        assert service._chroma_where({"org_id": 10, "file_ids": [1, 2]}) == {"file_id": {"$in": [1, 2]}}
+
+    async def test_delete_file_vectors_in_partition(self, vector_env):
+        """按组织分区删除文件向量"""
+        from app.services.vector_service import VectorService
+
+        service = VectorService()
+        await service.add_vectors(
+            ["1_a", "2_a"],
+            _random_vectors(2),
+            [{"file_id": 1, "org_id": 10}, {"file_id": 2, "org_id": 10}]
+        )
+
+        await service.delete_file_vectors(1, org_id=10)
+
+        metadata = service._get_faiss_entry(partition="org_10").metadata_store
+        assert [m["chunk_id"] for _, m in metadata.items()] == ["2_a"]
+
+
+class TestFilterPushdown:
+    """测试搜索时按文件过滤"""
+
+    @pytest.mark.parametrize("exact_max", [0, 20000])
+    async def test_file_filter_returns_full_top_k(self, vector_env, monkeypatch, exact_max):
+        """限定文件后仍返回完整的 top_k（索引内过滤 / 原始向量精确搜索两条路径）"""
+        from app.services.vector_service import VectorService
+
+        monkeypatch.setattr(settings, "VECTOR_FILTER_EXACT_MAX", exact_max)
+        vectors = _random_vectors(100)
+        service = VectorService()
+        await service.add_vectors(
+            [f"{i % 10}_{i}" for i in range(100)],
+            vectors,
+            [{"file_id": i % 10} for i in range(100)]
+        )
+        await service.delete_vectors(["3_3"])
+
+        query = np.array(vectors[13], dtype=np.float32)
+        results = await service.search(query.tolist(), top_k=5, filters={"file_ids": [3, 7]})
+
+        allowed = [i for i in range(100) if i % 10 in (3, 7) and i != 3]
+        exact = ((np.array(vectors, dtype=np.float32)[allowed] - query) ** 2).sum(axis=1)
+        expected = [f"{allowed[i] % 10}_{allowed[i]}" for i in np.argsort(exact)[:5]]
+        assert [r["chunk_id"] for r in results] == expected
+        assert results[0]["distance"] == pytest.approx(0.0, abs=1e-5)
+
+        assert await service.search(query.tolist(), top_k=5, filters={"file_ids": []}) == []
+
+
+class TestDeletion:
+    """测试向量删除与压缩"""
+
+    @pytest.mark.parametrize("index_type", ["flat", "hnsw"])
+    async def test_delete_vectors_excluded_from_search(self, vector_env, monkeypatch, index_type):
+        """删除的向量不再出现在搜索结果中，且不占用 top-k 名额"""
+        from app.services.vector_service import VectorService
+
+        monkeypatch.setattr(settings, "VECTOR_INDEX_TYPE", index_type)
+        vectors = _random_vectors(10)
+        service = VectorService()
+        await service.add_vectors(
+            [f"1_{i}" for i in range(10)],
+            vectors,
+            [{"file_id": 1} for _ in range(10)]
+        )
+
+        await service.delete_vectors(["1_4"])
+
+        results = await service.search(vectors[4], top_k=3)
+        assert len(results) == 3
+        assert "1_4" not in [r["chunk_id"] for r in results]
+
+        entry = service._get_faiss_entry()
+        if index_type == "hnsw":
+            assert entry.tombstones == {4}
+        else:
+            assert entry.index.ntotal == 9
+
+    async def test_compaction_renumbers_ids(self, vector_env, monkeypatch):
+        """压缩后 ID 连续，原始向量文件缩小，搜索结果不变"""
+        from app.services.vector_service import VectorService
+        from app.services.vector_index_manager import vector_index_manager
+
+        monkeypatch.setattr(settings, "VECTOR_INDEX_TYPE", "hnsw")
+        vectors = _random_vectors(10)
+        service = VectorService()
+        await service.add_vectors(
+            [f"1_{i}" for i in range(5)] + [f"2_{i}" for i in range(5)],
+            vectors,
+            [{"file_id": 1} for _ in range(5)] + [{"file_id": 2} for _ in range(5)]
+        )
+        await service.delete_file_vectors(1)
+
+        entry = service._get_faiss_entry()
+        assert entry.garbage_ratio() == pytest.approx(0.5)
+        assert vector_index_manager.needs_compaction(entry)
+
+        vector_index_manager.compact(entry)
+        vector_index_manager.save(entry)
+
+        assert entry.metadata_store.live_ids().tolist() == [0, 1, 2, 3, 4]
+        assert len(entry.raw_vectors) == 5
+        assert not entry.tombstones
+
+        results = await service.search(vectors[7], top_k=1)
+        assert results[0]["chunk_id"] == "2_2"
+
+    async def test_legacy_row_index_converted(self, vector_env):
+        """旧版按行号存储的索引在首次写入时转换为 IDMap，孤立向量被丢弃"""
+        import pickle
+        import faiss
+        from app.services.vector_service import VectorService
+        from app.services.vector_index_manager import is_id_map
+
+        vectors = np.array(_random_vectors(3), dtype=np.float32)
+        legacy = faiss.IndexFlatL2(DIM)
+        legacy.add(vectors)
+        faiss.write_index(legacy, str(vector_env / "index.faiss"))
+        with open(vector_env / "metadata.pkl", "wb") as f:
+            # 行 1 已被旧版 delete_file_vectors 删除元数据
+            pickle.dump({0: {"chunk_id": "1_0", "file_id": 1}, 2: {"chunk_id": "1_2", "file_id": 1}}, f)
+
+        service = VectorService()
+        await service.add_vectors(["2_0"], _random_vectors(1, seed=1), [{"file_id": 2}])
+
+        entry = service._get_faiss_entry()
+        assert is_id_map(entry.index)
+        assert entry.index.ntotal == 3
+        assert entry.metadata_store.live_ids().tolist() == [0, 2, 3]
+
+        results = await service.search(vectors[2].tolist(), top_k=1)
+        assert results[0]["chunk_id"] == "1_2"
+
+
+class TestWriteAheadLog:
+    """测试预写日志"""
+
+    async def test_appends_do_not_rewrite_snapshot(self, vector_env):
+        """增量写入只追加日志，快照在达到阈值前不变"""
+        from app.services.vector_service import VectorService
+
+        service = VectorService()
+        await service.add_vectors(["1_0"], _random_vectors(1), [{"file_id": 1}])
+        entry = service._get_faiss_entry()
+        generation = entry.generation
+        snapshots = sorted(p.name for p in (vector_env / "snapshots").iterdir())
+
+        await service.add_vectors(["1_1", "1_2"], _random_vectors(2, seed=1), [{"file_id": 1}] * 2)
+        await service.delete_vectors(["1_0"])
+
+        assert entry.generation == generation
+        assert sorted(p.name for p in (vector_env / "snapshots").iterdir()) == snapshots
+        assert entry.applied_lsn == entry.checkpoint_lsn + 2
+
+    async def test_recovery_replays_log(self, vector_env):
+        """重新加载时在快照之上重放日志"""
+        from app.services.vector_service import VectorService
+        from app.services.vector_index_manager import FaissIndexManager
+
+        vectors = _random_vectors(3)
+        service = VectorService()
+        await service.add_vectors(["1_0"], vectors[:1], [{"file_id": 1}])
+        await service.add_vectors(["1_1", "1_2"], vectors[1:], [{"file_id": 1}] * 2)
+        await service.delete_vectors(["1_1"])
+
+        recovered = FaissIndexManager().get()
+        assert recovered.index.ntotal == 2
+        assert sorted(m["chunk_id"] for _, m in recovered.metadata_store.items()) == ["1_0", "1_2"]
+
+    async def test_reader_tails_log(self, vector_env):
+        """其他进程无需重新加载快照即可读到日志中的新增向量"""
+        from app.services.vector_service import VectorService
+        from app.services.vector_index_manager import FaissIndexManager
+
+        service = VectorService()
+        await service.add_vectors(["1_0"], _random_vectors(1), [{"file_id": 1}])
+
+        reader = FaissIndexManager()
+        before = reader.get()
+        await service.add_vectors(["1_1"], _random_vectors(1, seed=1), [{"file_id": 1}])
+
+        after = reader.get()
+        assert after is before
+        assert after.index.ntotal == 2
+
+    async def test_checkpoint_after_threshold(self, vector_env, monkeypatch):
+        """日志达到阈值后合并为新快照并清理日志段"""
+        from app.services.vector_service import VectorService
+
+        monkeypatch.setattr(settings, "VECTOR_WAL_CHECKPOINT_ROWS", 3)
+        service = VectorService()
+        await service.add_vectors(["1_0"], _random_vectors(1), [{"file_id": 1}])
+        entry = service._get_faiss_entry()
+        generation = entry.generation
+
+        await service.add_vectors(["1_1", "1_2", "1_3"], _random_vectors(3, seed=1), [{"file_id": 1}] * 3)
+
+        assert entry.generation == generation + 1
+        assert entry.checkpoint_lsn == entry.applied_lsn
+        assert list((vector_env / "wal").iterdir()) == []
+
+    async def test_torn_raw_vector_row_is_discarded(self, vector_env):
+        """原始向量文件末尾的半行在下次写入前被截掉，新向量的 ID 与行号保持对齐"""
+        from app.services.vector_service import VectorService
+        from app.services.vector_index_manager import FaissIndexManager
+
+        vectors = np.asarray(_random_vectors(2), dtype=np.float32)
+        service = VectorService()
+        await service.add_vectors(["1_0"], vectors[:1], [{"file_id": 1}])
+        with open(service._get_faiss_entry().raw_vectors.file_path, "ab") as f:
+            f.write(b"\0" * 6)
+
+        writer = FaissIndexManager()
+        entry = writer.get()
+        ids = writer.add(entry, vectors[1:], [{"chunk_id": "1_1", "file_id": 1}])
+        assert ids.tolist() == [1]
+        np.testing.assert_array_equal(entry.raw_vectors.get(ids), vectors[1:])
+
+    async def test_torn_wal_tail_is_cut_before_append(self, vector_env):
+        """日志段末尾的半条记录在追加前被截掉，之后追加的记录对新进程可见"""
+        from app.services.vector_service import VectorService
+        from app.services.vector_index_manager import FaissIndexManager
+
+        vectors = np.asarray(_random_vectors(6), dtype=np.float32)
+        service = VectorService()
+        await service.add_vectors(["1_0", "1_1"], vectors[:2], [{"file_id": 1}] * 2)
+        await service.add_vectors(["1_2", "1_3"], vectors[2:4], [{"file_id": 1}] * 2)
+
+        manager = FaissIndexManager()
+        wal = manager._wal(service._get_faiss_entry().path)
+        with open(wal._segment_path(wal.segments()[-1]), "ab") as f:
+            f.write(b"\x07" * 23)
+
+        writer = FaissIndexManager()
+        entry = writer.get()
+        with writer.write_lock(entry) as entry:
+            writer.add(entry, vectors[4:], [{"chunk_id": f"1_{i}", "file_id": 1} for i in (4, 5)])
+        assert entry.index.ntotal == 6
+
+        assert FaissIndexManager().get().index.ntotal == 6
+
+    async def test_mmap_reader_becomes_writable(self, vector_env, monkeypatch):
+        """只读内存映射加载的 IVF 快照在应用日志和写入前转为普通索引"""
+        from app.services.vector_service import VectorService
+        from app.services.vector_index_manager import FaissIndexManager, get_index_type
+
+        monkeypatch.setattr(settings, "VECTOR_INDEX_MIN_TRAIN_SIZE", 100)
+        monkeypatch.setattr(settings, "VECTOR_INDEX_TYPE", "ivf_flat")
+        vectors = _random_vectors(201)
+        service = VectorService()
+        await service.add_vectors(
+            [f"1_{i}" for i in range(200)], vectors[:200], [{"file_id": 1}] * 200
+        )
+
+        monkeypatch.setattr(settings, "VECTOR_INDEX_MMAP", True)
+        reader = FaissIndexManager()
+        entry = reader.get()
+        assert entry.mmapped
+        assert get_index_type(entry.index) == "ivf_flat"
+
+        await service.add_vectors(["1_200"], vectors[200:], [{"file_id": 1}])
+        reloaded = reader.get()
+        # 重新加载为新对象整体替换，旧对象保持不变
+        assert reloaded is not entry
+        assert entry.mmapped and entry.index.ntotal == 200
+        assert not reloaded.mmapped
+        assert reloaded.index.ntotal == 201
+
+        reader.delete(reloaded, [0])
+        assert reloaded.index.ntotal == 200
+        assert 0 not in reloaded.metadata_store
+
+
+    async def test_mmap_only_marks_ivf(self, vector_env, monkeypatch):
+        """非 IVF 索引无法内存映射，按普通加载处理，应用日志时不需要重新加载"""
+        from app.services.vector_service import VectorService
+        from app.services.vector_index_manager import FaissIndexManager, vector_index_manager
+
+        service = VectorService()
+        await service.add_vectors(["1_0"], _random_vectors(1), [{"file_id": 1}])
+        vector_index_manager.save(service._get_faiss_entry())
+
+        monkeypatch.setattr(settings, "VECTOR_INDEX_MMAP", True)
+        reader = FaissIndexManager()
+        entry = reader.get()
+        assert not entry.mmapped
+
+        await service.add_vectors(["1_1"], _random_vectors(1, seed=1), [{"file_id": 1}])
+        assert reader.get() is entry
+        assert entry.index.ntotal == 2
+
+    async def test_mmap_reader_reloads_in_background(self, vector_env, monkeypatch):
+        """查询路径上遇到新日志时，内存映射的 IVF 快照在后台转为普通加载，期间继续使用旧快照"""
+        import time
+        from app.services.vector_service import VectorService
+        from app.services.vector_index_manager import FaissIndexManager
+
+        monkeypatch.setattr(settings, "VECTOR_INDEX_MIN_TRAIN_SIZE", 100)
+        monkeypatch.setattr(settings, "VECTOR_INDEX_TYPE", "ivf_flat")
+        vectors = _random_vectors(201)
+        service = VectorService()
+        await service.add_vectors([f"1_{i}" for i in range(200)], vectors[:200], [{"file_id": 1}] * 200)
+
+        monkeypatch.setattr(settings, "VECTOR_INDEX_MMAP", True)
+        monkeypatch.setattr(settings, "VECTOR_INDEX_BACKGROUND_RELOAD", True)
+        reader = FaissIndexManager()
+        entry = reader.get()
+        assert entry.mmapped
+
+        await service.add_vectors(["1_200"], vectors[200:], [{"file_id": 1}])
+        assert reader.get() is entry
+        assert entry.mmapped and entry.index.ntotal == 200
+
+        deadline = time.monotonic() + 5
+        while reader.get() is entry and time.monotonic() < deadline:
+            time.sleep(0.01)
+        reloaded = reader.get()
+        assert reloaded is not entry
+        assert not reloaded.mmapped
+        assert reloaded.index.ntotal == 201
+
+
+class TestSnapshots:
+    """测试版本化快照与热切换"""
+
+    async def test_snapshots_published_and_pruned(self, vector_env, monkeypatch):
+        """检查点写入新的快照目录并更新 CURRENT，只保留最近的快照"""
+        import json
+        from app.services.vector_service import VectorService
+
+        monkeypatch.setattr(settings, "VECTOR_WAL_CHECKPOINT_ROWS", 1)
+        monkeypatch.setattr(settings, "VECTOR_SNAPSHOT_RETAIN", 2)
+        service = VectorService()
+        for i in range(4):
+            await service.add_vectors([f"1_{i}"], _random_vectors(1, seed=i), [{"file_id": 1}])
+
+        entry = service._get_faiss_entry()
+        assert (vector_env / "CURRENT").read_text() == str(entry.generation)
+        assert sorted(p.name for p in (vector_env / "snapshots").iterdir()) == [
+            f"gen-{g:010d}" for g in (entry.generation - 1, entry.generation)
+        ]
+        manifest = json.loads(
+            (vector_env / "snapshots" / f"gen-{entry.generation:010d}" / "manifest.json").read_text()
+        )
+        assert manifest["checkpoint_lsn"] == entry.applied_lsn
+        assert not (vector_env / "index.faiss").exists()
+
+    async def test_background_swap(self, vector_env, monkeypatch):
+        """读进程在后台加载新快照，加载完成前继续使用旧索引"""
+        import asyncio
+        from app.services.vector_service import VectorService
+        from app.services.vector_index_manager import FaissIndexManager, vector_index_manager
+
+        service = VectorService()
+        await service.add_vectors(["1_0"], _random_vectors(1), [{"file_id": 1}])
+
+        monkeypatch.setattr(settings, "VECTOR_INDEX_BACKGROUND_RELOAD", True)
+        reader = FaissIndexManager()
+        before = reader.get()
+
+        writer_entry = service._get_faiss_entry()
+        await service.add_vectors(["1_1", "1_2"], _random_vectors(2, seed=1), [{"file_id": 1}] * 2)
+        vector_index_manager.save(writer_entry)
+
+        assert reader.get() is before
+        for _ in range(100):
+            after = reader.get()
+            if after is not before:
+                break
+            await asyncio.sleep(0.02)
+        assert after is not before
+        assert after.generation == writer_entry.generation
+        assert after.index.ntotal == 3
+
+    async def test_compaction_keeps_old_snapshot_readable(self, vector_env):
+        """压缩重写原始向量到新文件，仍持有旧快照的读者结果不受影响"""
+        from app.services.vector_service import VectorService
+        from app.services.vector_index_manager import FaissIndexManager, vector_index_manager
+
+        vectors = _random_vectors(6)
+        service = VectorService()
+        await service.add_vectors([f"1_{i}" for i in range(6)], vectors, [{"file_id": 1}] * 6)
+        await service.delete_vectors(["1_0", "1_1", "1_2"])
+        entry = service._get_faiss_entry()
+        vector_index_manager.save(entry)
+
+        reader = FaissIndexManager()
+        old = reader.get()
+        old_raw = old.raw_vectors.file_name
+
+        vector_index_manager.compact(entry)
+        vector_index_manager.save(entry)
+        assert entry.raw_vectors.file_name != old_raw
+        assert entry.metadata_store.live_ids().tolist() == [0, 1, 2]
+
+        # 旧快照仍被保留，旧读者按旧编号读取原始向量
+        assert (vector_env / old_raw).exists()
+        assert np.allclose(old.raw_vectors.get(np.array([4])), np.array([vectors[4]], dtype=np.float32))
+        assert old.metadata_store[4]["chunk_id"] == "1_4"
+
+        assert reader.get() is not old
+        assert reader.get().metadata_store[1]["chunk_id"] == "1_4"
+
+
+class TestSingleWriter:
+    """测试单写入进程的写入队列"""
+
+    def test_encode_round_trip(self):
+        """操作编码后向量和元数据保持不变"""
+        from app.services.vector_write_queue import VectorWriteQueue
+
+        vectors = np.array(_random_vectors(3), dtype=np.float32)
+        op = {"op": "add", "chunk_ids": ["1_a", "1_b", "1_c"], "vectors": vectors,
+              "metadata": [{"file_id": 1, "heading": "标题"}] * 3}
+
+        decoded = VectorWriteQueue.decode(VectorWriteQueue.encode(op))
+        assert decoded["chunk_ids"] == op["chunk_ids"]
+        assert decoded["metadata"] == op["metadata"]
+        np.testing.assert_array_equal(decoded["vectors"], vectors)
+
+    async def test_add_enqueued_when_enabled(self, vector_env, monkeypatch):
+        """开启单写入进程时 add_vectors 只入队，不写索引"""
+        from app.services.vector_service import VectorService
+        from app.services.vector_write_queue import vector_write_queue
+
+        enqueued = []
+        monkeypatch.setattr(settings, "VECTOR_SINGLE_WRITER", True)
+        monkeypatch.setattr(vector_write_queue, "enqueue", enqueued.append)
+
+        service = VectorService()
+        await service.add_vectors(["1_a"], _random_vectors(1), [{"file_id": 1}])
+        await service.delete_file_vectors(1)
+
+        assert [op["op"] for op in enqueued] == ["add", "delete"]
+        assert service._get_faiss_entry().index.ntotal == 0
+
+    async def test_apply_ops_in_order_and_idempotent(self, vector_env):
+        """批量提交保持入队顺序，重复提交同一批操作不产生重复向量"""
+        from app.services.vector_service import VectorService
+
+        vectors = np.array(_random_vectors(3), dtype=np.float32)
+        ops = [
+            {"op": "add", "chunk_ids": ["1_a", "1_b"], "vectors": vectors[:2],
+             "metadata": [{"file_id": 1}, {"file_id": 1}]},
+            {"op": "delete", "org_id": None, "conditions": {"file_ids": [1]}},
+            {"op": "add", "chunk_ids": ["2_a"], "vectors": vectors[2:],
+             "metadata": [{"file_id": 2}]},
+        ]
+
+        service = VectorService()
+        await service.apply_write_ops(ops)
+        await service.apply_write_ops(ops[2:])
+
+        entry = service._get_faiss_entry()
+        assert [meta["chunk_id"] for _, meta in entry.metadata_store.items()] == ["2_a"]
+        results = await service.search(vectors[0].tolist(), top_k=5)
+        assert [r["chunk_id"] for r in results] == ["2_a"]
+
+    async def test_write_lock_syncs_other_writer(self, vector_env):
+        """获取写锁时先同步其他进程已提交的写入"""
+        from app.services.vector_index_manager import FaissIndexManager
+
+        first, second = FaissIndexManager(), FaissIndexManager()
+        entry_a, entry_b = first.get(), second.get()
+
+        first.add(entry_a, np.array(_random_vectors(2), dtype=np.float32),
+                  [{"chunk_id": "1_a", "file_id": 1}, {"chunk_id": "1_b", "file_id": 1}])
+        first.save(entry_a)
+
+        with second.write_lock(entry_b) as entry_b:
+            with second.write_lock(entry_b) as entry_b:
+                entry_b = second.get()
+                second.add(entry_b, np.array(_random_vectors(1, seed=1), dtype=np.float32),
+                           [{"chunk_id": "2_a", "file_id": 2}])
+
+        assert entry_b.index.ntotal == 3
+        assert len(entry_b.metadata_store) == 3
+
+
+class TestHierarchicalSearch:
+    """测试文档级向量两阶段检索"""
+
+    @staticmethod
+    def _clustered(n_files, chunks_per_file):
+        """每个文件的分块围绕各自的中心分布"""
+        rng = np.random.default_rng(0)
+        centers = rng.random((n_files, DIM), dtype=np.float32) * 10
+        vectors = np.repeat(centers, chunks_per_file, axis=0)
+        vectors += rng.random(vectors.shape, dtype=np.float32) * 0.1
+        file_ids = np.repeat(np.arange(1, n_files + 1), chunks_per_file)
+        return centers, vectors, file_ids.tolist()
+
+    async def _add_files(self, service, vectors, file_ids):
+        await service.add_vectors(
+            [f"{f}_{i}" for i, f in enumerate(file_ids)],
+            vectors.tolist(),
+            [{"file_id": f} for f in file_ids]
+        )
+
+    async def test_two_stage_search(self, vector_env, monkeypatch):
+        """先选候选文件，只在候选文件的分块中搜索；删除文件时同步删除文档向量"""
+        from app.services.vector_service import VectorService
+
+        monkeypatch.setattr(settings, "VECTOR_HIERARCHICAL_SEARCH", True)
+        monkeypatch.setattr(settings, "VECTOR_HIERARCHICAL_MIN_FILES", 10)
+        monkeypatch.setattr(settings, "VECTOR_HIERARCHICAL_TOP_FILES", 2)
+
+        centers, vectors, file_ids = self._clustered(30, 4)
+        service = VectorService()
+        await self._add_files(service, vectors, file_ids)
+
+        docs_entry = service._get_faiss_entry(partition=VectorService.docs_partition_name("default"))
+        assert len(docs_entry.metadata_store) == 30
+        assert service._candidate_files("default", centers[6:7])[0][0] == 7
+
+        results = await service.search(centers[6].tolist(), top_k=4)
+        assert [r["metadata"]["file_id"] for r in results] == [7] * 4
+
+        await service.delete_file_vectors(7)
+        docs_entry = service._get_faiss_entry(partition=VectorService.docs_partition_name("default"))
+        assert len(docs_entry.metadata_store) == 29
+        results = await service.search(centers[6].tolist(), top_k=4)
+        assert 7 not in {r["metadata"]["file_id"] for r in results}
+
+    async def test_rebuild_backfills_existing_files(self, vector_env, monkeypatch):
+        """开启前写入的数据通过重建回填文档向量，文件过滤条件在第一阶段生效"""
+        from app.services.vector_service import VectorService
+
+        centers, vectors, file_ids = self._clustered(12, 3)
+        service = VectorService()
+        await self._add_files(service, vectors, file_ids)
+
+        monkeypatch.setattr(settings, "VECTOR_HIERARCHICAL_SEARCH", True)
+        monkeypatch.setattr(settings, "VECTOR_HIERARCHICAL_MIN_FILES", 10)
+        monkeypatch.setattr(settings, "VECTOR_HIERARCHICAL_TOP_FILES", 2)
+        assert service._candidate_files("default", centers[:1]) is None
+        assert service.rebuild_document_index("default") == 12
+
+        results = await service.search(centers[0].tolist(), top_k=3, filters={"file_ids": [2, 3, 4, 5]})
+        assert {r["metadata"]["file_id"] for r in results} <= {2, 3, 4, 5}
+
+
+class TestShards:
+    """测试分片的并行搜索与合并"""
+
+    @pytest.fixture
+    def sharded(self, vector_env, monkeypatch):
+        from app.services.vector_shards import vector_shard_coordinator
+
+        monkeypatch.setattr(settings, "VECTOR_NUM_SHARDS", 3)
+        vector_shard_coordinator.reset()
+        yield
+        vector_shard_coordinator.reset()
+
+    async def _add_and_search(self, queries, top_k=5):
+        from app.services.vector_service import VectorService
+
+        vectors = _random_vectors(60)
+        service = VectorService()
+        await service.add_vectors(
+            [f"{i % 10}_{i}" for i in range(60)],
+            vectors,
+            [{"file_id": i % 10} for i in range(60)]
+        )
+        return await service.search_batch(queries, top_k=top_k)
+
+    async def test_local_fan_out_matches_single_index(self, vector_env, monkeypatch):
+        """本进程内并行搜索各分片，合并后的结果与不分片时一致"""
+        from app.services.vector_index_manager import vector_index_manager
+        from app.services.vector_shards import shard_partitions, vector_shard_coordinator
+
+        queries = _random_vectors(4, seed=1)
+        expected = await self._add_and_search(queries)
+
+        vector_index_manager.reset()
+        monkeypatch.setattr(settings, "VECTOR_DB_PATH", str(vector_env / "sharded"))
+        monkeypatch.setattr(settings, "VECTOR_NUM_SHARDS", 3)
+        try:
+            results = await self._add_and_search(queries)
+            for partition in shard_partitions("default"):
+                entry = vector_index_manager.get(partition)
+                file_ids = {meta["file_id"] for _, meta in entry.metadata_store.items()}
+                assert {f % 3 for f in file_ids} == {int(partition[-1])}
+        finally:
+            vector_shard_coordinator.reset()
+
+        assert [[r["chunk_id"] for r in q] for q in results] == [[r["chunk_id"] for r in q] for q in expected]
+
+    async def test_missing_shards_are_skipped(self, sharded, vector_env):
+        """没有数据的分片直接返回空结果，搜索不会创建空的索引目录"""
+        import os
+        from app.services.vector_service import VectorService
+        from app.services.vector_shards import shard_of, shard_partition, shard_partitions
+
+        service = VectorService()
+        await service.add_vectors(["1_a"], _random_vectors(1), [{"file_id": 1, "org_id": 10}])
+        results = await service.search_batch(_random_vectors(2, seed=3), top_k=5, filters={"org_id": 10})
+        assert [[r["chunk_id"] for r in q] for q in results] == [["1_a"], ["1_a"]]
+
+        for partition in shard_partitions("org_10") + shard_partitions("default"):
+            if partition != shard_partition("org_10", shard_of(1)):
+                assert not os.path.exists(vector_env / partition)
+
+    async def test_search_over_shard_servers(self, sharded, monkeypatch):
+        """通过 IPC 查询各分片服务进程，并支持删除后的过滤"""
+        import threading
+        from app.services.vector_service import VectorService
+        from app.services.vector_shards import ShardServer
+
+        monkeypatch.setattr(settings, "VECTOR_SHARD_AUTHKEY", "test-shard-key")
+        servers = [ShardServer(shard) for shard in range(3)]
+        for server in servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        monkeypatch.setattr(
+            settings, "VECTOR_SHARD_ADDRESSES",
+            ",".join(f"{host}:{port}" for host, port in (server.address for server in servers))
+        )
+
+        try:
+            queries = _random_vectors(2, seed=2)
+            results = await self._add_and_search(queries, top_k=8)
+            assert all(len(q) == 8 for q in results)
+            assert [r["distance"] for r in results[0]] == sorted(r["distance"] for r in results[0])
+
+            await VectorService().delete_file_vectors(results[0][0]["metadata"]["file_id"])
+            deleted = results[0][0]["metadata"]["file_id"]
+            after = await VectorService().search(queries[0], top_k=8)
+            assert deleted not in {r["metadata"]["file_id"] for r in after}
+        finally:
+            for server in servers:
+                server.close()
+
+
+    def test_shard_protocol(self, monkeypatch):
+        """分片服务要求配置密钥；消息只包含 JSON 和限定类型的原始数组"""
+        from app.services.vector_shards import ShardServer, pack_message, unpack_message
+
+        monkeypatch.setattr(settings, "VECTOR_SHARD_AUTHKEY", "")
+        with pytest.raises(ValueError):
+            ShardServer(0)
+
+        queries = np.asarray(_random_vectors(3), dtype=np.float32)
+        header, arrays = unpack_message(pack_message({"method": "search", "top_k": 5}, queries))
+        assert header == {"method": "search", "top_k": 5}
+        np.testing.assert_array_equal(arrays[0], queries)
+
+        with pytest.raises(TypeError):
+            pack_message({}, np.zeros(2, dtype=object))
+        with pytest.raises(ValueError):
+            unpack_message(pack_message({"method": "ping"}) + b"extra")
+
+
+class TestColumnarMetadataStore:
+    """列式元数据存储测试"""
+
+    def test_round_trip_and_select(self, tmp_path):
+        """保存后内存映射加载，按文件 / chunk 筛选，首次写入时复制"""
+        from app.services.vector_metadata_store import ColumnarMetadataStore
+
+        store = ColumnarMetadataStore()
+        store.add([0, 1, 2], [
+            {"chunk_id": "1_0", "file_id": 1, "file_name": "a.pdf", "page": 1},
+            {"chunk_id": "1_1", "file_id": 1, "file_name": "a.pdf", "custom": "x"},
+            {"chunk_id": "2_0" * 20, "file_id": 2, "file_name": "b.pdf", "heading": "标题"},
+        ])
+        store.delete([0])
+        store.save(str(tmp_path))
+
+        loaded = ColumnarMetadataStore.load(str(tmp_path))
+        assert len(loaded) == 2
+        assert 0 not in loaded
+        assert loaded[1] == {
+            "chunk_id": "1_1", "file_id": 1, "org_id": None, "page": None,
+            "file_name": "a.pdf", "heading": None, "custom": "x",
+        }
+        assert loaded[2]["chunk_id"] == "2_0" * 20
+        assert loaded[2]["heading"] == "标题"
+        assert loaded.select(file_ids=[1]).tolist() == [1]
+        assert loaded.select(chunk_ids=["2_0" * 20, "missing"]).tolist() == [2]
+        # 比存储宽度长的 chunk_id 不能被截断后匹配到其他分块
+        assert loaded.select(chunk_ids=["2_0" * 20 + "x"]).tolist() == []
+
+        loaded.add([3], [{"chunk_id": "3_0", "file_id": 3, "file_name": "a.pdf"}])
+        assert loaded.live_ids().tolist() == [1, 2, 3]
+        assert len(loaded.strings["file_name"]) == 2
+
+        compacted = loaded.compacted(loaded.live_ids())
+        assert [m["chunk_id"] for _, m in compacted.items()] == ["1_1", "2_0" * 20, "3_0"]
+        assert compacted[0]["custom"] == "x"
+
+    def test_chunk_id_membership(self, tmp_path):
+        """chunk_id 计数随写入、删除、覆盖和加载保持一致"""
+        from app.services.vector_metadata_store import ColumnarMetadataStore
+
+        store = ColumnarMetadataStore()
+        store.add([0, 1], [{"chunk_id": "a"}, {"chunk_id": "b"}])
+        assert store.has_chunk_ids(["a", "b", "c"]).tolist() == [True, True, False]
+
+        store.add([1, 2], [{"chunk_id": "c"}, {"chunk_id": "a"}])
+        store.delete([0])
+        assert store.has_chunk_ids(["a", "b", "c"]).tolist() == [True, False, True]
+        store.delete([2, 2])
+        assert store.has_chunk_ids(["a", "c"]).tolist() == [False, True]
+
+        store.save(str(tmp_path))
+        loaded = ColumnarMetadataStore.load(str(tmp_path))
+        assert loaded.has_chunk_ids(["a", "c", "c" * 100]).tolist() == [False, True, False]
+        loaded.add([3], [{"chunk_id": "d" * 40}])
+        assert loaded.has_chunk_ids(["d" * 40, "c"]).tolist() == [True, True]
+        assert loaded.compacted(loaded.live_ids()).has_chunk_ids(["c", "d" * 40]).tolist() == [True, True]